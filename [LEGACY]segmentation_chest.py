@@ -1,5 +1,4 @@
 import os
-import glob
 
 from typing import Optional, Union, List, Dict, Sequence, Callable
 import torch
@@ -46,6 +45,7 @@ from monai.transforms import (
 )
 # from data import CustomDataModule
 from model import *
+from file_index import index_files
 
 class PairedAndUnsupervisedDataset(monai.data.Dataset, monai.transforms.Randomizable):
     def __init__(
@@ -124,8 +124,7 @@ class PairedAndUnsupervisedDataModule(LightningDataModule):
         # self.setup()
         def glob_files(folders: str=None, extension: str='*.nii.gz'):
             assert folders is not None
-            paths = [glob.glob(os.path.join(folder, extension), recursive = True) for folder in folders]
-            files = sorted([item for sublist in paths for item in sublist])
+            files = index_files(folders, extension)
             print(len(files))
             print(files[:1])
             return files
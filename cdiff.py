@@ -3,22 +3,31 @@ import copy
 from pathlib import Path
 from random import random
 from functools import partial
-from collections import namedtuple
+from contextlib import nullcontext
+from collections import namedtuple, OrderedDict
 from multiprocessing import cpu_count
 
 import torch
 from torch import nn, einsum
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 from einops import rearrange, reduce, repeat
 from einops.layers.torch import Rearrange
 
 from tqdm.auto import tqdm
 
+from solvers import SOLVERS
+from layers import LayerNorm, LinearAttention, WeightStandardizedConv2d, group_norm_scale_shift_silu, is_channels_last, concat_skip, weights_version
+
 # constants
 
 ModelPrediction =  namedtuple('ModelPrediction', ['pred_noise', 'pred_x_start'])
 
+# input shapes the unet keeps decoder skip buffers for, least recently used first out
+
+MAX_SKIP_BUFFER_SHAPES = 2
+
 # helpers functions
 
 def exists(x):
@@ -81,8 +90,8 @@ class Residual(nn.Module):
         super().__init__()
         self.fn = fn
 
-    def forward(self, x, *args, **kwargs):
-        return self.fn(x, *args, **kwargs) + x
+    def forward(self, x, *args, out = None, **kwargs):
+        return torch.add(self.fn(x, *args, **kwargs), x, out = out)
 
 def Upsample(dim, dim_out = None):
     return nn.Sequential(
@@ -93,32 +102,6 @@ def Upsample(dim, dim_out = None):
 def Downsample(dim, dim_out = None):
     return nn.Conv2d(dim, default(dim_out, dim), 4, 2, 1)
 
-class WeightStandardizedConv2d(nn.Conv2d):
-    """
-    https://arxiv.org/abs/1903.10520
-    weight standardization purportedly works synergistically with group normalization
-    """
-    def forward(self, x):
-        eps = 1e-5 if x.dtype == torch.float32 else 1e-3
-
-        weight = self.weight
-        mean = reduce(weight, 'o ... -> o 1 1 1', 'mean')
-        var = reduce(weight, 'o ... -> o 1 1 1', partial(torch.var, unbiased = False))
-        normalized_weight = (weight - mean) * (var + eps).rsqrt()
-
-        return F.conv2d(x, normalized_weight, self.bias, self.stride, self.padding, self.dilation, self.groups)
-
-class LayerNorm(nn.Module):
-    def __init__(self, dim):
-        super().__init__()
-        self.g = nn.Parameter(torch.ones(1, dim, 1, 1))
-
-    def forward(self, x):
-        eps = 1e-5 if x.dtype == torch.float32 else 1e-3
-        var = torch.var(x, dim = 1, unbiased = False, keepdim = True)
-        mean = torch.mean(x, dim = 1, keepdim = True)
-        return (x - mean) * (var + eps).rsqrt() * self.g
-
 class PreNorm(nn.Module):
     def __init__(self, dim, fn):
         super().__init__()
@@ -165,14 +148,23 @@ class RandomOrLearnedSinusoidalPosEmb(nn.Module):
 # building block modules
 
 class Block(nn.Module):
-    def __init__(self, dim, dim_out, groups = 8):
+    def __init__(self, dim, dim_out, groups = 8, fused = False):
         super().__init__()
         self.proj = WeightStandardizedConv2d(dim, dim_out, 3, padding = 1)
         self.norm = nn.GroupNorm(groups, dim_out)
         self.act = nn.SiLU()
 
+        # fused folds the scale / shift into the group norm affine and applies the silu in place, see layers.py
+        # only taken outside of autograd, the backward of the folded affine is slower than the unfused one on cpu
+
+        self.fused = fused
+
     def forward(self, x, scale_shift = None):
         x = self.proj(x)
+
+        if self.fused and not torch.is_grad_enabled():
+            return group_norm_scale_shift_silu(x, self.norm, scale_shift)
+
         x = self.norm(x)
 
         if exists(scale_shift):
@@ -183,21 +175,41 @@ class Block(nn.Module):
         return x
 
 class ResnetBlock(nn.Module):
-    def __init__(self, dim, dim_out, *, time_emb_dim = None, classes_emb_dim = None, groups = 8):
+    def __init__(self, dim, dim_out, *, time_emb_dim = None, classes_emb_dim = None, groups = 8, fused = False):
         super().__init__()
         self.mlp = nn.Sequential(
             nn.SiLU(),
             nn.Linear(int(time_emb_dim) + int(classes_emb_dim), dim_out * 2)
         ) if exists(time_emb_dim) or exists(classes_emb_dim) else None
 
-        self.block1 = Block(dim, dim_out, groups = groups)
-        self.block2 = Block(dim_out, dim_out, groups = groups)
+        self.time_emb_dim = time_emb_dim
+
+        self.block1 = Block(dim, dim_out, groups = groups, fused = fused)
+        self.block2 = Block(dim_out, dim_out, groups = groups, fused = fused)
         self.res_conv = nn.Conv2d(dim, dim_out, 1) if dim != dim_out else nn.Identity()
 
-    def forward(self, x, time_emb = None, class_emb = None):
+    def time_proj(self, time_emb):
+        """
+        time half of the mlp, which acts on [time_emb, class_emb]
+        the silu is elementwise, so the mlp splits into W_time silu(time_emb) + W_class silu(class_emb) + bias
+        """
+        return F.linear(F.silu(time_emb), self.mlp[-1].weight[:, :self.time_emb_dim])
+
+    def class_proj(self, class_emb):
+        """ class half of the mlp, with the bias """
+        linear = self.mlp[-1]
+        return F.linear(F.silu(class_emb), linear.weight[:, self.time_emb_dim:], linear.bias)
+
+    def forward(self, x, time_emb = None, class_emb = None, time_proj = None, out = None):
+        # time_proj, the time half of the mlp, can be looked up from the unet time cache instead
 
         scale_shift = None
-        if exists(self.mlp) and (exists(time_emb) or exists(class_emb)):
+        if exists(time_proj):
+            cond_emb = time_proj + self.class_proj(class_emb)
+            cond_emb = rearrange(cond_emb, 'b c -> b c 1 1')
+            scale_shift = cond_emb.chunk(2, dim = 1)
+
+        elif exists(self.mlp) and (exists(time_emb) or exists(class_emb)):
             cond_emb = tuple(filter(exists, (time_emb, class_emb)))
             cond_emb = torch.cat(cond_emb, dim = -1)
             cond_emb = self.mlp(cond_emb)
@@ -208,60 +220,48 @@ class ResnetBlock(nn.Module):
 
         h = self.block2(h)
 
-        return h + self.res_conv(x)
+        return torch.add(h, self.res_conv(x), out = out)
 
-class LinearAttention(nn.Module):
-    def __init__(self, dim, heads = 4, dim_head = 32):
+class Attention(nn.Module):
+    def __init__(self, dim, heads = 4, dim_head = 32, flash = True):
         super().__init__()
         self.scale = dim_head ** -0.5
         self.heads = heads
         hidden_dim = dim_head * heads
-        self.to_qkv = nn.Conv2d(dim, hidden_dim * 3, 1, bias = False)
-
-        self.to_out = nn.Sequential(
-            nn.Conv2d(hidden_dim, dim, 1),
-            LayerNorm(dim)
-        )
 
-    def forward(self, x):
-        b, c, h, w = x.shape
-        qkv = self.to_qkv(x).chunk(3, dim = 1)
-        q, k, v = map(lambda t: rearrange(t, 'b (h c) x y -> b h c (x y)', h = self.heads), qkv)
+        # scaled_dot_product_attention (flash / memory efficient kernels) never materializes the [n, n] similarity matrix
+        # falls back to the explicit softmax attention on pytorch versions without it
 
-        q = q.softmax(dim = -2)
-        k = k.softmax(dim = -1)
-
-        q = q * self.scale
-        v = v / (h * w)
+        self.flash = flash and hasattr(F, 'scaled_dot_product_attention')
 
-        context = torch.einsum('b h d n, b h e n -> b h d e', k, v)
+        self.to_qkv = nn.Conv2d(dim, hidden_dim * 3, 1, bias = False)
+        self.to_out = nn.Conv2d(hidden_dim, dim, 1)
 
-        out = torch.einsum('b h d e, b h d n -> b h e n', context, q)
-        out = rearrange(out, 'b h c (x y) -> b (h c) x y', h = self.heads, x = h, y = w)
-        return self.to_out(out)
+    def attend(self, q, k, v):
+        if self.flash:
+            return F.scaled_dot_product_attention(q, k, v) # default scale is dim_head ** -0.5
 
-class Attention(nn.Module):
-    def __init__(self, dim, heads = 4, dim_head = 32):
-        super().__init__()
-        self.scale = dim_head ** -0.5
-        self.heads = heads
-        hidden_dim = dim_head * heads
+        q = q * self.scale
 
-        self.to_qkv = nn.Conv2d(dim, hidden_dim * 3, 1, bias = False)
-        self.to_out = nn.Conv2d(hidden_dim, dim, 1)
+        sim = einsum('b h i d, b h j d -> b h i j', q, k)
+        attn = sim.softmax(dim = -1)
+        return einsum('b h i j, b h j d -> b h i d', attn, v)
 
     def forward(self, x):
         b, c, h, w = x.shape
-        qkv = self.to_qkv(x).chunk(3, dim = 1)
-        q, k, v = map(lambda t: rearrange(t, 'b (h c) x y -> b h c (x y)', h = self.heads), qkv)
+        qkv = self.to_qkv(x)
 
-        q = q * self.scale
+        if not is_channels_last(qkv):
+            q, k, v = map(lambda t: rearrange(t, 'b (h c) x y -> b h (x y) c', h = self.heads), qkv.chunk(3, dim = 1))
+            out = self.attend(q, k, v)
+            out = rearrange(out, 'b h (x y) d -> b (h d) x y', x = h, y = w)
+            return self.to_out(out)
 
-        sim = einsum('b h d i, b h d j -> b h i j', q, k)
-        attn = sim.softmax(dim = -1)
-        out = einsum('b h i j, b h d j -> b h i d', attn, v)
+        # [b, h, w, c] memory, q, k, v as strided [b, heads, h * w, dim_head] views and the output back to channels last
 
-        out = rearrange(out, 'b h (x y) d -> b (h d) x y', x = h, y = w)
+        q, k, v = qkv.permute(0, 2, 3, 1).reshape(b, h * w, 3, self.heads, -1).permute(2, 0, 3, 1, 4).unbind(dim = 0)
+        out = self.attend(q, k, v)
+        out = out.transpose(1, 2).reshape(b, h, w, -1).permute(0, 3, 1, 2)
         return self.to_out(out)
 
 # model
@@ -281,6 +281,12 @@ class Unet(nn.Module):
         learned_sinusoidal_cond = False,
         random_fourier_features = False,
         learned_sinusoidal_dim = 16,
+        full_attn = None,
+        flash_attn = True,
+        fused_blocks = False,
+        channels_last = False,
+        preallocate_skips = False,
+        checkpoint_levels = ()
     ):
         super().__init__()
 
@@ -299,7 +305,15 @@ class Unet(nn.Module):
         dims = [init_dim, *map(lambda m: dim * m, dim_mults)]
         in_out = list(zip(dims[:-1], dims[1:]))
 
-        block_klass = partial(ResnetBlock, groups = resnet_block_groups)
+        block_klass = partial(ResnetBlock, groups = resnet_block_groups, fused = fused_blocks)
+
+        # attention per resolution level, linear by default, full (flash when available) where full_attn is True
+        # the mid block always uses full attention
+
+        full_attn = default(full_attn, (False,) * len(in_out))
+        assert len(full_attn) == len(in_out), 'full_attn must have one entry per resolution level'
+
+        attn_klass = lambda dim, full: Attention(dim, flash = flash_attn) if full else LinearAttention(dim)
 
         # time embeddings
 
@@ -334,34 +348,39 @@ class Unet(nn.Module):
             nn.Linear(classes_dim, classes_dim)
         )
 
+        # classes_mlp output of the null class, cached at inference
+
+        self._null_cond = None
+        self._null_cond_version = None
+
         # layers
 
         self.downs = nn.ModuleList([])
         self.ups = nn.ModuleList([])
         num_resolutions = len(in_out)
 
-        for ind, (dim_in, dim_out) in enumerate(in_out):
+        for ind, ((dim_in, dim_out), level_full_attn) in enumerate(zip(in_out, full_attn)):
             is_last = ind >= (num_resolutions - 1)
 
             self.downs.append(nn.ModuleList([
                 block_klass(dim_in, dim_in, time_emb_dim = time_dim, classes_emb_dim = classes_dim),
                 block_klass(dim_in, dim_in, time_emb_dim = time_dim, classes_emb_dim = classes_dim),
-                Residual(PreNorm(dim_in, LinearAttention(dim_in))),
+                Residual(PreNorm(dim_in, attn_klass(dim_in, level_full_attn))),
                 Downsample(dim_in, dim_out) if not is_last else nn.Conv2d(dim_in, dim_out, 3, padding = 1)
             ]))
 
         mid_dim = dims[-1]
         self.mid_block1 = block_klass(mid_dim, mid_dim, time_emb_dim = time_dim, classes_emb_dim = classes_dim)
-        self.mid_attn = Residual(PreNorm(mid_dim, Attention(mid_dim)))
+        self.mid_attn = Residual(PreNorm(mid_dim, Attention(mid_dim, flash = flash_attn)))
         self.mid_block2 = block_klass(mid_dim, mid_dim, time_emb_dim = time_dim, classes_emb_dim = classes_dim)
 
-        for ind, (dim_in, dim_out) in enumerate(reversed(in_out)):
+        for ind, ((dim_in, dim_out), level_full_attn) in enumerate(zip(reversed(in_out), reversed(full_attn))):
             is_last = ind == (len(in_out) - 1)
 
             self.ups.append(nn.ModuleList([
                 block_klass(dim_out + dim_in, dim_out, time_emb_dim = time_dim, classes_emb_dim = classes_dim),
                 block_klass(dim_out + dim_in, dim_out, time_emb_dim = time_dim, classes_emb_dim = classes_dim),
-                Residual(PreNorm(dim_out, LinearAttention(dim_out))),
+                Residual(PreNorm(dim_out, attn_klass(dim_out, level_full_attn))),
                 Upsample(dim_out, dim_in) if not is_last else  nn.Conv2d(dim_out, dim_in, 3, padding = 1)
             ]))
 
@@ -371,18 +390,192 @@ class Unet(nn.Module):
         self.final_res_block = block_klass(dim * 2, dim, time_emb_dim = time_dim, classes_emb_dim = classes_dim)
         self.final_conv = nn.Conv2d(dim, self.out_dim, 1)
 
+        # activation checkpointing, the blocks of the down and up stages at these resolution levels (0 being the highest resolution)
+        # are recomputed in the backward instead of keeping their intermediate activations
+
+        self.checkpoint_levels = tuple(checkpoint_levels)
+        assert all(0 <= level < len(in_out) for level in self.checkpoint_levels), f'checkpoint levels must be between 0 and {len(in_out) - 1}'
+
+        # at inference, the decoder concatenations can be served from buffers preallocated per input shape, see skip_buffers
+        # channels of the skip in each of them, in the order the encoder produces the skips, the init_conv output r last
+
+        self.preallocate_skips = preallocate_skips
+        self.in_out = in_out
+        self.skip_dims = [*[dim_in for dim_in, _ in in_out for _ in range(2)], init_dim]
+        self._skip_buffers = OrderedDict()
+
+        # channels last (nhwc) activations and conv weights end to end, faster with onednn cpu and cudnn convs
+
+        self.channels_last = channels_last
+
+        if channels_last:
+            self.to(memory_format = torch.channels_last)
+
+        # inference cache of the time embedding and the resnet block projections of it, enabled by cache_time_embeddings
+
+        self.num_cached_timesteps = None
+        self._time_cache = None
+        self._time_cache_version = None
+
+    def checkpointed(self, level, stage):
+        """
+        the block1, block2, attn, resample modules of a stage, the first three wrapped to be recomputed in the backward
+        when training with the stage level checkpointed, the resampling conv saves no more than its input anyway
+        """
+        if level not in self.checkpoint_levels or not torch.is_grad_enabled():
+            return stage
+
+        *modules, resample = stage
+        return [*(partial(checkpoint, module, use_reentrant = False) for module in modules), resample]
+
+    def skip_buffers(self, x):
+        """
+        [x, skip] decoder inputs for an init_conv output shaped like x, one per skip in the order the encoder produces them,
+        followed by the [x, r] input of the final block, kept per shape, dtype and device as sampling repeats the same shape
+        only the MAX_SKIP_BUFFER_SHAPES most recent shapes are kept, the batch of sample_until_stable shrinks step after step
+        """
+        b, channels, height, width = x.shape
+        key = (b, height, width, x.dtype, x.device)
+
+        if key in self._skip_buffers:
+            self._skip_buffers.move_to_end(key)
+        else:
+            memory_format = torch.channels_last if self.channels_last else torch.contiguous_format
+            empty = lambda dim, level: torch.empty((b, dim, height // 2 ** level, width // 2 ** level), dtype = x.dtype, device = x.device, memory_format = memory_format)
+
+            buffers = [empty(dim_out + dim_in, level) for level, (dim_in, dim_out) in enumerate(self.in_out) for _ in range(2)]
+            buffers.append(empty(channels * 2, 0))
+            self._skip_buffers[key] = buffers
+
+            while len(self._skip_buffers) > MAX_SKIP_BUFFER_SHAPES:
+                self._skip_buffers.popitem(last = False)
+
+        return self._skip_buffers[key]
+
+    def freeze_for_inference(self):
+        """ eval mode, with every weight standardized conv standardizing its weight once instead of on every call """
+        self.eval()
+        for module in self.modules():
+            if isinstance(module, WeightStandardizedConv2d):
+                module.freeze()
+        return self
+
+    def cache_time_embeddings(self, num_timesteps):
+        """ at inference, look the time embeddings of the integer timesteps [0, num_timesteps) up instead of recomputing them """
+        self.num_cached_timesteps = num_timesteps
+        self._time_cache = None
+        self._time_cache_version = None
+        return self
+
+    def time_tables(self, device):
+        """
+        [T, time_dim] time embedding and, per resnet block, the [T, dim_out * 2] time half of its scale / shift projection
+        built lazily outside of autograd, rebuilt when the weights change
+        """
+        blocks = [module for module in self.modules() if isinstance(module, ResnetBlock) and exists(module.mlp)]
+        version = weights_version(self.time_mlp, *blocks)
+
+        # built in float32 even when first requested under autocast, the tables outlive the autocast region
+
+        if self._time_cache_version != version:
+            with torch.autocast(device.type, enabled = False):
+                times = torch.arange(self.num_cached_timesteps, device = device)
+                table = self.time_mlp(times)
+                self._time_cache = (table, {block: block.time_proj(table) for block in blocks})
+
+            self._time_cache_version = version
+
+        return self._time_cache
+
+    def time_embeddings(self, time):
+        """ time embedding t and the per resnet block projections of it, the latter only when served from the cache """
+        use_cache = exists(self.num_cached_timesteps) and not torch.is_grad_enabled() and not time.is_floating_point()
+
+        if not use_cache:
+            return self.time_mlp(time), {}
+
+        table, block_tables = self.time_tables(time.device)
+        t = table.index_select(0, time)
+        return t, {block: block_table.index_select(0, time) for block, block_table in block_tables.items()}
+
+    def null_class_cond(self):
+        """ classes_mlp output of the null class embedding, [classes_dim], cached outside of autograd until the weights change """
+        if torch.is_grad_enabled():
+            return self.classes_mlp(self.null_classes_emb)
+
+        version = weights_version(self.null_classes_emb, self.classes_mlp)
+
+        if self._null_cond_version != version:
+            self._null_cond = self.classes_mlp(self.null_classes_emb)
+            self._null_cond_version = version
+
+        return self._null_cond
+
+    def class_cond(
+        self,
+        classes,
+        cond_drop_prob = None,
+        keep_mask = None
+    ):
+        """
+        class conditioning vector c, [b, classes_dim], fed to every resnet block
+        classes are constant over a sampling trajectory, so samplers compute it once and pass it to forward as `cond`
+        """
+        batch, device = classes.shape[0], classes.device
+
+        cond_drop_prob = default(cond_drop_prob, self.cond_drop_prob)
+
+        # derive condition, with condition dropout for classifier free guidance
+        # an explicit keep_mask (True keeps the class) overrides the random dropout
+        # the mlp acts per row, so dropping after it is the same as dropping the embedding before it
+
+        c = self.classes_mlp(self.classes_emb(classes))
+
+        if exists(keep_mask) or cond_drop_prob > 0:
+            keep_mask = default(keep_mask, lambda: prob_mask_like((batch,), 1 - cond_drop_prob, device = device))
+
+            c = torch.where(
+                rearrange(keep_mask, 'b -> b 1'),
+                c,
+                self.null_class_cond()
+            )
+
+        return c
+
     def forward_with_cond_scale(
         self,
-        *args,
+        x,
+        time,
+        classes,
         cond_scale = 1.,
-        **kwargs
+        single_pass = True,
+        cond = None
     ):
-        logits = self.forward(*args, **kwargs)
+        cond = default(cond, lambda: self.class_cond(classes, cond_drop_prob = 0.))
 
         if cond_scale == 1:
-            return logits
+            return self.forward(x, time, classes, cond = cond)
+
+        batch = x.shape[0]
+        null_cond = repeat(self.null_class_cond(), 'd -> b d', b = batch)
 
-        null_logits = self.forward(*args, cond_drop_prob = 1., **kwargs)
+        if not single_pass:
+            logits = self.forward(x, time, classes, cond = cond)
+            null_logits = self.forward(x, time, classes, cond = null_cond)
+            return null_logits + (logits - null_logits) * cond_scale
+
+        # conditional and null branches concatenated along the batch, so one unet pass serves both
+
+        time = time.expand(batch) if time.ndim == 0 else time
+
+        out = self.forward(
+            torch.cat((x, x), dim = 0),
+            torch.cat((time, time), dim = 0),
+            torch.cat((classes, classes), dim = 0),
+            cond = torch.cat((cond, null_cond), dim = 0)
+        )
+
+        logits, null_logits = out.chunk(2, dim = 0)
         return null_logits + (logits - null_logits) * cond_scale
 
     def forward(
@@ -390,64 +583,68 @@ class Unet(nn.Module):
         x,
         time,
         classes,
-        cond_drop_prob = None
+        cond_drop_prob = None,
+        keep_mask = None,
+        cond = None
     ):
-        batch, device = x.shape[0], x.device
+        # a precomputed class conditioning (see class_cond) skips the class path entirely
 
-        cond_drop_prob = default(cond_drop_prob, self.cond_drop_prob)
-
-        # derive condition, with condition dropout for classifier free guidance        
+        c = default(cond, lambda: self.class_cond(classes, cond_drop_prob = cond_drop_prob, keep_mask = keep_mask))
 
-        classes_emb = self.classes_emb(classes)
+        # unet
 
-        if cond_drop_prob > 0:
-            keep_mask = prob_mask_like((batch,), 1 - cond_drop_prob, device = device)
-            null_classes_emb = repeat(self.null_classes_emb, 'd -> b d', b = batch)
+        if self.channels_last:
+            x = x.contiguous(memory_format = torch.channels_last)
 
-            classes_emb = torch.where(
-                rearrange(keep_mask, 'b -> b 1'),
-                classes_emb,
-                null_classes_emb
-            )
+        x = self.init_conv(x)
 
-        c = self.classes_mlp(classes_emb)
+        # with preallocated skips, the encoder writes each skip straight into its slice of the matching decoder input,
+        # and the first decoder block of each level its output in front of the next skip, so the concatenations copy little
 
-        # unet
+        cats = self.skip_buffers(x) if self.preallocate_skips and not torch.is_grad_enabled() else None
+        cat_buffer = lambda index: cats[index] if exists(cats) else None
+        skip_slot = lambda index: cats[index][:, -self.skip_dims[index]:] if exists(cats) else None
+        head_slot = lambda index: cats[index][:, :-self.skip_dims[index]] if exists(cats) else None
 
-        x = self.init_conv(x)
-        r = x.clone()
+        r = x.clone() if not exists(cats) else skip_slot(-1).copy_(x)
 
-        t = self.time_mlp(time)
+        t, proj = self.time_embeddings(time)
 
         h = []
 
-        for block1, block2, attn, downsample in self.downs:
-            x = block1(x, t, c)
+        for level, stage in enumerate(self.downs):
+            block1, block2, attn, downsample = self.checkpointed(level, stage)
+
+            x = block1(x, t, c, proj.get(block1), out = skip_slot(len(h)))
             h.append(x)
 
-            x = block2(x, t, c)
-            x = attn(x)
+            x = block2(x, t, c, proj.get(block2))
+            x = attn(x, out = skip_slot(len(h)))
             h.append(x)
 
             x = downsample(x)
 
-        x = self.mid_block1(x, t, c)
+        x = self.mid_block1(x, t, c, proj.get(self.mid_block1))
         x = self.mid_attn(x)
-        x = self.mid_block2(x, t, c)
+        x = self.mid_block2(x, t, c, proj.get(self.mid_block2))
+
+        for ind, stage in enumerate(self.ups):
+            block1, block2, attn, upsample = self.checkpointed(len(self.ups) - 1 - ind, stage)
 
-        for block1, block2, attn, upsample in self.ups:
-            x = torch.cat((x, h.pop()), dim = 1)
-            x = block1(x, t, c)
+            skip = h.pop()
+            x = concat_skip(x, skip, cat_buffer(len(h)))
+            x = block1(x, t, c, proj.get(block1), out = head_slot(len(h) - 1))
 
-            x = torch.cat((x, h.pop()), dim = 1)
-            x = block2(x, t, c)
+            skip = h.pop()
+            x = concat_skip(x, skip, cat_buffer(len(h)))
+            x = block2(x, t, c, proj.get(block2))
             x = attn(x)
 
             x = upsample(x)
 
-        x = torch.cat((x, r), dim = 1)
+        x = concat_skip(x, r, cat_buffer(-1))
 
-        x = self.final_res_block(x, t, c)
+        x = self.final_res_block(x, t, c, proj.get(self.final_res_block))
         return self.final_conv(x)
 
 # gaussian diffusion trainer class
@@ -457,6 +654,34 @@ def extract(a, t, x_shape):
     out = a.gather(-1, t)
     return out.reshape(b, *((1,) * (len(x_shape) - 1)))
 
+ScheduleCoefficients = namedtuple('ScheduleCoefficients', [
+    'sqrt_alphas_cumprod',
+    'sqrt_one_minus_alphas_cumprod',
+    'sqrt_recip_alphas_cumprod',
+    'sqrt_recipm1_alphas_cumprod',
+    'posterior_mean_coef1',
+    'posterior_mean_coef2',
+    'posterior_variance',
+    'posterior_log_variance_clipped',
+    'p2_loss_weight'
+])
+
+class ScheduleTable(nn.Module):
+    """
+    all per timestep coefficients packed into one contiguous [T, K] table,
+    so a single gather per call returns every coefficient, already shaped to broadcast against x
+    """
+    def __init__(self, **buffers):
+        super().__init__()
+        table = torch.stack([buffers[name] for name in ScheduleCoefficients._fields], dim = -1)
+        self.register_buffer('table', table.to(torch.float32).contiguous(), persistent = False)
+
+    def forward(self, t, x_shape):
+        b, *_ = t.shape
+        coefs = self.table.index_select(0, t)
+        coefs = coefs.reshape(b, len(ScheduleCoefficients._fields), *((1,) * (len(x_shape) - 1)))
+        return ScheduleCoefficients(*coefs.unbind(dim = 1))
+
 def linear_beta_schedule(timesteps):
     scale = 1000 / timesteps
     beta_start = scale * 0.0001
@@ -488,7 +713,8 @@ class GaussianDiffusion(nn.Module):
         beta_schedule = 'cosine',
         p2_loss_weight_gamma = 0., # p2 loss weight, from https://arxiv.org/abs/2204.00227 - 0 is equivalent to weight of 1 across time - 1. is recommended
         p2_loss_weight_k = 1,
-        ddim_sampling_eta = 1.
+        ddim_sampling_eta = 1.,
+        autocast_dtype = None
     ):
         super().__init__()
         assert not (type(self) == GaussianDiffusion and model.channels != model.out_dim)
@@ -516,6 +742,7 @@ class GaussianDiffusion(nn.Module):
 
         timesteps, = betas.shape
         self.num_timesteps = int(timesteps)
+        self.model.cache_time_embeddings(self.num_timesteps)
         self.loss_type = loss_type
 
         # sampling related parameters
@@ -526,6 +753,11 @@ class GaussianDiffusion(nn.Module):
         self.is_ddim_sampling = self.sampling_timesteps < timesteps
         self.ddim_sampling_eta = ddim_sampling_eta
 
+        # the unet can run under autocast (torch.bfloat16 for cpu training and sampling), while the schedule buffers stay float32
+        # and the unet output is cast back to the dtype of x, so the sampler updates and the loss accumulate in float32
+
+        self.autocast_dtype = autocast_dtype
+
         # helper function to register buffer from float64 to float32
 
         register_buffer = lambda name, val: self.register_buffer(name, val.to(torch.float32))
@@ -560,41 +792,62 @@ class GaussianDiffusion(nn.Module):
 
         register_buffer('p2_loss_weight', (p2_loss_weight_k + alphas_cumprod / (1 - alphas_cumprod)) ** -p2_loss_weight_gamma)
 
+        # the buffers above packed into one table, gathered once per call instead of once per buffer
+
+        self.schedule = ScheduleTable(**{name: getattr(self, name) for name in ScheduleCoefficients._fields})
+
     def predict_start_from_noise(self, x_t, t, noise):
+        coefs = self.schedule(t, x_t.shape)
         return (
-            extract(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t -
-            extract(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape) * noise
+            coefs.sqrt_recip_alphas_cumprod * x_t -
+            coefs.sqrt_recipm1_alphas_cumprod * noise
         )
 
     def predict_noise_from_start(self, x_t, t, x0):
+        coefs = self.schedule(t, x_t.shape)
         return (
-            (extract(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t - x0) / \
-            extract(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape)
+            (coefs.sqrt_recip_alphas_cumprod * x_t - x0) / \
+            coefs.sqrt_recipm1_alphas_cumprod
         )
 
     def predict_v(self, x_start, t, noise):
+        coefs = self.schedule(t, x_start.shape)
         return (
-            extract(self.sqrt_alphas_cumprod, t, x_start.shape) * noise -
-            extract(self.sqrt_one_minus_alphas_cumprod, t, x_start.shape) * x_start
+            coefs.sqrt_alphas_cumprod * noise -
+            coefs.sqrt_one_minus_alphas_cumprod * x_start
         )
 
     def predict_start_from_v(self, x_t, t, v):
+        coefs = self.schedule(t, x_t.shape)
         return (
-            extract(self.sqrt_alphas_cumprod, t, x_t.shape) * x_t -
-            extract(self.sqrt_one_minus_alphas_cumprod, t, x_t.shape) * v
+            coefs.sqrt_alphas_cumprod * x_t -
+            coefs.sqrt_one_minus_alphas_cumprod * v
         )
 
     def q_posterior(self, x_start, x_t, t):
+        coefs = self.schedule(t, x_t.shape)
         posterior_mean = (
-            extract(self.posterior_mean_coef1, t, x_t.shape) * x_start +
-            extract(self.posterior_mean_coef2, t, x_t.shape) * x_t
+            coefs.posterior_mean_coef1 * x_start +
+            coefs.posterior_mean_coef2 * x_t
         )
-        posterior_variance = extract(self.posterior_variance, t, x_t.shape)
-        posterior_log_variance_clipped = extract(self.posterior_log_variance_clipped, t, x_t.shape)
-        return posterior_mean, posterior_variance, posterior_log_variance_clipped
+        return posterior_mean, coefs.posterior_variance, coefs.posterior_log_variance_clipped
+
+    def autocast(self, device):
+        """ autocast region of the unet calls, a no-op without autocast_dtype, which leaves an enclosing autocast (lightning's) in effect """
+        if not exists(self.autocast_dtype):
+            return nullcontext()
+
+        return torch.autocast(device.type, dtype = self.autocast_dtype)
 
-    def model_predictions(self, x, t, classes, cond_scale = 3., clip_x_start = False):
-        model_output = self.model.forward_with_cond_scale(x, t, classes, cond_scale = cond_scale)
+    def run_model(self, fn, x, *args, **kwargs):
+        """ fn (a unet method) under autocast, its output in the dtype of x """
+        with self.autocast(x.device):
+            out = fn(x, *args, **kwargs)
+
+        return out.to(x.dtype)
+
+    def model_predictions(self, x, t, classes, cond_scale = 3., clip_x_start = False, cond = None):
+        model_output = self.run_model(self.model.forward_with_cond_scale, x, t, classes, cond_scale = cond_scale, cond = cond)
         maybe_clip = partial(torch.clamp, min = -1., max = 1.) if clip_x_start else identity
 
         if self.objective == 'pred_noise':
@@ -615,8 +868,8 @@ class GaussianDiffusion(nn.Module):
 
         return ModelPrediction(pred_noise, x_start)
 
-    def p_mean_variance(self, x, t, classes, cond_scale, clip_denoised = True):
-        preds = self.model_predictions(x, t, classes, cond_scale)
+    def p_mean_variance(self, x, t, classes, cond_scale, clip_denoised = True, cond = None):
+        preds = self.model_predictions(x, t, classes, cond_scale, cond = cond)
         x_start = preds.pred_x_start
 
         if clip_denoised:
@@ -626,10 +879,10 @@ class GaussianDiffusion(nn.Module):
         return model_mean, posterior_variance, posterior_log_variance, x_start
 
     @torch.no_grad()
-    def p_sample(self, x, t: int, classes, cond_scale = 3., clip_denoised = True):
+    def p_sample(self, x, t: int, classes, cond_scale = 3., clip_denoised = True, cond = None):
         b, *_, device = *x.shape, x.device
         batched_times = torch.full((x.shape[0],), t, device = x.device, dtype = torch.long)
-        model_mean, _, model_log_variance, x_start = self.p_mean_variance(x = x, t = batched_times, classes = classes, cond_scale = cond_scale, clip_denoised = clip_denoised)
+        model_mean, _, model_log_variance, x_start = self.p_mean_variance(x = x, t = batched_times, classes = classes, cond_scale = cond_scale, clip_denoised = clip_denoised, cond = cond)
         noise = torch.randn_like(x) if t > 0 else 0. # no noise if t == 0
         pred_img = model_mean + (0.5 * model_log_variance).exp() * noise
         return pred_img, x_start
@@ -640,10 +893,14 @@ class GaussianDiffusion(nn.Module):
 
         img = torch.randn(shape, device=device) if noise is None else noise
 
+        # classes are fixed over the trajectory, the class path runs once instead of every step
+
+        cond = self.model.class_cond(classes, cond_drop_prob = 0.)
+
         x_start = None
         # for t in tqdm(reversed(range(0, self.num_timesteps)), desc = 'sampling loop time step', total = self.num_timesteps):
         for t in reversed(range(0, self.num_timesteps)):
-            img, x_start = self.p_sample(img, t, classes, cond_scale)
+            img, x_start = self.p_sample(img, t, classes, cond_scale, cond = cond)
 
         img = unnormalize_to_zero_to_one(img)
         return img
@@ -658,11 +915,13 @@ class GaussianDiffusion(nn.Module):
 
         img = torch.randn(shape, device = device) if noise is None else noise
 
+        cond = self.model.class_cond(classes, cond_drop_prob = 0.)
+
         x_start = None
 
         for time, time_next in tqdm(time_pairs, desc = 'sampling loop time step'):
             time_cond = torch.full((batch,), time, device=device, dtype=torch.long)
-            pred_noise, x_start, *_ = self.model_predictions(img, time_cond, classes, cond_scale = cond_scale, clip_x_start = clip_denoised)
+            pred_noise, x_start, *_ = self.model_predictions(img, time_cond, classes, cond_scale = cond_scale, clip_x_start = clip_denoised, cond = cond)
 
             if time_next < 0:
                 img = x_start
@@ -684,10 +943,41 @@ class GaussianDiffusion(nn.Module):
         return img
 
     @torch.no_grad()
-    def sample(self, classes, noise = None, cond_scale = 3.):
+    def solver_sample(self, classes, shape, noise = None, cond_scale = 3., sampler = 'dpmpp_2m', steps = 20, clip_denoised = True):
+        batch, device = shape[0], self.betas.device
+
+        img = torch.randn(shape, device = device) if noise is None else noise
+
+        cond = self.model.class_cond(classes, cond_drop_prob = 0.)
+
+        def denoise_fn(x, time):
+            time_cond = torch.full((batch,), time, device = device, dtype = torch.long)
+            _, x_start, *_ = self.model_predictions(x, time_cond, classes, cond_scale = cond_scale, clip_x_start = clip_denoised, cond = cond)
+            return x_start
+
+        img = SOLVERS[sampler](denoise_fn, img, self.alphas_cumprod, steps = steps)
+
+        img = unnormalize_to_zero_to_one(img.clamp(-1., 1.))
+        return img
+
+    @torch.no_grad()
+    def sample(self, classes, noise = None, cond_scale = 3., sampler = None, sampling_timesteps = None):
+        """
+        sampler is one of 'ddpm', 'ddim', 'dpmpp_2m' (DPM-Solver++ 2M) or 'unipc', defaulting to ddim when sampling_timesteps < timesteps and ddpm otherwise
+        the multistep solvers default to 20 steps unless the diffusion was set up with fewer sampling_timesteps
+        """
         batch_size, image_size, channels = classes.shape[0], self.image_size, self.channels
-        sample_fn = self.p_sample_loop if not self.is_ddim_sampling else self.ddim_sample
-        return sample_fn(classes, (batch_size, channels, image_size, image_size), noise, cond_scale)
+        shape = (batch_size, channels, image_size, image_size)
+
+        sampler = default(sampler, 'ddim' if self.is_ddim_sampling else 'ddpm')
+
+        if sampler in SOLVERS:
+            steps = default(sampling_timesteps, self.sampling_timesteps if self.is_ddim_sampling else 20)
+            return self.solver_sample(classes, shape, noise, cond_scale, sampler = sampler, steps = steps)
+
+        assert sampler in {'ddpm', 'ddim'}, f'unknown sampler {sampler}'
+        sample_fn = self.p_sample_loop if sampler == 'ddpm' else self.ddim_sample
+        return sample_fn(classes, shape, noise, cond_scale)
 
     @torch.no_grad()
     def interpolate(self, x1, x2, t = None, lam = 0.5):
@@ -708,9 +998,10 @@ class GaussianDiffusion(nn.Module):
     def q_sample(self, x_start, t, noise=None):
         noise = default(noise, lambda: torch.randn_like(x_start))
 
+        coefs = self.schedule(t, x_start.shape)
         return (
-            extract(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start +
-            extract(self.sqrt_one_minus_alphas_cumprod, t, x_start.shape) * noise
+            coefs.sqrt_alphas_cumprod * x_start +
+            coefs.sqrt_one_minus_alphas_cumprod * noise
         )
 
     @property
@@ -732,7 +1023,7 @@ class GaussianDiffusion(nn.Module):
 
         # predict and take gradient step
 
-        model_out = self.model(x, t, classes)
+        model_out = self.run_model(self.model, x, t, classes)
 
         if self.objective == 'pred_noise':
             target = noise
@@ -747,7 +1038,7 @@ class GaussianDiffusion(nn.Module):
         loss = self.loss_fn(model_out, target, reduction = 'none')
         loss = reduce(loss, 'b ... -> b (...)', 'mean')
 
-        loss = loss * extract(self.p2_loss_weight, t, loss.shape)
+        loss = loss * self.schedule(t, loss.shape).p2_loss_weight
         return loss.mean()
 
     def forward(self, img, *args, **kwargs):
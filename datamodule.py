@@ -1,5 +1,4 @@
 import os
-import glob
 import numpy as np
 
 from typing import Callable, Optional, Sequence
@@ -11,7 +10,7 @@ from monai.data import Dataset, DataLoader
 from monai.data import list_data_collate, decollate_batch
 from monai.utils import first, set_determinism, get_seed, MAX_SEED
 from monai.transforms import (
-    # apply_transform, ensure_channel_first=True, 
+    # ensure_channel_first=True, 
     # AddChanneld,
     Compose, 
     OneOf, 
@@ -31,9 +30,13 @@ from monai.transforms import (
     ScaleIntensityd,
     ScaleIntensityRanged, 
     ToTensord,
+    apply_transform,
 )
 from pytorch_lightning import LightningDataModule
 
+from shards import ShardDataset, preprocess_transforms
+from file_index import index_files
+
 class UnpairedDataset(Dataset, monai.transforms.Randomizable):
     def __init__(
         self,
@@ -77,6 +80,8 @@ class CustomDataModule(LightningDataModule):
         train_samples: int = 4000,
         val_samples: int = 800,
         test_samples: int = 800,
+        train_shards: Optional[str] = None,
+        val_shards: Optional[str] = None,
     ):
         super().__init__()
 
@@ -90,11 +95,14 @@ class CustomDataModule(LightningDataModule):
         self.val_samples = val_samples
         self.test_samples = test_samples
 
+        # directories written by shards.pack_shards with the same preprocessing, read instead of the png files when given
+        self.train_shards = train_shards
+        self.val_shards = val_shards
+
         # self.setup()
         def glob_files(folders: str=None, extension: str='*.nii.gz'):
             assert folders is not None
-            paths = [glob.glob(os.path.join(folder, extension), recursive = True) for folder in folders]
-            files = sorted([item for sublist in paths for item in sublist])
+            files = index_files(folders, extension)
             print(len(files))
             print(files[:1])
             return files
@@ -110,22 +118,19 @@ class CustomDataModule(LightningDataModule):
         set_determinism(seed=seed)
 
     def train_dataloader(self):
+        # packed with shards.py --no_histogram
         self.train_transforms = Compose(
             [
-                LoadImaged(keys=["image2d"], ensure_channel_first=True),
-                # AddChanneld(keys=["image2d"],),
-                ScaleIntensityd(keys=["image2d"], minv=0.0, maxv=1.0,),
+                *preprocess_transforms(keys=["image2d"], shape=256, histogram_normalize=False),
                 # CropForegroundd(keys=["image2d"], source_key="image", select_fn=(lambda x: x > 0), margin=0),
                 # RandZoomd(keys=["image2d"], prob=1.0, min_zoom=0.9, max_zoom=1.0, padding_mode='constant', mode=["area"]), 
-                Resized(keys=["image2d"], spatial_size=256, size_mode="longest", mode=["area"]),
-                DivisiblePadd(keys=["image2d"], k=256, mode="constant", constant_values=0),
                 ToTensord(keys=["image2d"],),
             ]
-        )
+        ) if self.train_shards is None else None
 
         self.train_datasets = UnpairedDataset(
             keys=["image2d"],
-            data=[self.train_image2d_files], 
+            data=[self.train_image2d_files if self.train_shards is None else ShardDataset(self.train_shards, "image2d")], 
             transform=self.train_transforms,
             length=self.train_samples,
             batch_size=self.batch_size,
@@ -143,20 +148,14 @@ class CustomDataModule(LightningDataModule):
     def val_dataloader(self):
         self.val_transforms = Compose(
             [
-                LoadImaged(keys=["image2d"], ensure_channel_first=True),
-                # AddChanneld(keys=["image2d"],),
-                ScaleIntensityd(keys=["image2d"], minv=0.0, maxv=1.0,), 
-                # CropForegroundd(keys=["image2d"], source_key="image", select_fn=(lambda x: x > 0), margin=0),
-                HistogramNormalized(keys=["image2d"], min=0.0, max=1.0,),
-                Resized(keys=["image2d"], spatial_size=256, size_mode="longest", mode=["area"]),
-                DivisiblePadd(keys=["image2d"], k=256, mode="constant", constant_values=0),
+                *preprocess_transforms(keys=["image2d"], shape=256, histogram_normalize=True),
                 ToTensord(keys=["image2d"],),
             ]
-        )
+        ) if self.val_shards is None else None
 
         self.val_datasets = UnpairedDataset(
             keys=["image2d"],
-            data=[self.val_image2d_files], 
+            data=[self.val_image2d_files if self.val_shards is None else ShardDataset(self.val_shards, "image2d")], 
             transform=self.val_transforms,
             length=self.val_samples,
             batch_size=self.batch_size,
@@ -25,10 +25,14 @@ class DDPMLightningModule(LightningModule):
         self.weight_decay = hparams.weight_decay
         self.num_timesteps = hparams.timesteps
         self.batch_size = hparams.batch_size
+        self.sampler = hparams.sampler
+        self.sampling_timesteps = hparams.sampling_timesteps
         self.model = Unet(
             dim=64,
             dim_mults=(1, 2, 4, 8),
             channels=1,
+            checkpoint_levels=hparams.checkpoint_levels,
+            fused_blocks=hparams.fused_blocks,
         )
 
         self.diffusion = GaussianDiffusion(
@@ -49,7 +53,7 @@ class DDPMLightningModule(LightningModule):
         t = torch.randint(0, self.num_timesteps, (self.batch_size,), device=self.device).long()
         loss = self.diffusion.forward(image2d, t, noise)
         if batch_idx==0:
-            samples = self.diffusion.sample(batch_size=self.batch_size)
+            samples = self.diffusion.sample(batch_size=self.batch_size, sampler=self.sampler, sampling_timesteps=self.sampling_timesteps)
             viz2d = torch.cat([image2d, samples], dim=-2)
             grid = torchvision.utils.make_grid(viz2d, normalize=False, scale_each=False, nrow=8, padding=0)
             tensorboard = self.logger.experiment
@@ -84,7 +88,11 @@ if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument("--seed", type=int, default=2222)
     parser.add_argument("--timesteps", type=int, default=1000, help="timesteps")
+    parser.add_argument("--sampler", type=str, default='dpmpp_2m', help="sampler: ddpm, ddim, dpmpp_2m or unipc")
+    parser.add_argument("--sampling_timesteps", type=int, default=20, help="sampling steps for ddim / dpmpp_2m / unipc")
     parser.add_argument("--batch_size", type=int, default=16, help="batch size")
+    parser.add_argument("--checkpoint_levels", type=int, nargs="*", default=[], help="unet levels to activation checkpoint, 0 is the highest resolution")
+    parser.add_argument("--fused_blocks", action="store_true", help="fused group norm, scale / shift and silu in the unet blocks when sampling")
     parser.add_argument("--shape", type=int, default=256, help="spatial size of the tensor")
     parser.add_argument("--train_samples", type=int, default=4000, help="training samples")
     parser.add_argument("--val_samples", type=int, default=800, help="validation samples")
@@ -92,6 +100,8 @@ if __name__ == "__main__":
     
     parser.add_argument("--logsdir", type=str, default='logs', help="logging directory")
     parser.add_argument("--datadir", type=str, default='data', help="data directory")
+    parser.add_argument("--train_shards", type=str, default=None, help="shards.py directory of the preprocessed training images (packed with --no_histogram)")
+    parser.add_argument("--val_shards", type=str, default=None, help="shards.py directory of the preprocessed validation images")
     
     parser.add_argument("--epochs", type=int, default=501, help="number of epochs")
     parser.add_argument("--lr", type=float, default=1e-4, help="adam: learning rate")
@@ -99,6 +109,8 @@ if __name__ == "__main__":
     parser.add_argument("--weight_decay", type=float, default=1e-4, help="Weight decay")
     
     parser = Trainer.add_argparse_args(parser)
+    # fp16 autocast on gpu by default, --precision bf16 for bfloat16 autocast on cpu (or ampere+ gpus)
+    parser.set_defaults(precision=16)
     
     # Collect the hyper parameters
     hparams = parser.parse_args()
@@ -139,6 +151,8 @@ if __name__ == "__main__":
         train_samples = hparams.train_samples,
         val_samples = hparams.val_samples,
         test_samples = hparams.test_samples,
+        train_shards = hparams.train_shards,
+        val_shards = hparams.val_shards,
         batch_size = hparams.batch_size, 
         shape = hparams.shape
     )
@@ -180,7 +194,7 @@ if __name__ == "__main__":
         ],
         # accumulate_grad_batches=4, 
         strategy="fsdp", #"fsdp", #"ddp_sharded", #"horovod", #"deepspeed", #"ddp_sharded",
-        precision=16,  #if hparams.use_amp else 32,
+        precision=hparams.precision,  #if hparams.use_amp else 32,
         # amp_backend='apex',
         # amp_level='O1', # see https://nvidia.github.io/apex/amp.html#opt-levels
         # stochastic_weight_avg=True,
@@ -0,0 +1,262 @@
+import os
+import copy
+import math
+
+from typing import Optional
+import torch
+import torch.nn.functional as F
+
+import torchvision
+
+from argparse import ArgumentParser
+
+from pytorch_lightning import LightningModule
+from pytorch_lightning import Trainer
+from pytorch_lightning.loggers import TensorBoardLogger
+from pytorch_lightning.callbacks import LearningRateMonitor
+from pytorch_lightning.utilities.seed import seed_everything
+
+from cdiff import Unet, GaussianDiffusion, normalize_to_neg_one_to_one
+from segmentation_spine import PairedAndUnsupervisedDataModule
+
+# progressive distillation, https://arxiv.org/abs/2202.00512
+# a student learns to match two deterministic ddim steps of its teacher with one step of its own,
+# then becomes the teacher of the next student, halving the number of sampling steps each round
+
+def with_sampling_steps(diffusion, steps):
+    """ teachers and students are sampled with deterministic ddim over `steps` steps """
+    diffusion.sampling_timesteps = steps
+    diffusion.is_ddim_sampling = steps < diffusion.num_timesteps
+    diffusion.ddim_sampling_eta = 0.
+    return diffusion
+
+def distillation_times(num_timesteps, student_steps):
+    """ teacher ddim grid [T-1, ..., 0, -1] with 2N steps, the student steps between every other point """
+    assert 2 * student_steps <= num_timesteps, f'a teacher of {2 * student_steps} steps needs at least as many timesteps, not {num_timesteps}'
+    times = torch.linspace(-1, num_timesteps - 1, steps = 2 * student_steps + 1).int().flip(0).long()
+    # a repeated timestep would make one of the two teacher steps a no op
+    assert (times[1:] < times[:-1]).all(), 'distillation timesteps must be strictly decreasing'
+    return times
+
+def alpha_sigma(diffusion, t, x_shape):
+    """ alpha_t and sigma_t, with t = -1 standing for the clean image (alpha = 1, sigma = 0) """
+    coefs = diffusion.schedule(t.clamp(min = 0), x_shape)
+    is_clean = (t < 0).reshape(-1, *((1,) * (len(x_shape) - 1)))
+    alpha = torch.where(is_clean, torch.ones_like(coefs.sqrt_alphas_cumprod), coefs.sqrt_alphas_cumprod)
+    sigma = torch.where(is_clean, torch.zeros_like(coefs.sqrt_one_minus_alphas_cumprod), coefs.sqrt_one_minus_alphas_cumprod)
+    return alpha, sigma
+
+def ddim_step(diffusion, x, x_start, t, t_next):
+    alpha, sigma = alpha_sigma(diffusion, t, x.shape)
+    alpha_next, sigma_next = alpha_sigma(diffusion, t_next, x.shape)
+    pred_noise = (x - alpha * x_start) / sigma
+    return alpha_next * x_start + sigma_next * pred_noise
+
+def load_diffusion(diffusion, path, prefix = 'diffusion.'):
+    """ loads a plain GaussianDiffusion state dict, or the `prefix` submodule of a lightning checkpoint """
+    state_dict = torch.load(path, map_location = 'cpu')
+    if 'state_dict' in state_dict:
+        state_dict = {key[len(prefix):]: value for key, value in state_dict['state_dict'].items() if key.startswith(prefix)}
+    diffusion.load_state_dict(state_dict)
+    return diffusion
+
+class DistillationLightningModule(LightningModule):
+    def __init__(self, hparams, teacher, student_steps, **kwargs) -> None:
+        super().__init__()
+        self.lr = hparams.lr
+        self.weight_decay = hparams.weight_decay
+        self.batch_size = hparams.batch_size
+        self.cond_scale = hparams.cond_scale
+        self.student_steps = student_steps
+
+        assert teacher.objective == 'pred_v', 'progressive distillation needs the pred_v parameterization'
+        assert 2 * student_steps <= teacher.num_timesteps, f'the teacher of a {student_steps} step student runs {2 * student_steps} steps, more than its {teacher.num_timesteps} timesteps'
+
+        self.student = with_sampling_steps(copy.deepcopy(teacher), student_steps).requires_grad_(True)
+        self.teacher = with_sampling_steps(teacher, 2 * student_steps).requires_grad_(False)
+
+        self.register_buffer('times', distillation_times(teacher.num_timesteps, student_steps), persistent = False)
+
+    def configure_optimizers(self):
+        optimizer = torch.optim.RAdam(self.student.parameters(), lr=self.lr, weight_decay=self.weight_decay)
+        return optimizer
+
+    def teacher_x_start(self, x, t, classes):
+        return self.teacher.model_predictions(x, t, classes, cond_scale = self.cond_scale, clip_x_start = True).pred_x_start
+
+    def _samples_and_classes(self, batch):
+        # image is class 0, label is class 1
+        image, label = batch["image"], batch["label"]
+        x_start = normalize_to_neg_one_to_one(torch.cat([image, label], dim=0))
+        classes = torch.cat([torch.zeros(image.shape[0]), torch.ones(label.shape[0])]).long().to(self.device)
+        return x_start, classes
+
+    def _common_step(self, batch, batch_idx, stage: Optional[str]='common'):
+        x_start, classes = self._samples_and_classes(batch)
+        b = x_start.shape[0]
+
+        ind = torch.randint(0, self.student_steps, (b,), device=self.device)
+        t, t_mid, t_next = self.times[2 * ind], self.times[2 * ind + 1], self.times[2 * ind + 2]
+
+        noise = torch.randn_like(x_start)
+        x_t = self.student.q_sample(x_start, t, noise)
+
+        with torch.no_grad():
+            # two teacher steps t -> t_mid -> t_next
+
+            x_mid = ddim_step(self.teacher, x_t, self.teacher_x_start(x_t, t, classes), t, t_mid)
+            x_next = ddim_step(self.teacher, x_mid, self.teacher_x_start(x_mid, t_mid, classes), t_mid, t_next)
+
+            # the x_start for which a single ddim step t -> t_next lands on x_next, as a v target
+
+            alpha, sigma = alpha_sigma(self.teacher, t, x_t.shape)
+            alpha_next, sigma_next = alpha_sigma(self.teacher, t_next, x_t.shape)
+            ratio = sigma_next / sigma
+
+            target_x_start = (x_next - ratio * x_t) / (alpha_next - ratio * alpha)
+            target_noise = (x_t - alpha * target_x_start) / sigma
+            target = self.student.predict_v(target_x_start, t, target_noise)
+
+        model_out = self.student.model(x_t, t, classes, cond_drop_prob = 0.)
+        loss = F.mse_loss(model_out, target)
+
+        self.log(f'{stage}_loss', loss, on_step=(stage == 'train'), prog_bar=True, logger=True, sync_dist=True, batch_size=b)
+
+        if stage != 'train' and batch_idx == 0:
+            sample_mse = self.sample_mse(x_start, classes)
+            self.log(f'{stage}_sample_mse', sample_mse, on_step=False, prog_bar=True, logger=True, sync_dist=True, batch_size=b)
+
+        info = {"loss": loss}
+        return info
+
+    @torch.no_grad()
+    def sample_mse(self, x_start, classes):
+        """ mse between the student samples (N steps) and the teacher samples (2N steps) from the same noise """
+        noise = torch.randn_like(x_start)
+        teacher_samples = self.teacher.sample(classes, noise.clone(), cond_scale = self.cond_scale, sampler = 'ddim')
+        student_samples = self.student.sample(classes, noise.clone(), cond_scale = 1., sampler = 'ddim')
+
+        viz2d = torch.cat([teacher_samples, student_samples], dim=-2)
+        grid = torchvision.utils.make_grid(viz2d, normalize=False, scale_each=False, nrow=8, padding=0)
+        tensorboard = self.logger.experiment
+        tensorboard.add_image(f'student_{self.student_steps}_samples', grid.clamp(0., 1.), self.global_step)
+
+        return F.mse_loss(student_samples, teacher_samples)
+
+    def training_step(self, batch, batch_idx):
+        return self._common_step(batch, batch_idx, stage='train')
+
+    def validation_step(self, batch, batch_idx):
+        return self._common_step(batch, batch_idx, stage='validation')
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--timesteps", type=int, default=1000, help="timesteps the teacher was trained with")
+    parser.add_argument("--num_classes", type=int, default=2, help="number of classes of the teacher")
+    parser.add_argument("--teacher_ckpt", type=str, required=True, help="path to the pred_v teacher checkpoint")
+    parser.add_argument("--teacher_prefix", type=str, default='diffusion.', help="prefix of the teacher inside a lightning checkpoint")
+    parser.add_argument("--start_steps", type=int, default=None, help="sampling steps of the first student, the largest power of two up to timesteps / 2 by default")
+    parser.add_argument("--final_steps", type=int, default=4, help="sampling steps of the last student")
+    parser.add_argument("--steps_per_stage", type=int, default=10000, help="optimization steps per halving")
+    parser.add_argument("--cond_scale", type=float, default=1., help="classifier free guidance scale of the teacher")
+    parser.add_argument("--batch_size", type=int, default=8, help="batch size")
+    parser.add_argument("--shape", type=int, default=256, help="spatial size of the tensor")
+    parser.add_argument("--train_samples", type=int, default=4000, help="training samples")
+    parser.add_argument("--val_samples", type=int, default=800, help="validation samples")
+    parser.add_argument("--test_samples", type=int, default=400, help="test samples")
+
+    parser.add_argument("--logsdir", type=str, default='logs', help="logging directory")
+    parser.add_argument("--datadir", type=str, default='data', help="data directory")
+
+    parser.add_argument("--lr", type=float, default=1e-4, help="adam: learning rate")
+    parser.add_argument("--weight_decay", type=float, default=0., help="Weight decay")
+
+    parser = Trainer.add_argparse_args(parser)
+
+    # Collect the hyper parameters
+    hparams = parser.parse_args()
+    # Create data module
+
+    image_dirs = [
+        os.path.join(hparams.datadir, 'ChestXRLungSegmentation/JSRT/processed/images/'),
+        os.path.join(hparams.datadir, 'ChestXRLungSegmentation/ChinaSet/processed/images/'),
+        os.path.join(hparams.datadir, 'ChestXRLungSegmentation/Montgomery/processed/images/'),
+    ]
+    label_dirs = [
+        os.path.join(hparams.datadir, 'ChestXRLungSegmentation/JSRT/processed/labels/'),
+        os.path.join(hparams.datadir, 'ChestXRLungSegmentation/ChinaSet/processed/labels/'),
+        os.path.join(hparams.datadir, 'ChestXRLungSegmentation/Montgomery/processed/labels/'),
+    ]
+    unsup_dirs = [
+        os.path.join(hparams.datadir, 'ChestXRLungSegmentation/VinDr/v1/processed/test/images/'),
+    ]
+
+    datamodule = PairedAndUnsupervisedDataModule(
+        train_image_dirs = image_dirs,
+        train_label_dirs = label_dirs,
+        train_unsup_dirs = unsup_dirs,
+        val_image_dirs = image_dirs,
+        val_label_dirs = label_dirs,
+        val_unsup_dirs = unsup_dirs,
+        test_image_dirs = image_dirs,
+        test_label_dirs = label_dirs,
+        test_unsup_dirs = unsup_dirs,
+        train_samples = hparams.train_samples,
+        val_samples = hparams.val_samples,
+        test_samples = hparams.test_samples,
+        batch_size = hparams.batch_size,
+        shape = hparams.shape
+    )
+    datamodule.setup(seed=hparams.seed)
+
+    teacher = GaussianDiffusion(
+        Unet(
+            dim=64,
+            dim_mults=(1, 2, 4, 8),
+            channels=1,
+            num_classes=hparams.num_classes,
+        ),
+        image_size=hparams.shape,
+        timesteps=hparams.timesteps,
+        objective='pred_v',
+    )
+    teacher = load_diffusion(teacher, hparams.teacher_ckpt, prefix=hparams.teacher_prefix)
+
+    # Seed the application
+    seed_everything(hparams.seed)
+
+    # the first teacher runs 2 * start_steps ddim steps, at most one per timestep
+
+    student_steps = hparams.start_steps or 2 ** int(math.log2(hparams.timesteps // 2))
+    while student_steps >= hparams.final_steps:
+        model = DistillationLightningModule(
+            hparams = hparams,
+            teacher = teacher,
+            student_steps = student_steps,
+        )
+
+        lr_callback = LearningRateMonitor(logging_interval='step')
+        tensorboard_logger = TensorBoardLogger(save_dir=hparams.logsdir, name=f'student_{student_steps:04d}')
+
+        trainer = Trainer.from_argparse_args(
+            hparams,
+            max_steps=hparams.steps_per_stage,
+            logger=[tensorboard_logger],
+            callbacks=[
+                lr_callback,
+            ],
+        )
+
+        trainer.fit(
+            model,
+            datamodule,
+        )
+
+        # each student is saved as a plain GaussianDiffusion state dict, loadable with load_diffusion
+
+        torch.save(model.student.state_dict(), os.path.join(hparams.logsdir, f'student_{student_steps:04d}.pt'))
+
+        teacher = model.student
+        student_steps //= 2
@@ -0,0 +1,164 @@
+import os
+import json
+
+import torch
+from torch import nn
+
+from argparse import ArgumentParser
+
+import model
+import cdiff
+
+# onnx export of the diffusion unets, sampled without torch by onnx_sampler.OnnxDiffusionSampler
+# the unet goes to <name>.onnx, the noise schedule and sampling settings to the <name>.json next to it
+
+SCHEDULE_BUFFERS = (
+    'alphas_cumprod',
+    'sqrt_recip_alphas_cumprod',
+    'sqrt_recipm1_alphas_cumprod',
+    'posterior_mean_coef1',
+    'posterior_mean_coef2',
+    'posterior_log_variance_clipped',
+)
+
+class ExportableUnet(nn.Module):
+    """ model.Unet with the self conditioning input always present (zeros when unused) """
+    def __init__(self, unet):
+        super().__init__()
+        self.unet = unet
+
+    def forward(self, x, time, x_self_cond):
+        return self.unet(x, time, x_self_cond if self.unet.self_condition else None)
+
+class ExportableGuidedUnet(nn.Module):
+    """ cdiff.Unet with classifier free guidance, the conditional and null branches in one batched pass and cond_scale as an input """
+    def __init__(self, unet):
+        super().__init__()
+        self.unet = unet
+
+    def forward(self, x, time, classes, cond_scale):
+        batch = x.shape[0]
+        cond = self.unet.class_cond(classes, cond_drop_prob = 0.)
+        null_cond = self.unet.null_class_cond().expand(batch, -1)
+
+        out = self.unet(
+            torch.cat((x, x), dim = 0),
+            torch.cat((time, time), dim = 0),
+            torch.cat((classes, classes), dim = 0),
+            cond = torch.cat((cond, null_cond), dim = 0)
+        )
+
+        logits, null_logits = out.chunk(2, dim = 0)
+        return null_logits + (logits - null_logits) * cond_scale
+
+def export_diffusion(diffusion, path, batch_size = 1, opset_version = 17):
+    """
+    exports the unet of a model.GaussianDiffusion or a cdiff.GaussianDiffusion to onnx at `path`, with a dynamic batch,
+    and its schedule to the json sidecar, returns the path of the sidecar
+    """
+    unet = diffusion.model
+    is_conditional = isinstance(unet, cdiff.Unet)
+    size, channels = diffusion.image_size, diffusion.channels
+
+    x = torch.randn(batch_size, channels, size, size)
+    time = torch.zeros(batch_size, dtype = torch.long)
+
+    if is_conditional:
+        module = ExportableGuidedUnet(unet)
+        args = (x, time, torch.zeros(batch_size, dtype = torch.long), torch.tensor(1.))
+        input_names = ['x', 'time', 'classes', 'cond_scale']
+    else:
+        module = ExportableUnet(unet)
+        args = (x, time, torch.zeros_like(x))
+        input_names = ['x', 'time', 'x_self_cond']
+
+    dynamic_axes = {name: {0: 'batch'} for name in (*input_names, 'out') if name != 'cond_scale'}
+
+    # exported in eval mode with the unet caches off, the onnx graph recomputes what the caches would serve
+
+    was_training, num_cached_timesteps = unet.training, unet.num_cached_timesteps
+    unet.eval()
+    unet.num_cached_timesteps = None
+
+    try:
+        with torch.no_grad():
+            torch.onnx.export(
+                module,
+                args,
+                path,
+                input_names = input_names,
+                output_names = ['out'],
+                dynamic_axes = dynamic_axes,
+                opset_version = opset_version,
+                dynamo = False
+            )
+    finally:
+        unet.train(was_training)
+        unet.num_cached_timesteps = num_cached_timesteps
+
+    config = dict(
+        image_size = size,
+        channels = channels,
+        objective = diffusion.objective,
+        num_timesteps = diffusion.num_timesteps,
+        sampling_timesteps = diffusion.sampling_timesteps,
+        ddim_sampling_eta = diffusion.ddim_sampling_eta,
+        self_condition = bool(getattr(unet, 'self_condition', False)),
+        num_classes = unet.classes_emb.num_embeddings if is_conditional else None,
+        **{name: getattr(diffusion, name).tolist() for name in SCHEDULE_BUFFERS}
+    )
+
+    config_path = os.path.splitext(path)[0] + '.json'
+
+    with open(config_path, 'w') as f:
+        json.dump(config, f)
+
+    return config_path
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--ckpt", type=str, required=True, help="path to a lightning checkpoint or a GaussianDiffusion state dict")
+    parser.add_argument("--prefix", type=str, default='diffusion.', help="prefix of the diffusion inside a lightning checkpoint")
+    parser.add_argument("--output", type=str, default='diffusion.onnx', help="path of the exported onnx model")
+    parser.add_argument("--timesteps", type=int, default=1000, help="timesteps the model was trained with")
+    parser.add_argument("--sampling_timesteps", type=int, default=None, help="ddim sampling steps stored as the default of the sampler")
+    parser.add_argument("--shape", type=int, default=256, help="spatial size of the tensor")
+    parser.add_argument("--num_classes", type=int, default=None, help="number of classes, exports a cdiff unet with classifier free guidance")
+    parser.add_argument("--objective", type=str, default='pred_noise', help="pred_noise, pred_x0 or pred_v")
+    parser.add_argument("--opset", type=int, default=17, help="onnx opset version")
+    hparams = parser.parse_args()
+
+    if hparams.num_classes is not None:
+        diffusion = cdiff.GaussianDiffusion(
+            cdiff.Unet(
+                dim=64,
+                dim_mults=(1, 2, 4, 8),
+                channels=1,
+                num_classes=hparams.num_classes,
+            ),
+            image_size=hparams.shape,
+            timesteps=hparams.timesteps,
+            sampling_timesteps=hparams.sampling_timesteps,
+            objective=hparams.objective,
+        )
+    else:
+        diffusion = model.GaussianDiffusion(
+            model.Unet(
+                dim=64,
+                dim_mults=(1, 2, 4, 8),
+                channels=1,
+            ),
+            image_size=hparams.shape,
+            timesteps=hparams.timesteps,
+            sampling_timesteps=hparams.sampling_timesteps,
+            objective=hparams.objective,
+        )
+
+    state_dict = torch.load(hparams.ckpt, map_location = 'cpu')
+    if 'state_dict' in state_dict:
+        state_dict = {key[len(hparams.prefix):]: value for key, value in state_dict['state_dict'].items() if key.startswith(hparams.prefix)}
+    diffusion.load_state_dict(state_dict)
+
+    config_path = export_diffusion(diffusion, hparams.output, opset_version = hparams.opset)
+    print(f'exported {hparams.output} and {config_path}')
@@ -0,0 +1,197 @@
+import os
+import glob
+import json
+import time
+import fnmatch
+import hashlib
+
+import numpy as np
+import torch.distributed as dist
+
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from argparse import ArgumentParser
+
+try:
+    import fcntl
+except ImportError:  # no advisory locks, concurrent processes may scan the same root twice
+    fcntl = None
+
+# persistent, incremental file index of the data folders, what the data modules list their pngs with instead of a recursive glob
+# every root gets a manifest of its directories (mtime, subdirectories, files), a rescan stats each directory and only lists
+# those whose mtime changed, a file added, removed or renamed changes the mtime of its directory
+# the manifests live under DIFFUSORS_INDEX_DIR (~/.cache/diffusors/file_index by default), one json per root
+# pair_files matches the image and label lists of the paired datasets into an explicit [n, 2] index
+
+INDEX_VERSION = 1
+INDEX_DIR = os.environ.get('DIFFUSORS_INDEX_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'diffusors', 'file_index'))
+
+# a directory modified this recently could change again within the timestamp granularity of the filesystem (seconds on some
+# network mounts) without its mtime moving, it is listed again on the next scan
+
+MTIME_SLACK_NS = 2 * 10 ** 9
+
+def manifest_path(root: str, index_dir: str) -> str:
+    return os.path.join(index_dir, hashlib.sha1(os.path.abspath(root).encode()).hexdigest() + '.json')
+
+def load_manifest(path: str, root: str) -> Dict:
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    if manifest.get('version') != INDEX_VERSION or manifest.get('root') != os.path.abspath(root):
+        return {}
+    return manifest['dirs']
+
+def list_directory(path: str) -> Tuple[List[str], List[str]]:
+    """ (subdirectories, files) of path, hidden entries skipped as glob does """
+    subdirs, files = [], []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.name.startswith('.'):
+                continue
+            (subdirs if entry.is_dir() else files).append(entry.name)
+    return sorted(subdirs), sorted(files)
+
+def scan(root: str, previous: Dict) -> Tuple[Dict, int]:
+    """ the directories of root, relative path -> [mtime, subdirectories, files], and how many of them had to be listed """
+    dirs, listed = {}, 0
+    now = time.time_ns()
+    stack = ['']
+
+    while stack:
+        rel = stack.pop()
+        path = os.path.join(root, rel)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            continue
+
+        entry = previous.get(rel)
+        if entry is not None and entry[0] == mtime:
+            subdirs, files = entry[1], entry[2]
+        else:
+            subdirs, files = list_directory(path)
+            listed += 1
+
+        dirs[rel] = [mtime if now - mtime > MTIME_SLACK_NS else None, subdirs, files]
+        stack.extend(os.path.join(rel, subdir) for subdir in subdirs)
+
+    return dirs, listed
+
+def index_root(root: str, index_dir: str = INDEX_DIR) -> Dict:
+    """ the up to date manifest of root, rescanned incrementally and rewritten when anything changed """
+    os.makedirs(index_dir, exist_ok=True)
+    path = manifest_path(root, index_dir)
+
+    with open(path + '.lock', 'w') as lock:
+        # the processes of a host (dataloader setup on every ddp rank) take turns, the first lists what changed,
+        # the others only stat the directories
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+        previous = load_manifest(path, root)
+        dirs, listed = scan(root, previous)
+
+        if listed > 0 or dirs.keys() != previous.keys():
+            with open(path + '.tmp', 'w') as f:
+                json.dump(dict(version=INDEX_VERSION, root=os.path.abspath(root), dirs=dirs), f)
+            os.replace(path + '.tmp', path)
+
+    return dirs
+
+def match(folder: str, dirs: Dict, pattern: str) -> List[str]:
+    """ the files of a manifest matching a glob pattern, as glob.glob(os.path.join(folder, pattern), recursive=True) names them """
+    recursive = pattern.startswith('**/')
+    name = pattern[3:] if recursive else pattern
+
+    files = []
+    for rel, (_, _, names) in dirs.items():
+        if rel and not recursive:
+            continue
+        files += [os.path.join(folder, rel, file) for file in fnmatch.filter(names, name)]
+    return files
+
+def local_index_files(folders: Sequence[str], pattern: str = '**/*.png', index_dir: str = INDEX_DIR) -> List[str]:
+    files = []
+    for folder in folders:
+        if '/' in pattern.replace('**/', '', 1) or not os.path.isdir(folder):
+            # patterns over directory names and missing folders are left to glob
+            files += glob.glob(os.path.join(folder, pattern), recursive=True)
+            continue
+        files += match(folder, index_root(folder, index_dir), pattern)
+    return sorted(files)
+
+def index_files(folders: Sequence[str], pattern: str = '**/*.png', index_dir: Optional[str] = None) -> List[str]:
+    """
+    sorted paths of the files under folders matching pattern ('**/*.png' or '*.png' style), the list
+    sorted(glob.glob(os.path.join(folder, pattern), recursive=True) for every folder) would give
+    under an initialized process group, rank 0 indexes and broadcasts the list to the other ranks
+    """
+    index_dir = index_dir or INDEX_DIR
+
+    if dist.is_available() and dist.is_initialized():
+        files = [local_index_files(folders, pattern, index_dir) if dist.get_rank() == 0 else None]
+        dist.broadcast_object_list(files, src=0)
+        return files[0]
+
+    return local_index_files(folders, pattern, index_dir)
+
+def strip_extension(name: str) -> str:
+    return name[:-len('.nii.gz')] if name.endswith('.nii.gz') else os.path.splitext(name)[0]
+
+def pair_keys(files: Sequence[str], folders: Sequence[str]) -> Dict[Tuple[int, str], int]:
+    """ (position of the folder, relative path without extension) -> index of the file, what images and labels are matched on """
+    roots = sorted(((os.path.join(folder, ''), position) for position, folder in enumerate(folders)), key=lambda root: -len(root[0]))
+
+    keys = {}
+    for index, file in enumerate(files):
+        root, position = next(((root, position) for root, position in roots if file.startswith(root)), (None, None))
+        if root is None:
+            raise ValueError(f'{file} is under none of {list(folders)}')
+
+        key = (position, strip_extension(file[len(root):]))
+        if key in keys:
+            raise ValueError(f'{files[keys[key]]} and {file} pair with the same file')
+        keys[key] = index
+    return keys
+
+def pair_files(
+    image_files: Sequence[str],
+    label_files: Sequence[str],
+    image_folders: Sequence[str],
+    label_folders: Sequence[str],
+    allow_orphans: bool = False,
+) -> np.ndarray:
+    """
+    [n, 2] int32 (image index, label index) pairs of the two file lists, an image and a label pair when they sit at the
+    same relative path (extension aside) under the folders at the same position of image_folders and label_folders
+    images without a label and labels without an image raise, unless allow_orphans, when they are left out
+    """
+    assert len(image_folders) == len(label_folders), 'image and label folders pair by position, one label folder per image folder'
+
+    images = pair_keys(image_files, image_folders)
+    labels = pair_keys(label_files, label_folders)
+
+    pairs = [(index, labels[key]) for key, index in images.items() if key in labels]
+
+    if len(pairs) < max(len(images), len(labels)) and not allow_orphans:
+        orphans = [image_files[index] for key, index in images.items() if key not in labels]
+        orphans += [label_files[index] for key, index in labels.items() if key not in images]
+        raise ValueError(f'{len(orphans)} files without a counterpart, e.g. {orphans[:3]}')
+
+    return np.asarray(sorted(pairs), dtype=np.int32).reshape(-1, 2)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--folders", type=str, nargs="+", required=True, help="folders to index, e.g. ahead of a training run")
+    parser.add_argument("--pattern", type=str, default='**/*.png', help="glob pattern of the files to count")
+    parser.add_argument("--index_dir", type=str, default=INDEX_DIR, help="directory of the manifests")
+    hparams = parser.parse_args()
+
+    for folder in hparams.folders:
+        start = time.perf_counter()
+        files = local_index_files([folder], hparams.pattern, hparams.index_dir)
+        print(f'{folder}: {len(files)} files in {time.perf_counter() - start:.2f}s')
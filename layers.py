@@ -0,0 +1,400 @@
+import time
+
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+from einops import rearrange
+
+# layers shared by the unets of model.py and cdiff.py
+
+def identity(t, *args, **kwargs):
+    return t
+
+def is_channels_last(x):
+    """ stored as [b, h, w, c], excluding maps that are trivially both layouts (a single channel, 1 x 1) """
+    return not x.is_contiguous() and x.is_contiguous(memory_format = torch.channels_last)
+
+def concat_skip(x, skip, buffer = None):
+    """
+    torch.cat((x, skip), dim = 1), or the preallocated [x, skip] buffer the skip was already written into, with x copied in front
+    x is not copied when it was written there directly
+    """
+    if buffer is None:
+        return torch.cat((x, skip), dim = 1)
+
+    head = buffer[:, :x.shape[1]]
+
+    if head.data_ptr() != x.data_ptr():
+        head.copy_(x)
+
+    return buffer
+
+def norm_eps(dtype):
+    """
+    eps of the layer norms and of the weight standardization, whose statistics are taken in float32 for float16 / bfloat16 inputs
+    float16 keeps the larger eps its (gpu precision = 16) checkpoints were trained with, bfloat16 has the float32 one
+    """
+    return 1e-3 if dtype == torch.float16 else 1e-5
+
+def upcast(x):
+    """ float16 / bfloat16 x in float32, where reductions over it are accumulated """
+    return x.float() if x.dtype in (torch.float16, torch.bfloat16) else x
+
+def is_compiling():
+    """ inside a torch.compile trace, where the python side caches are bypassed so they neither break nor get baked into the graph """
+    compiler = getattr(torch, 'compiler', None)
+    return compiler is not None and hasattr(compiler, 'is_compiling') and compiler.is_compiling()
+
+def weights_version(*modules_or_params):
+    """ changes whenever a parameter is updated in place (optimizer step, load_state_dict) or moved (.to, .half) """
+    params = []
+    for item in modules_or_params:
+        params.extend(item.parameters() if isinstance(item, nn.Module) else (item,))
+    return tuple((p.data_ptr(), p.dtype, p._version) for p in params)
+
+def layer_norm(x, g):
+    """ layer norm over the channels of [b, c, h, w] x, with float32 statistics, in the dtype of x """
+    eps = norm_eps(x.dtype)
+    xf = upcast(x)
+    var, mean = torch.var_mean(xf, dim = 1, unbiased = False, keepdim = True)
+    return ((xf - mean) * (var + eps).rsqrt() * g).to(x.dtype)
+
+class LayerNorm(nn.Module):
+    def __init__(self, dim):
+        super().__init__()
+        self.g = nn.Parameter(torch.ones(1, dim, 1, 1))
+
+    def forward(self, x):
+        return layer_norm(x, self.g)
+
+class WeightStandardizedConv2d(nn.Conv2d):
+    """
+    https://arxiv.org/abs/1903.10520
+    weight standardization purportedly works synergistically with group normalization
+    once frozen (see Unet.freeze_for_inference), the standardized weight is computed once and reused outside of autograd,
+    until the module is put back in training mode or its parameters change
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.frozen = False
+        self._standardized_weight = None
+        self._standardized_weight_key = None
+
+    def freeze(self):
+        self.frozen = True
+        return self
+
+    def train(self, mode = True):
+        if mode:
+            self.frozen = False
+            self._standardized_weight = None
+            self._standardized_weight_key = None
+        return super().train(mode)
+
+    def standardized_weight(self, dtype):
+        # eps by the dtype of the activations (see layers.norm_eps), the statistics in float32 for a half / bfloat16 weight
+
+        eps = norm_eps(dtype)
+
+        weight = upcast(self.weight)
+        var, mean = torch.var_mean(weight, dim = (1, 2, 3), unbiased = False, keepdim = True)
+        return ((weight - mean) * (var + eps).rsqrt()).to(self.weight.dtype)
+
+    def forward(self, x):
+        if self.frozen and not torch.is_grad_enabled() and not is_compiling():
+            key = (weights_version(self.weight), x.dtype)
+
+            if self._standardized_weight_key != key:
+                self._standardized_weight = self.standardized_weight(x.dtype)
+                self._standardized_weight_key = key
+
+            normalized_weight = self._standardized_weight
+        else:
+            normalized_weight = self.standardized_weight(x.dtype)
+
+        return F.conv2d(x, normalized_weight, self.bias, self.stride, self.padding, self.dilation, self.groups)
+
+class LinearAttention(nn.Module):
+    """
+    linear attention, https://arxiv.org/abs/1812.01243, over the h * w positions of a feature map
+    q, k, v are reshaped views of the to_qkv output, and the q scale and the 1 / (h * w) normalization of v
+    are folded into the small [dim_head, dim_head] context instead of being applied to the [dim_head, h * w] maps
+    """
+    def __init__(self, dim, heads = 4, dim_head = 32):
+        super().__init__()
+        self.scale = dim_head ** -0.5
+        self.heads = heads
+        self.dim_head = dim_head
+        hidden_dim = dim_head * heads
+        self.to_qkv = nn.Conv2d(dim, hidden_dim * 3, 1, bias = False)
+
+        self.to_out = nn.Sequential(
+            nn.Conv2d(hidden_dim, dim, 1),
+            LayerNorm(dim)
+        )
+
+    def forward(self, x):
+        b, c, h, w = x.shape
+        qkv = self.to_qkv(x)
+
+        if is_channels_last(qkv):
+            return self.forward_channels_last(qkv)
+
+        q, k, v = qkv.reshape(b, 3, self.heads, self.dim_head, h * w).unbind(dim = 1)
+
+        q = q.softmax(dim = -2)
+        k = k.softmax(dim = -1)
+
+        context = torch.matmul(k, v.transpose(-1, -2)).mul_(self.scale / (h * w))
+
+        out = torch.matmul(context.transpose(-1, -2), q)
+        out = out.reshape(b, -1, h, w)
+        return self.to_out(out)
+
+    def forward_channels_last(self, qkv):
+        """ same computation on [b, h, w, c] memory, with q, k, v as [b, heads, h * w, dim_head] views so dim_head stays innermost """
+        b, _, h, w = qkv.shape
+        q, k, v = qkv.permute(0, 2, 3, 1).reshape(b, h * w, 3, self.heads, self.dim_head).permute(2, 0, 3, 1, 4).unbind(dim = 0)
+
+        q = q.softmax(dim = -1)
+        k = k.softmax(dim = -2)
+
+        context = torch.matmul(k.transpose(-1, -2), v).mul_(self.scale / (h * w))
+
+        out = torch.matmul(q, context)
+        out = out.transpose(1, 2).reshape(b, h, w, -1).permute(0, 3, 1, 2)
+        return self.to_out(out)
+
+def group_norm_scale_shift_silu(x, norm, scale_shift = None):
+    """
+    silu(group_norm(x) * (scale + 1) + shift), the tail of the unet Block, in two full tensor passes after the normalization
+    the per sample scale / shift is folded into the affine parameters of the group norm, [b, c, 1, 1], and the silu is in place
+    """
+    if scale_shift is None:
+        x = F.group_norm(x, norm.num_groups, norm.weight, norm.bias, norm.eps)
+        return F.silu(x, inplace = True)
+
+    scale, shift = scale_shift
+    scale = scale + 1
+
+    weight = rearrange(norm.weight, 'c -> c 1 1') * scale
+    bias = torch.addcmul(shift, rearrange(norm.bias, 'c -> c 1 1'), scale)
+
+    x = F.group_norm(x, norm.num_groups, eps = norm.eps)
+    x = torch.addcmul(bias, x, weight)
+    return F.silu(x, inplace = True)
+
+# reference implementations and benchmarks of the fused layers
+
+def channels_last_violations(model, *args, **kwargs):
+    """
+    runs model(*args, **kwargs) and returns the names of the submodules whose 4d output is not channels last
+    empty when the input and weights are channels last and no layer silently flips the layout back to [b, c, h, w]
+    channel slices of a channels last tensor (the preallocated skip buffers) count as channels last
+    """
+    violations = []
+
+    def is_channels_last_strided(x):
+        b, c, h, w = x.stride()
+        return x.is_contiguous(memory_format = torch.channels_last) or (c == 1 and b >= h >= w >= x.shape[1])
+
+    def hook(name):
+        def check(module, inputs, output):
+            if torch.is_tensor(output) and output.ndim == 4 and not is_channels_last_strided(output):
+                violations.append(name)
+        return check
+
+    handles = [module.register_forward_hook(hook(name)) for name, module in model.named_modules()]
+
+    try:
+        model(*args, **kwargs)
+    finally:
+        for handle in handles:
+            handle.remove()
+
+    return violations
+
+def reference_linear_attention(attn, x):
+    """ the einsum / rearrange formulation LinearAttention replaced, run with the weights of `attn` """
+    b, c, h, w = x.shape
+    qkv = attn.to_qkv(x).chunk(3, dim = 1)
+    q, k, v = map(lambda t: rearrange(t, 'b (h c) x y -> b h c (x y)', h = attn.heads), qkv)
+
+    q = q.softmax(dim = -2)
+    k = k.softmax(dim = -1)
+
+    q = q * attn.scale
+    v = v / (h * w)
+
+    context = torch.einsum('b h d n, b h e n -> b h d e', k, v)
+
+    out = torch.einsum('b h d e, b h d n -> b h e n', context, q)
+    out = rearrange(out, 'b h c (x y) -> b (h c) x y', h = attn.heads, x = h, y = w)
+
+    conv, norm = attn.to_out
+    out = conv(out)
+    eps = 1e-5 if out.dtype == torch.float32 else 1e-3
+    var = torch.var(out, dim = 1, unbiased = False, keepdim = True)
+    mean = torch.mean(out, dim = 1, keepdim = True)
+    return (out - mean) * (var + eps).rsqrt() * norm.g
+
+def benchmark_linear_attention(shapes = ((8, 64, 128, 128), (8, 128, 64, 64), (8, 256, 32, 32)), repeats = 10, device = None):
+    """ max abs difference of outputs and input gradients against the reference, and forward + backward time of each """
+    device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+    sync = torch.cuda.synchronize if device == 'cuda' else (lambda: None)
+
+    def timed(fn, x):
+        fn(x).sum().backward()
+        sync()
+        start = time.perf_counter()
+        for _ in range(repeats):
+            fn(x).sum().backward()
+        sync()
+        return (time.perf_counter() - start) / repeats
+
+    results = []
+    for shape in shapes:
+        attn = LinearAttention(shape[1]).to(device)
+        x = torch.randn(shape, device = device, requires_grad = True)
+
+        # a random output gradient, the sum of a layernormed output has a vanishing gradient
+
+        out = attn(x)
+        grad_out = torch.randn_like(out)
+        grad, = torch.autograd.grad(out, x, grad_out)
+        ref_out = reference_linear_attention(attn, x)
+        ref_grad, = torch.autograd.grad(ref_out, x, grad_out)
+
+        results.append(dict(
+            shape = shape,
+            max_abs_diff = (out - ref_out).abs().max().item(),
+            max_abs_grad_diff = (grad - ref_grad).abs().max().item(),
+            fused_ms = timed(attn, x) * 1e3,
+            reference_ms = timed(lambda t: reference_linear_attention(attn, t), x) * 1e3
+        ))
+
+    return results
+
+def reference_group_norm_scale_shift_silu(x, norm, scale_shift = None):
+    """ the unfused group norm, scale / shift and silu of the unet Block """
+    x = norm(x)
+
+    if scale_shift is not None:
+        scale, shift = scale_shift
+        x = x * (scale + 1) + shift
+
+    return F.silu(x)
+
+def benchmark_group_norm_scale_shift_silu(shapes = ((8, 64, 128, 128), (8, 128, 64, 64), (8, 256, 32, 32)), groups = 8, repeats = 10, device = None):
+    """ max abs difference of outputs and input / scale / shift gradients against the reference, and forward + backward time of each """
+    device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+    sync = torch.cuda.synchronize if device == 'cuda' else (lambda: None)
+
+    def timed(fn, *args):
+        fn(*args).sum().backward()
+        sync()
+        start = time.perf_counter()
+        for _ in range(repeats):
+            fn(*args).sum().backward()
+        sync()
+        return (time.perf_counter() - start) / repeats
+
+    results = []
+    for shape in shapes:
+        b, c, *_ = shape
+        norm = nn.GroupNorm(groups, c).to(device)
+        nn.init.normal_(norm.weight)
+        nn.init.normal_(norm.bias)
+
+        x = torch.randn(shape, device = device, requires_grad = True)
+        scale = torch.randn(b, c, 1, 1, device = device, requires_grad = True)
+        shift = torch.randn(b, c, 1, 1, device = device, requires_grad = True)
+        inputs = (x, scale, shift)
+
+        fused = lambda x, scale, shift: group_norm_scale_shift_silu(x, norm, (scale, shift))
+        reference = lambda x, scale, shift: reference_group_norm_scale_shift_silu(x, norm, (scale, shift))
+
+        out = fused(*inputs)
+        grad_out = torch.randn_like(out)
+        grads = torch.autograd.grad(out, inputs, grad_out)
+        ref_out = reference(*inputs)
+        ref_grads = torch.autograd.grad(ref_out, inputs, grad_out)
+
+        results.append(dict(
+            shape = shape,
+            max_abs_diff = (out - ref_out).abs().max().item(),
+            max_abs_diff_without_scale_shift = (group_norm_scale_shift_silu(x, norm) - reference_group_norm_scale_shift_silu(x, norm)).abs().max().item(),
+            max_abs_grad_diff = max((grad - ref_grad).abs().max().item() for grad, ref_grad in zip(grads, ref_grads)),
+            fused_ms = timed(fused, *inputs) * 1e3,
+            reference_ms = timed(reference, *inputs) * 1e3
+        ))
+
+    return results
+
+def benchmark_checkpoint_levels(
+    make_unet,
+    configs = ((), (0,), (0, 1), (0, 1, 2), (0, 1, 2, 3)),
+    batch_size = 4,
+    image_size = 256,
+    channels = 1,
+    repeats = 3,
+    device = None
+):
+    """
+    activation memory and training step time of a unet for each checkpoint_levels configuration, `make_unet(checkpoint_levels)` builds it
+    memory is the peak allocated on cuda, and on cpu the bytes of the tensors saved for the backward (parameters excluded)
+    """
+    device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+    sync = torch.cuda.synchronize if device == 'cuda' else (lambda: None)
+
+    results = []
+    for checkpoint_levels in configs:
+        unet = make_unet(checkpoint_levels).to(device)
+        x = torch.randn(batch_size, channels, image_size, image_size, device = device)
+        t = torch.randint(0, 1000, (batch_size,), device = device)
+
+        param_storages = {param.untyped_storage().data_ptr() for param in unet.parameters()}
+        saved = dict()
+
+        def pack(tensor):
+            storage = tensor.untyped_storage()
+            if storage.data_ptr() not in param_storages:
+                saved[storage.data_ptr()] = storage.nbytes()
+            return tensor
+
+        if device == 'cuda':
+            torch.cuda.reset_peak_memory_stats()
+
+        with torch.autograd.graph.saved_tensors_hooks(pack, identity):
+            unet(x, t).square().mean().backward()
+
+        memory = torch.cuda.max_memory_allocated() if device == 'cuda' else sum(saved.values())
+
+        sync()
+        start = time.perf_counter()
+        for _ in range(repeats):
+            unet(x, t).square().mean().backward()
+        sync()
+
+        results.append(dict(
+            checkpoint_levels = checkpoint_levels,
+            memory_mb = memory / 2 ** 20,
+            step_ms = (time.perf_counter() - start) / repeats * 1e3
+        ))
+
+        del unet
+
+    return results
+
+if __name__ == "__main__":
+    for result in benchmark_linear_attention():
+        print('linear attention', result)
+
+    for result in benchmark_group_norm_scale_shift_silu():
+        print('group norm scale shift silu', result)
+
+    from model import Unet
+
+    for result in benchmark_checkpoint_levels(lambda checkpoint_levels: Unet(dim = 64, dim_mults = (1, 2, 4, 8), channels = 1, checkpoint_levels = checkpoint_levels)):
+        print('unet checkpoint levels', result)
@@ -2,13 +2,16 @@ import math
 import copy
 from pathlib import Path
 from random import random
-from functools import partial
-from collections import namedtuple
+from functools import partial, lru_cache
+from contextlib import nullcontext
+from collections import namedtuple, OrderedDict
+from typing import Optional, Tuple
 from multiprocessing import cpu_count
 
 import torch
 from torch import nn, einsum
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from torch.utils.data import Dataset, DataLoader
 
 from torch.optim import Adam
@@ -16,19 +19,26 @@ from torchvision import transforms as T, utils
 
 from monai.losses import DiceLoss
 
-from einops import rearrange, reduce
+from einops import rearrange, reduce, repeat
 from einops.layers.torch import Rearrange
 
 from PIL import Image
 from tqdm.auto import tqdm
 from ema_pytorch import EMA
 
+from solvers import SOLVERS
+from layers import LayerNorm, LinearAttention, WeightStandardizedConv2d, group_norm_scale_shift_silu, is_channels_last, concat_skip, is_compiling, weights_version
+
 # from accelerate import Accelerator
 
 # constants
 
 ModelPrediction =  namedtuple('ModelPrediction', ['pred_noise', 'pred_x_start'])
 
+# input shapes the unet keeps decoder skip buffers for, least recently used first out
+
+MAX_SKIP_BUFFER_SHAPES = 2
+
 # helpers functions
 
 def exists(x):
@@ -78,8 +88,8 @@ class Residual(nn.Module):
         super().__init__()
         self.fn = fn
 
-    def forward(self, x, *args, **kwargs):
-        return self.fn(x, *args, **kwargs) + x
+    def forward(self, x, *args, out = None, **kwargs):
+        return torch.add(self.fn(x, *args, **kwargs), x, out = out)
 
 def Upsample(dim, dim_out = None):
     return nn.Sequential(
@@ -90,32 +100,6 @@ def Upsample(dim, dim_out = None):
 def Downsample(dim, dim_out = None):
     return nn.Conv2d(dim, default(dim_out, dim), 4, 2, 1)
 
-class WeightStandardizedConv2d(nn.Conv2d):
-    """
-    https://arxiv.org/abs/1903.10520
-    weight standardization purportedly works synergistically with group normalization
-    """
-    def forward(self, x):
-        eps = 1e-5 if x.dtype == torch.float32 else 1e-3
-
-        weight = self.weight
-        mean = reduce(weight, 'o ... -> o 1 1 1', 'mean')
-        var = reduce(weight, 'o ... -> o 1 1 1', partial(torch.var, unbiased = False))
-        normalized_weight = (weight - mean) * (var + eps).rsqrt()
-
-        return F.conv2d(x, normalized_weight, self.bias, self.stride, self.padding, self.dilation, self.groups)
-
-class LayerNorm(nn.Module):
-    def __init__(self, dim):
-        super().__init__()
-        self.g = nn.Parameter(torch.ones(1, dim, 1, 1))
-
-    def forward(self, x):
-        eps = 1e-5 if x.dtype == torch.float32 else 1e-3
-        var = torch.var(x, dim = 1, unbiased = False, keepdim = True)
-        mean = torch.mean(x, dim = 1, keepdim = True)
-        return (x - mean) * (var + eps).rsqrt() * self.g
-
 class PreNorm(nn.Module):
     def __init__(self, dim, fn):
         super().__init__()
@@ -162,14 +146,23 @@ class LearnedSinusoidalPosEmb(nn.Module):
 # building block modules
 
 class Block(nn.Module):
-    def __init__(self, dim, dim_out, groups = 8):
+    def __init__(self, dim, dim_out, groups = 8, fused = False):
         super().__init__()
         self.proj = WeightStandardizedConv2d(dim, dim_out, 3, padding = 1)
         self.norm = nn.GroupNorm(groups, dim_out)
         self.act = nn.SiLU()
 
+        # fused folds the scale / shift into the group norm affine and applies the silu in place, see layers.py
+        # only taken outside of autograd, the backward of the folded affine is slower than the unfused one on cpu
+
+        self.fused = fused
+
     def forward(self, x, scale_shift = None):
         x = self.proj(x)
+
+        if self.fused and not torch.is_grad_enabled():
+            return group_norm_scale_shift_silu(x, self.norm, scale_shift)
+
         x = self.norm(x)
 
         if exists(scale_shift):
@@ -180,22 +173,23 @@ class Block(nn.Module):
         return x
 
 class ResnetBlock(nn.Module):
-    def __init__(self, dim, dim_out, *, time_emb_dim = None, groups = 8):
+    def __init__(self, dim, dim_out, *, time_emb_dim = None, groups = 8, fused = False):
         super().__init__()
         self.mlp = nn.Sequential(
             nn.SiLU(),
             nn.Linear(time_emb_dim, dim_out * 2)
         ) if exists(time_emb_dim) else None
 
-        self.block1 = Block(dim, dim_out, groups = groups)
-        self.block2 = Block(dim_out, dim_out, groups = groups)
+        self.block1 = Block(dim, dim_out, groups = groups, fused = fused)
+        self.block2 = Block(dim_out, dim_out, groups = groups, fused = fused)
         self.res_conv = nn.Conv2d(dim, dim_out, 1) if dim != dim_out else nn.Identity()
 
-    def forward(self, x, time_emb = None):
+    def forward(self, x, time_emb = None, time_proj = None, out = None):
+        # time_proj, the mlp output for time_emb, can be looked up from the unet time cache instead
 
         scale_shift = None
-        if exists(self.mlp) and exists(time_emb):
-            time_emb = self.mlp(time_emb)
+        if exists(self.mlp) and (exists(time_emb) or exists(time_proj)):
+            time_emb = default(time_proj, lambda: self.mlp(time_emb))
             time_emb = rearrange(time_emb, 'b c -> b c 1 1')
             scale_shift = time_emb.chunk(2, dim = 1)
 
@@ -203,60 +197,48 @@ class ResnetBlock(nn.Module):
 
         h = self.block2(h)
 
-        return h + self.res_conv(x)
+        return torch.add(h, self.res_conv(x), out = out)
 
-class LinearAttention(nn.Module):
-    def __init__(self, dim, heads = 4, dim_head = 32):
+class Attention(nn.Module):
+    def __init__(self, dim, heads = 4, dim_head = 32, flash = True):
         super().__init__()
         self.scale = dim_head ** -0.5
         self.heads = heads
         hidden_dim = dim_head * heads
-        self.to_qkv = nn.Conv2d(dim, hidden_dim * 3, 1, bias = False)
 
-        self.to_out = nn.Sequential(
-            nn.Conv2d(hidden_dim, dim, 1),
-            LayerNorm(dim)
-        )
+        # scaled_dot_product_attention (flash / memory efficient kernels) never materializes the [n, n] similarity matrix
+        # falls back to the explicit softmax attention on pytorch versions without it
 
-    def forward(self, x):
-        b, c, h, w = x.shape
-        qkv = self.to_qkv(x).chunk(3, dim = 1)
-        q, k, v = map(lambda t: rearrange(t, 'b (h c) x y -> b h c (x y)', h = self.heads), qkv)
-
-        q = q.softmax(dim = -2)
-        k = k.softmax(dim = -1)
+        self.flash = flash and hasattr(F, 'scaled_dot_product_attention')
 
-        q = q * self.scale
-        v = v / (h * w)
-
-        context = torch.einsum('b h d n, b h e n -> b h d e', k, v)
+        self.to_qkv = nn.Conv2d(dim, hidden_dim * 3, 1, bias = False)
+        self.to_out = nn.Conv2d(hidden_dim, dim, 1)
 
-        out = torch.einsum('b h d e, b h d n -> b h e n', context, q)
-        out = rearrange(out, 'b h c (x y) -> b (h c) x y', h = self.heads, x = h, y = w)
-        return self.to_out(out)
+    def attend(self, q, k, v):
+        if self.flash:
+            return F.scaled_dot_product_attention(q, k, v) # default scale is dim_head ** -0.5
 
-class Attention(nn.Module):
-    def __init__(self, dim, heads = 4, dim_head = 32):
-        super().__init__()
-        self.scale = dim_head ** -0.5
-        self.heads = heads
-        hidden_dim = dim_head * heads
+        q = q * self.scale
 
-        self.to_qkv = nn.Conv2d(dim, hidden_dim * 3, 1, bias = False)
-        self.to_out = nn.Conv2d(hidden_dim, dim, 1)
+        sim = einsum('b h i d, b h j d -> b h i j', q, k)
+        attn = sim.softmax(dim = -1)
+        return einsum('b h i j, b h j d -> b h i d', attn, v)
 
     def forward(self, x):
         b, c, h, w = x.shape
-        qkv = self.to_qkv(x).chunk(3, dim = 1)
-        q, k, v = map(lambda t: rearrange(t, 'b (h c) x y -> b h c (x y)', h = self.heads), qkv)
+        qkv = self.to_qkv(x)
 
-        q = q * self.scale
+        if not is_channels_last(qkv):
+            q, k, v = map(lambda t: rearrange(t, 'b (h c) x y -> b h (x y) c', h = self.heads), qkv.chunk(3, dim = 1))
+            out = self.attend(q, k, v)
+            out = rearrange(out, 'b h (x y) d -> b (h d) x y', x = h, y = w)
+            return self.to_out(out)
 
-        sim = einsum('b h d i, b h d j -> b h i j', q, k)
-        attn = sim.softmax(dim = -1)
-        out = einsum('b h i j, b h d j -> b h i d', attn, v)
+        # [b, h, w, c] memory, q, k, v as strided [b, heads, h * w, dim_head] views and the output back to channels last
 
-        out = rearrange(out, 'b h (x y) d -> b (h d) x y', x = h, y = w)
+        q, k, v = qkv.permute(0, 2, 3, 1).reshape(b, h * w, 3, self.heads, -1).permute(2, 0, 3, 1, 4).unbind(dim = 0)
+        out = self.attend(q, k, v)
+        out = out.transpose(1, 2).reshape(b, h, w, -1).permute(0, 3, 1, 2)
         return self.to_out(out)
 
 # model
@@ -273,7 +255,13 @@ class Unet(nn.Module):
         resnet_block_groups = 8,
         learned_variance = False,
         learned_sinusoidal_cond = False,
-        learned_sinusoidal_dim = 16
+        learned_sinusoidal_dim = 16,
+        full_attn = None,
+        flash_attn = True,
+        fused_blocks = False,
+        channels_last = False,
+        preallocate_skips = False,
+        checkpoint_levels = ()
     ):
         super().__init__()
 
@@ -289,7 +277,15 @@ class Unet(nn.Module):
         dims = [init_dim, *map(lambda m: dim * m, dim_mults)]
         in_out = list(zip(dims[:-1], dims[1:]))
 
-        block_klass = partial(ResnetBlock, groups = resnet_block_groups)
+        block_klass = partial(ResnetBlock, groups = resnet_block_groups, fused = fused_blocks)
+
+        # attention per resolution level, linear by default, full (flash when available) where full_attn is True
+        # the mid block always uses full attention
+
+        full_attn = default(full_attn, (False,) * len(in_out))
+        assert len(full_attn) == len(in_out), 'full_attn must have one entry per resolution level'
+
+        attn_klass = lambda dim, full: Attention(dim, flash = flash_attn) if full else LinearAttention(dim)
 
         # time embeddings
 
@@ -317,28 +313,28 @@ class Unet(nn.Module):
         self.ups = nn.ModuleList([])
         num_resolutions = len(in_out)
 
-        for ind, (dim_in, dim_out) in enumerate(in_out):
+        for ind, ((dim_in, dim_out), level_full_attn) in enumerate(zip(in_out, full_attn)):
             is_last = ind >= (num_resolutions - 1)
 
             self.downs.append(nn.ModuleList([
                 block_klass(dim_in, dim_in, time_emb_dim = time_dim),
                 block_klass(dim_in, dim_in, time_emb_dim = time_dim),
-                Residual(PreNorm(dim_in, LinearAttention(dim_in))),
+                Residual(PreNorm(dim_in, attn_klass(dim_in, level_full_attn))),
                 Downsample(dim_in, dim_out) if not is_last else nn.Conv2d(dim_in, dim_out, 3, padding = 1)
             ]))
 
         mid_dim = dims[-1]
         self.mid_block1 = block_klass(mid_dim, mid_dim, time_emb_dim = time_dim)
-        self.mid_attn = Residual(PreNorm(mid_dim, Attention(mid_dim)))
+        self.mid_attn = Residual(PreNorm(mid_dim, Attention(mid_dim, flash = flash_attn)))
         self.mid_block2 = block_klass(mid_dim, mid_dim, time_emb_dim = time_dim)
 
-        for ind, (dim_in, dim_out) in enumerate(reversed(in_out)):
+        for ind, ((dim_in, dim_out), level_full_attn) in enumerate(zip(reversed(in_out), reversed(full_attn))):
             is_last = ind == (len(in_out) - 1)
 
             self.ups.append(nn.ModuleList([
                 block_klass(dim_out + dim_in, dim_out, time_emb_dim = time_dim),
                 block_klass(dim_out + dim_in, dim_out, time_emb_dim = time_dim),
-                Residual(PreNorm(dim_out, LinearAttention(dim_out))),
+                Residual(PreNorm(dim_out, attn_klass(dim_out, level_full_attn))),
                 Upsample(dim_out, dim_in) if not is_last else  nn.Conv2d(dim_out, dim_in, 3, padding = 1)
             ]))
 
@@ -348,45 +344,171 @@ class Unet(nn.Module):
         self.final_res_block = block_klass(dim * 2, dim, time_emb_dim = time_dim)
         self.final_conv = nn.Conv2d(dim, self.out_dim, 1)
 
+        # activation checkpointing, the blocks of the down and up stages at these resolution levels (0 being the highest resolution)
+        # are recomputed in the backward instead of keeping their intermediate activations
+
+        self.checkpoint_levels = tuple(checkpoint_levels)
+        assert all(0 <= level < len(in_out) for level in self.checkpoint_levels), f'checkpoint levels must be between 0 and {len(in_out) - 1}'
+
+        # at inference, the decoder concatenations can be served from buffers preallocated per input shape, see skip_buffers
+        # channels of the skip in each of them, in the order the encoder produces the skips, the init_conv output r last
+
+        self.preallocate_skips = preallocate_skips
+        self.in_out = in_out
+        self.skip_dims = [*[dim_in for dim_in, _ in in_out for _ in range(2)], init_dim]
+        self._skip_buffers = OrderedDict()
+
+        # channels last (nhwc) activations and conv weights end to end, faster with onednn cpu and cudnn convs
+
+        self.channels_last = channels_last
+
+        if channels_last:
+            self.to(memory_format = torch.channels_last)
+
+        # inference cache of the time embedding and the resnet block projections of it, enabled by cache_time_embeddings
+
+        self.num_cached_timesteps = None
+        self._time_cache = None
+        self._time_cache_version = None
+
+    def checkpointed(self, level, stage):
+        """
+        the block1, block2, attn, resample modules of a stage, the first three wrapped to be recomputed in the backward
+        when training with the stage level checkpointed, the resampling conv saves no more than its input anyway
+        """
+        if level not in self.checkpoint_levels or not torch.is_grad_enabled():
+            return stage
+
+        *modules, resample = stage
+        return [*(partial(checkpoint, module, use_reentrant = False) for module in modules), resample]
+
+    def skip_buffers(self, x):
+        """
+        [x, skip] decoder inputs for an init_conv output shaped like x, one per skip in the order the encoder produces them,
+        followed by the [x, r] input of the final block, kept per shape, dtype and device as sampling repeats the same shape
+        only the MAX_SKIP_BUFFER_SHAPES most recent shapes are kept, the batch of sample_until_stable shrinks step after step
+        """
+        b, channels, height, width = x.shape
+        key = (b, height, width, x.dtype, x.device)
+
+        if key in self._skip_buffers:
+            self._skip_buffers.move_to_end(key)
+        else:
+            memory_format = torch.channels_last if self.channels_last else torch.contiguous_format
+            empty = lambda dim, level: torch.empty((b, dim, height // 2 ** level, width // 2 ** level), dtype = x.dtype, device = x.device, memory_format = memory_format)
+
+            buffers = [empty(dim_out + dim_in, level) for level, (dim_in, dim_out) in enumerate(self.in_out) for _ in range(2)]
+            buffers.append(empty(channels * 2, 0))
+            self._skip_buffers[key] = buffers
+
+            while len(self._skip_buffers) > MAX_SKIP_BUFFER_SHAPES:
+                self._skip_buffers.popitem(last = False)
+
+        return self._skip_buffers[key]
+
+    def freeze_for_inference(self):
+        """ eval mode, with every weight standardized conv standardizing its weight once instead of on every call """
+        self.eval()
+        for module in self.modules():
+            if isinstance(module, WeightStandardizedConv2d):
+                module.freeze()
+        return self
+
+    def cache_time_embeddings(self, num_timesteps):
+        """ at inference, look the time embeddings of the integer timesteps [0, num_timesteps) up instead of recomputing them """
+        self.num_cached_timesteps = num_timesteps
+        self._time_cache = None
+        self._time_cache_version = None
+        return self
+
+    def time_tables(self, device):
+        """
+        [T, time_dim] time embedding and, per resnet block, the [T, dim_out * 2] scale / shift projection of it
+        built lazily outside of autograd, rebuilt when the weights change
+        """
+        blocks = [module for module in self.modules() if isinstance(module, ResnetBlock) and exists(module.mlp)]
+        version = weights_version(self.time_mlp, *blocks)
+
+        # built in float32 even when first requested under autocast, the tables outlive the autocast region
+
+        if self._time_cache_version != version:
+            with torch.autocast(device.type, enabled = False):
+                times = torch.arange(self.num_cached_timesteps, device = device)
+                table = self.time_mlp(times)
+                self._time_cache = (table, {block: block.mlp(table) for block in blocks})
+
+            self._time_cache_version = version
+
+        return self._time_cache
+
+    def time_embeddings(self, time):
+        """ time embedding t and the per resnet block projections of it, the latter only when served from the cache """
+        use_cache = exists(self.num_cached_timesteps) and not torch.is_grad_enabled() and not time.is_floating_point() and not is_compiling()
+
+        if not use_cache:
+            return self.time_mlp(time), {}
+
+        table, block_tables = self.time_tables(time.device)
+        t = table.index_select(0, time)
+        return t, {block: block_table.index_select(0, time) for block, block_table in block_tables.items()}
+
     def forward(self, x, time, x_self_cond = None):
         if self.self_condition:
             x_self_cond = default(x_self_cond, lambda: torch.zeros_like(x))
             x = torch.cat((x_self_cond, x), dim = 1)
 
+        if self.channels_last:
+            x = x.contiguous(memory_format = torch.channels_last)
+
         x = self.init_conv(x)
-        r = x.clone()
 
-        t = self.time_mlp(time)
+        # with preallocated skips, the encoder writes each skip straight into its slice of the matching decoder input,
+        # and the first decoder block of each level its output in front of the next skip, so the concatenations copy little
+
+        cats = self.skip_buffers(x) if self.preallocate_skips and not torch.is_grad_enabled() and not is_compiling() else None
+        cat_buffer = lambda index: cats[index] if exists(cats) else None
+        skip_slot = lambda index: cats[index][:, -self.skip_dims[index]:] if exists(cats) else None
+        head_slot = lambda index: cats[index][:, :-self.skip_dims[index]] if exists(cats) else None
+
+        r = x.clone() if not exists(cats) else skip_slot(-1).copy_(x)
+
+        t, proj = self.time_embeddings(time)
 
         h = []
 
-        for block1, block2, attn, downsample in self.downs:
-            x = block1(x, t)
+        for level, stage in enumerate(self.downs):
+            block1, block2, attn, downsample = self.checkpointed(level, stage)
+
+            x = block1(x, t, proj.get(block1), out = skip_slot(len(h)))
             h.append(x)
 
-            x = block2(x, t)
-            x = attn(x)
+            x = block2(x, t, proj.get(block2))
+            x = attn(x, out = skip_slot(len(h)))
             h.append(x)
 
             x = downsample(x)
 
-        x = self.mid_block1(x, t)
+        x = self.mid_block1(x, t, proj.get(self.mid_block1))
         x = self.mid_attn(x)
-        x = self.mid_block2(x, t)
+        x = self.mid_block2(x, t, proj.get(self.mid_block2))
+
+        for ind, stage in enumerate(self.ups):
+            block1, block2, attn, upsample = self.checkpointed(len(self.ups) - 1 - ind, stage)
 
-        for block1, block2, attn, upsample in self.ups:
-            x = torch.cat((x, h.pop()), dim = 1)
-            x = block1(x, t)
+            skip = h.pop()
+            x = concat_skip(x, skip, cat_buffer(len(h)))
+            x = block1(x, t, proj.get(block1), out = head_slot(len(h) - 1))
 
-            x = torch.cat((x, h.pop()), dim = 1)
-            x = block2(x, t)
+            skip = h.pop()
+            x = concat_skip(x, skip, cat_buffer(len(h)))
+            x = block2(x, t, proj.get(block2))
             x = attn(x)
 
             x = upsample(x)
 
-        x = torch.cat((x, r), dim = 1)
+        x = concat_skip(x, r, cat_buffer(-1))
 
-        x = self.final_res_block(x, t)
+        x = self.final_res_block(x, t, proj.get(self.final_res_block))
         return self.final_conv(x)
 
 # gaussian diffusion trainer class
@@ -396,6 +518,34 @@ def extract(a, t, x_shape):
     out = a.gather(-1, t)
     return out.reshape(b, *((1,) * (len(x_shape) - 1)))
 
+ScheduleCoefficients = namedtuple('ScheduleCoefficients', [
+    'sqrt_alphas_cumprod',
+    'sqrt_one_minus_alphas_cumprod',
+    'sqrt_recip_alphas_cumprod',
+    'sqrt_recipm1_alphas_cumprod',
+    'posterior_mean_coef1',
+    'posterior_mean_coef2',
+    'posterior_variance',
+    'posterior_log_variance_clipped',
+    'p2_loss_weight'
+])
+
+class ScheduleTable(nn.Module):
+    """
+    all per timestep coefficients packed into one contiguous [T, K] table,
+    so a single gather per call returns every coefficient, already shaped to broadcast against x
+    """
+    def __init__(self, **buffers):
+        super().__init__()
+        table = torch.stack([buffers[name] for name in ScheduleCoefficients._fields], dim = -1)
+        self.register_buffer('table', table.to(torch.float32).contiguous(), persistent = False)
+
+    def forward(self, t, x_shape):
+        b, *_ = t.shape
+        coefs = self.table.index_select(0, t)
+        coefs = coefs.reshape(b, len(ScheduleCoefficients._fields), *((1,) * (len(x_shape) - 1)))
+        return ScheduleCoefficients(*coefs.unbind(dim = 1))
+
 def linear_beta_schedule(timesteps):
     scale = 1000 / timesteps
     beta_start = scale * 0.0001
@@ -469,6 +619,292 @@ def dice_loss(input: torch.Tensor, target: torch.Tensor, eps: float = 1e-8) -> t
     target_unnorm = unnormalize_to_zero_to_one(target)
     return DiceLoss()(input_unnorm, target_unnorm)
 
+# fused ancestral update
+
+def fused_p_sample_step(
+    x_t: torch.Tensor,
+    model_output: torch.Tensor,
+    noise: Optional[torch.Tensor],
+    sqrt_recip_alphas_cumprod: torch.Tensor,
+    sqrt_recipm1_alphas_cumprod: torch.Tensor,
+    posterior_mean_coef1: torch.Tensor,
+    posterior_mean_coef2: torch.Tensor,
+    posterior_log_variance_clipped: torch.Tensor,
+    objective: str = 'pred_noise',
+    clip_denoised: bool = True,
+    out: Optional[torch.Tensor] = None
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    x_{t-1} = coef1 * x_0 + coef2 * x_t + exp(0.5 * log_var) * noise, computed straight from x_t, the model output and the noise
+    x_0 is written into the model output (which is consumed) and x_{t-1} into `out` (which may be x_t itself),
+    so no full size intermediates are materialized for the posterior mean or variance
+    """
+    x_start = model_output
+    if objective == 'pred_noise':
+        x_start = x_start.mul_(-sqrt_recipm1_alphas_cumprod).addcmul_(x_t, sqrt_recip_alphas_cumprod)
+    elif objective == 'pred_v':
+        x_start = x_start.mul_(-sqrt_recipm1_alphas_cumprod).add_(x_t).div_(sqrt_recip_alphas_cumprod)
+
+    if clip_denoised:
+        x_start = x_start.clamp_(-1., 1.)
+
+    if out is None:
+        out = torch.mul(x_t, posterior_mean_coef2)
+    else:
+        out = torch.mul(x_t, posterior_mean_coef2, out = out)
+
+    out = out.addcmul_(x_start, posterior_mean_coef1)
+
+    if noise is not None:
+        out = out.addcmul_(noise, (0.5 * posterior_log_variance_clipped).exp())
+
+    return out, x_start
+
+@lru_cache(maxsize = None)
+def scripted_fused_p_sample_step():
+    return torch.jit.script(fused_p_sample_step)
+
+# preplanned sampling engine
+
+SamplingPlan = namedtuple('SamplingPlan', ['times', 'coefs'])
+
+class SamplingEngine:
+    """
+    ancestral (ddpm) and ddim sampling with the whole time / coefficient schedule planned once,
+    image, x_start and noise buffers allocated once per chunk and updated in place across steps,
+    and batches of arbitrary size streamed through in chunks of at most `chunk_size`
+    """
+    def __init__(self, diffusion, chunk_size = 16, clip_denoised = True):
+        self.diffusion = diffusion
+        self.chunk_size = chunk_size
+        self.clip_denoised = clip_denoised
+        self.plans = {}
+
+    def reset(self):
+        self.plans.clear()
+
+    def sampling_times(self, method, steps):
+        diffusion = self.diffusion
+
+        if method == 'ddpm':
+            times = list(reversed(range(diffusion.num_timesteps)))
+            return list(zip(times, [t - 1 for t in times]))
+
+        times = torch.linspace(-1, diffusion.num_timesteps - 1, steps = steps + 1)
+        times = list(reversed(times.int().tolist()))
+        return list(zip(times[:-1], times[1:]))
+
+    def plan(self, method, steps, device):
+        diffusion = self.diffusion
+        key = (method, steps, diffusion.ddim_sampling_eta, str(device))
+
+        if key in self.plans:
+            return self.plans[key]
+
+        time_pairs = self.sampling_times(method, steps)
+
+        # all coefficients are kept as python floats, so each step is a handful of in-place scalar ops
+
+        buffers = dict(
+            alphas_cumprod = diffusion.alphas_cumprod,
+            sqrt_recip_alphas_cumprod = diffusion.sqrt_recip_alphas_cumprod,
+            sqrt_recipm1_alphas_cumprod = diffusion.sqrt_recipm1_alphas_cumprod,
+            posterior_mean_coef1 = diffusion.posterior_mean_coef1,
+            posterior_mean_coef2 = diffusion.posterior_mean_coef2,
+            posterior_log_variance_clipped = diffusion.posterior_log_variance_clipped
+        )
+        buffers = {name: buffer.detach().double().cpu().tolist() for name, buffer in buffers.items()}
+
+        coefs = []
+        for time, time_next in time_pairs:
+            sqrt_recip, sqrt_recipm1 = buffers['sqrt_recip_alphas_cumprod'][time], buffers['sqrt_recipm1_alphas_cumprod'][time]
+
+            if method == 'ddpm':
+                sigma = math.exp(0.5 * buffers['posterior_log_variance_clipped'][time]) if time > 0 else 0.
+                coefs.append((sqrt_recip, sqrt_recipm1, buffers['posterior_mean_coef1'][time], buffers['posterior_mean_coef2'][time], sigma))
+                continue
+
+            if time_next < 0:
+                coefs.append((sqrt_recip, sqrt_recipm1, 0., 0., 0.))
+                continue
+
+            alpha, alpha_next = buffers['alphas_cumprod'][time], buffers['alphas_cumprod'][time_next]
+            sigma = diffusion.ddim_sampling_eta * math.sqrt((1 - alpha / alpha_next) * (1 - alpha_next) / (1 - alpha))
+            c = math.sqrt(max(1 - alpha_next - sigma ** 2, 0.))
+            coefs.append((sqrt_recip, sqrt_recipm1, math.sqrt(alpha_next), c, sigma))
+
+        times = torch.tensor([time for time, _ in time_pairs], device = device, dtype = torch.long)
+        times = repeat(times, 's -> s b', b = self.chunk_size).contiguous()
+
+        plan = SamplingPlan(times, coefs)
+        self.plans[key] = plan
+        return plan
+
+    def predict_start(self, img, model_output, x_start, sqrt_recip, sqrt_recipm1):
+        objective = self.diffusion.objective
+
+        if objective == 'pred_noise':
+            torch.mul(img, sqrt_recip, out = x_start)
+            x_start.add_(model_output, alpha = -sqrt_recipm1)
+        elif objective == 'pred_v':
+            torch.div(img, sqrt_recip, out = x_start)
+            x_start.add_(model_output, alpha = -sqrt_recipm1 / sqrt_recip)
+        else:
+            x_start.copy_(model_output)
+
+        if self.clip_denoised:
+            x_start.clamp_(-1., 1.)
+
+    def ddpm_step(self, img, model_output, x_start, noise, coefs, draw_noise = True):
+        sqrt_recip, sqrt_recipm1, coef1, coef2, sigma = coefs
+        self.predict_start(img, model_output, x_start, sqrt_recip, sqrt_recipm1)
+
+        img.mul_(coef2).add_(x_start, alpha = coef1)
+
+        if sigma > 0:
+            img.add_(noise.normal_() if draw_noise else noise, alpha = sigma)
+
+    def ddim_step(self, img, model_output, x_start, noise, coefs, draw_noise = True):
+        sqrt_recip, sqrt_recipm1, sqrt_alpha_next, c, sigma = coefs
+        self.predict_start(img, model_output, x_start, sqrt_recip, sqrt_recipm1)
+
+        if sqrt_alpha_next == 0.:
+            img.copy_(x_start)
+            return
+
+        # the model output is no longer needed once x_start is taken, so it is reused to hold the predicted noise
+
+        if self.diffusion.objective == 'pred_noise':
+            pred_noise = model_output
+        else:
+            pred_noise = model_output.copy_(img).mul_(sqrt_recip).sub_(x_start).div_(sqrt_recipm1)
+
+        img.copy_(x_start).mul_(sqrt_alpha_next).add_(pred_noise, alpha = c)
+
+        if sigma > 0:
+            img.add_(noise.normal_() if draw_noise else noise, alpha = sigma)
+
+    @torch.no_grad()
+    def __call__(self, shape, img = None, method = None, steps = None):
+        diffusion = self.diffusion
+        method = default(method, 'ddim' if diffusion.is_ddim_sampling else 'ddpm')
+        steps = default(steps, diffusion.sampling_timesteps)
+        assert method in {'ddpm', 'ddim'}, f'unknown sampling method {method}'
+
+        batch, *item_shape = shape
+        device, dtype = diffusion.betas.device, diffusion.betas.dtype
+
+        plan = self.plan(method, steps, device)
+        step_fn = self.ddpm_step if method == 'ddpm' else self.ddim_step
+
+        chunk_size = min(self.chunk_size, batch)
+        buffers = [torch.empty((chunk_size, *item_shape), device = device, dtype = dtype) for _ in range(3)]
+        out = torch.empty(shape, device = device, dtype = dtype)
+
+        for start in range(0, batch, chunk_size):
+            size = min(chunk_size, batch - start)
+            x, x_start, noise = (buffer[:size] for buffer in buffers)
+
+            if exists(img):
+                x.copy_(img[start:start + size])
+            else:
+                x.normal_()
+
+            for ind, coefs in enumerate(tqdm(plan.coefs, desc = 'sampling loop time step', leave = False)):
+                self_cond = x_start if diffusion.self_condition and ind > 0 else None
+                model_output = diffusion.denoise_fn(x, plan.times[ind, :size], self_cond)
+                step_fn(x, model_output, x_start, noise, coefs)
+
+            out[start:start + size].copy_(x)
+
+        return out.add_(1.).mul_(0.5)
+
+    @torch.no_grad()
+    def until_stable(self, shape, img = None, method = None, steps = None, tol = 1e-3, patience = 2, threshold = 0.5, min_alpha_cumprod = 0.5):
+        """
+        as __call__, for masks, with each sample leaving the batch once its predicted x_start has settled:
+        at most a `tol` fraction of the pixels of its mask, thresholded at `threshold` (in [0, 1] units), flipped for `patience` consecutive steps,
+        its x_start at that step being its result. returns the samples and the number of denoising steps each took
+        only the mask is tested, the continuous prediction keeps drifting with the noise level long after the mask stops changing
+        steps are only tested from the first one whose alphas_cumprod reaches `min_alpha_cumprod`, at higher noise levels the
+        prediction can sit on one mode for a few steps and still end up on another
+        """
+        diffusion = self.diffusion
+        method = default(method, 'ddim' if diffusion.is_ddim_sampling else 'ddpm')
+        steps = default(steps, diffusion.sampling_timesteps)
+        assert method in {'ddpm', 'ddim'}, f'unknown sampling method {method}'
+
+        batch, *item_shape = shape
+        device, dtype = diffusion.betas.device, diffusion.betas.dtype
+
+        plan = self.plan(method, steps, device)
+        step_fn = self.ddpm_step if method == 'ddpm' else self.ddim_step
+        last = len(plan.coefs) - 1
+
+        alphas_cumprod = diffusion.alphas_cumprod[plan.times[:, 0]]
+        first_exit = int((alphas_cumprod < min_alpha_cumprod).sum().item())
+
+        out = torch.empty(shape, device = device, dtype = dtype)
+        steps_taken = torch.empty((batch,), device = device, dtype = torch.long)
+
+        # the sampler works in [-1, 1]
+
+        threshold = threshold * 2 - 1
+
+        for start in range(0, batch, self.chunk_size):
+            size = min(self.chunk_size, batch - start)
+            index = torch.arange(start, start + size, device = device)
+
+            x = img[start:start + size].to(device = device, dtype = dtype, copy = True) if exists(img) else torch.randn((size, *item_shape), device = device, dtype = dtype)
+            x_start, prev_x_start, noise = torch.empty_like(x), torch.empty_like(x), torch.empty_like(x)
+            stable = torch.zeros((size,), device = device, dtype = torch.long)
+
+            # the noise is drawn for the whole chunk, as __call__ does, and gathered for the remaining samples,
+            # so they follow the same trajectories as without early exit
+
+            chunk_noise = noise
+
+            for ind, coefs in enumerate(tqdm(plan.coefs, desc = 'sampling loop time step', leave = False)):
+                self_cond = x_start if diffusion.self_condition and ind > 0 else None
+                model_output = diffusion.denoise_fn(x, plan.times[ind, :x.shape[0]], self_cond)
+
+                # x_start is double buffered, the previous step's prediction is compared against without a copy
+
+                if coefs[-1] > 0 and x.shape[0] < size:
+                    torch.index_select(chunk_noise.normal_(), 0, index - start, out = noise)
+
+                x_start, prev_x_start = prev_x_start, x_start
+                step_fn(x, model_output, x_start, noise, coefs, draw_noise = x.shape[0] == size)
+
+                if ind == last:
+                    out[index] = x
+                    steps_taken[index] = ind + 1
+                    break
+
+                if ind == 0 or ind < first_exit:
+                    continue
+
+                flipped = ((x_start > threshold) != (prev_x_start > threshold)).flatten(1).float().mean(dim = 1)
+                stable = torch.where(flipped <= tol, stable + 1, torch.zeros_like(stable))
+
+                done = stable >= patience
+
+                if not done.any():
+                    continue
+
+                out[index[done]] = x_start[done]
+                steps_taken[index[done]] = ind + 1
+
+                # the settled samples drop out, the rest of the chunk carries on as a smaller batch
+
+                keep = ~done
+                if not keep.any():
+                    break
+
+                index, x, x_start, prev_x_start, noise, stable = (t[keep] for t in (index, x, x_start, prev_x_start, noise, stable))
+
+        return out.add_(1.).mul_(0.5), steps_taken
+
 
 class GaussianDiffusion(nn.Module):
     def __init__(
@@ -483,7 +919,11 @@ class GaussianDiffusion(nn.Module):
         beta_schedule = 'cosine',
         p2_loss_weight_gamma = 0., # p2 loss weight, from https://arxiv.org/abs/2204.00227 - 0 is equivalent to weight of 1 across time - 1. is recommended
         p2_loss_weight_k = 1,
-        ddim_sampling_eta = 1.
+        ddim_sampling_eta = 1.,
+        sampling_chunk_size = 16,
+        script_fused_step = False,
+        compile = False,
+        autocast_dtype = None
     ):
         super().__init__()
         assert not (type(self) == GaussianDiffusion and model.channels != model.out_dim)
@@ -497,7 +937,7 @@ class GaussianDiffusion(nn.Module):
 
         self.objective = objective
 
-        assert objective in {'pred_noise', 'pred_x0'}, 'objective must be either pred_noise (predict noise) or pred_x0 (predict image start)'
+        assert objective in {'pred_noise', 'pred_x0', 'pred_v'}, 'objective must be either pred_noise (predict noise) or pred_x0 (predict image start) or pred_v (predict v [v-parameterization as defined in appendix D of progressive distillation paper, used in imagen-video successfully])'
 
         if beta_schedule == 'linear':
             betas = linear_beta_schedule(timesteps)
@@ -512,6 +952,7 @@ class GaussianDiffusion(nn.Module):
 
         timesteps, = betas.shape
         self.num_timesteps = int(timesteps)
+        self.model.cache_time_embeddings(self.num_timesteps)
         self.loss_type = loss_type
 
         # sampling related parameters
@@ -521,6 +962,18 @@ class GaussianDiffusion(nn.Module):
         assert self.sampling_timesteps <= timesteps
         self.is_ddim_sampling = self.sampling_timesteps < timesteps
         self.ddim_sampling_eta = ddim_sampling_eta
+        self.script_fused_step = script_fused_step
+
+        # sampling can run the unet through torch.compile, compiled once on first use and reused across sample calls
+        # the compiled forward is kept out of the module tree, so state dicts are unchanged
+
+        self.compile = compile
+        self._compiled_forward = None
+
+        # the unet can run under autocast (torch.bfloat16 for cpu training and sampling), while the schedule buffers stay float32
+        # and the unet output is cast back to the dtype of x, so the sampler updates and the loss accumulate in float32
+
+        self.autocast_dtype = autocast_dtype
 
         # helper function to register buffer from float64 to float32
 
@@ -556,29 +1009,77 @@ class GaussianDiffusion(nn.Module):
 
         register_buffer('p2_loss_weight', (p2_loss_weight_k + alphas_cumprod / (1 - alphas_cumprod)) ** -p2_loss_weight_gamma)
 
+        # the buffers above packed into one table, gathered once per call instead of once per buffer
+
+        self.schedule = ScheduleTable(**{name: getattr(self, name) for name in ScheduleCoefficients._fields})
+
+        # preplanned sampling loop used by `sample`, streaming the batch through in chunks of `sampling_chunk_size`
+
+        self.sampling_engine = SamplingEngine(self, chunk_size = sampling_chunk_size)
+
     def predict_start_from_noise(self, x_t, t, noise):
+        coefs = self.schedule(t, x_t.shape)
         return (
-            extract(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t -
-            extract(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape) * noise
+            coefs.sqrt_recip_alphas_cumprod * x_t -
+            coefs.sqrt_recipm1_alphas_cumprod * noise
         )
 
     def predict_noise_from_start(self, x_t, t, x0):
+        coefs = self.schedule(t, x_t.shape)
         return (
-            (extract(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t - x0) / \
-            extract(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape)
+            (coefs.sqrt_recip_alphas_cumprod * x_t - x0) / \
+            coefs.sqrt_recipm1_alphas_cumprod
+        )
+
+    def predict_v(self, x_start, t, noise):
+        coefs = self.schedule(t, x_start.shape)
+        return (
+            coefs.sqrt_alphas_cumprod * noise -
+            coefs.sqrt_one_minus_alphas_cumprod * x_start
+        )
+
+    def predict_start_from_v(self, x_t, t, v):
+        coefs = self.schedule(t, x_t.shape)
+        return (
+            coefs.sqrt_alphas_cumprod * x_t -
+            coefs.sqrt_one_minus_alphas_cumprod * v
         )
 
     def q_posterior(self, x_start, x_t, t):
+        coefs = self.schedule(t, x_t.shape)
         posterior_mean = (
-            extract(self.posterior_mean_coef1, t, x_t.shape) * x_start +
-            extract(self.posterior_mean_coef2, t, x_t.shape) * x_t
+            coefs.posterior_mean_coef1 * x_start +
+            coefs.posterior_mean_coef2 * x_t
         )
-        posterior_variance = extract(self.posterior_variance, t, x_t.shape)
-        posterior_log_variance_clipped = extract(self.posterior_log_variance_clipped, t, x_t.shape)
-        return posterior_mean, posterior_variance, posterior_log_variance_clipped
+        return posterior_mean, coefs.posterior_variance, coefs.posterior_log_variance_clipped
+
+    def autocast(self, device):
+        """ autocast region of the unet calls, a no-op without autocast_dtype, which leaves an enclosing autocast (lightning's) in effect """
+        if not exists(self.autocast_dtype):
+            return nullcontext()
+
+        return torch.autocast(device.type, dtype = self.autocast_dtype)
+
+    def run_model(self, fn, x, *args, **kwargs):
+        """ fn (the unet or its compiled forward) under autocast, its output in the dtype of x """
+        with self.autocast(x.device):
+            out = fn(x, *args, **kwargs)
+
+        return out.to(x.dtype)
+
+    @property
+    def denoise_fn(self):
+        """ the unet as the samplers call it, under autocast_dtype, its forward compiled once with torch.compile when compile = True """
+        if not self.compile:
+            return partial(self.run_model, self.model)
+
+        if not exists(self._compiled_forward):
+            self._compiled_forward = torch.compile(self.model.forward, dynamic = False)
+
+        return partial(self.run_model, self._compiled_forward)
 
     def model_predictions(self, x, t, x_self_cond = None, clip_x_start = False):
-        model_output = self.model(x, t, x_self_cond)
+        model_output = self.denoise_fn(x, t, x_self_cond)
         maybe_clip = partial(torch.clamp, min = -1., max = 1.) if clip_x_start else identity # ?
 
         if self.objective == 'pred_noise':
@@ -591,6 +1092,12 @@ class GaussianDiffusion(nn.Module):
             x_start = maybe_clip(x_start)
             pred_noise = self.predict_noise_from_start(x, t, x_start)
 
+        elif self.objective == 'pred_v':
+            v = model_output
+            x_start = self.predict_start_from_v(x, t, v)
+            x_start = maybe_clip(x_start)
+            pred_noise = self.predict_noise_from_start(x, t, x_start)
+
         return ModelPrediction(pred_noise, x_start)
 
     def p_mean_variance(self, x, t, x_self_cond = None, clip_denoised = True):
@@ -603,14 +1110,29 @@ class GaussianDiffusion(nn.Module):
         model_mean, posterior_variance, posterior_log_variance = self.q_posterior(x_start = x_start, x_t = x, t = t)
         return model_mean, posterior_variance, posterior_log_variance, x_start
 
+    @property
+    def p_sample_step(self):
+        return scripted_fused_p_sample_step() if self.script_fused_step else fused_p_sample_step
+
     @torch.no_grad()
     def p_sample(self, x, t: int, x_self_cond = None, clip_denoised = True):
-        b, *_, device = *x.shape, x.device
         batched_times = torch.full((x.shape[0],), t, device = x.device, dtype = torch.long)
-        model_mean, _, model_log_variance, x_start = self.p_mean_variance(x = x, t = batched_times, x_self_cond = x_self_cond, clip_denoised = clip_denoised)
-        noise = torch.randn_like(x) if t > 0 else 0. # no noise if t == 0
-        pred_img = model_mean + (0.5 * model_log_variance).exp() * noise
-        return pred_img, x_start
+        coefs = self.schedule(batched_times, x.shape)
+        model_output = self.denoise_fn(x, batched_times, x_self_cond)
+        noise = torch.randn_like(x) if t > 0 else None # no noise if t == 0
+
+        return self.p_sample_step(
+            x,
+            model_output,
+            noise,
+            coefs.sqrt_recip_alphas_cumprod,
+            coefs.sqrt_recipm1_alphas_cumprod,
+            coefs.posterior_mean_coef1,
+            coefs.posterior_mean_coef2,
+            coefs.posterior_log_variance_clipped,
+            objective = self.objective,
+            clip_denoised = clip_denoised
+        )
 
     @torch.no_grad()
     def p_sample_loop(self, shape, img = None):
@@ -664,10 +1186,53 @@ class GaussianDiffusion(nn.Module):
         return img
 
     @torch.no_grad()
-    def sample(self, img = None, batch_size = 16):
+    def solver_sample(self, shape, img = None, sampler = 'dpmpp_2m', steps = 20, clip_denoised = True):
+        batch, device = shape[0], self.betas.device
+
+        img = torch.randn(shape, device = device) if img is None else img
+
+        x_start = None
+
+        def denoise_fn(x, time):
+            nonlocal x_start
+            time_cond = torch.full((batch,), time, device = device, dtype = torch.long)
+            self_cond = x_start if self.self_condition else None
+            _, x_start, *_ = self.model_predictions(x, time_cond, self_cond, clip_x_start = clip_denoised)
+            return x_start
+
+        img = SOLVERS[sampler](denoise_fn, img, self.alphas_cumprod, steps = steps)
+
+        img = unnormalize_to_zero_to_one(img.clamp(-1., 1.))
+        return img
+
+    @torch.no_grad()
+    def sample(self, img = None, batch_size = 16, sampler = None, sampling_timesteps = None):
+        """
+        sampler is one of 'ddpm', 'ddim', 'dpmpp_2m' (DPM-Solver++ 2M) or 'unipc', defaulting to ddim when sampling_timesteps < timesteps and ddpm otherwise
+        the multistep solvers default to 20 steps unless the diffusion was set up with fewer sampling_timesteps
+        """
         image_size, channels = self.image_size, self.channels
-        sample_fn = self.p_sample_loop if not self.is_ddim_sampling else self.ddim_sample
-        return sample_fn((batch_size, channels, image_size, image_size), img)
+        batch_size = img.shape[0] if exists(img) else batch_size
+        shape = (batch_size, channels, image_size, image_size)
+
+        sampler = default(sampler, 'ddim' if self.is_ddim_sampling else 'ddpm')
+
+        if sampler in SOLVERS:
+            steps = default(sampling_timesteps, self.sampling_timesteps if self.is_ddim_sampling else 20)
+            return self.solver_sample(shape, img, sampler = sampler, steps = steps)
+
+        return self.sampling_engine(shape, img, method = sampler, steps = sampling_timesteps)
+
+    @torch.no_grad()
+    def sample_until_stable(self, img = None, batch_size = 16, sampler = None, sampling_timesteps = None, tol = 1e-3, patience = 2, threshold = 0.5, min_alpha_cumprod = 0.5):
+        """
+        ddpm / ddim sampling of masks with per sample early exit once the thresholded prediction settles, see SamplingEngine.until_stable
+        returns the samples in [0, 1] and the number of denoising steps each took
+        """
+        batch_size = img.shape[0] if exists(img) else batch_size
+        shape = (batch_size, self.channels, self.image_size, self.image_size)
+        sampler = default(sampler, 'ddim' if self.is_ddim_sampling else 'ddpm')
+        return self.sampling_engine.until_stable(shape, img, method = sampler, steps = sampling_timesteps, tol = tol, patience = patience, threshold = threshold, min_alpha_cumprod = min_alpha_cumprod)
 
     @torch.no_grad()
     def interpolate(self, x1, x2, t = None, lam = 0.5):
@@ -688,9 +1253,10 @@ class GaussianDiffusion(nn.Module):
     def q_sample(self, x_start, t, noise=None):
         noise = default(noise, lambda: torch.randn_like(x_start))
 
+        coefs = self.schedule(t, x_start.shape)
         return (
-            extract(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start +
-            extract(self.sqrt_one_minus_alphas_cumprod, t, x_start.shape) * noise
+            coefs.sqrt_alphas_cumprod * x_start +
+            coefs.sqrt_one_minus_alphas_cumprod * noise
         )
 
     @property
@@ -726,12 +1292,15 @@ class GaussianDiffusion(nn.Module):
 
         # predict and take gradient step
 
-        model_out = self.model(x, t, x_self_cond)
+        model_out = self.run_model(self.model, x, t, x_self_cond)
 
         if self.objective == 'pred_noise':
             target = noise
         elif self.objective == 'pred_x0':
             target = x_start
+        elif self.objective == 'pred_v':
+            v = self.predict_v(x_start, t, noise)
+            target = v
         else:
             raise ValueError(f'unknown objective {self.objective}')
 
@@ -739,7 +1308,7 @@ class GaussianDiffusion(nn.Module):
         # loss = reduce(loss, 'b ... -> b (...)', 'mean')
         loss = self.loss_fn(model_out, target)
 
-        loss = loss * extract(self.p2_loss_weight, t, loss.shape)
+        loss = loss * self.schedule(t, loss.shape).p2_loss_weight
         return loss.mean()
 
     def forward(self, img, t, noise, *args, **kwargs):
@@ -0,0 +1,167 @@
+import os
+import json
+
+import numpy as np
+import onnxruntime as ort
+
+from tqdm.auto import tqdm
+
+# ddpm / ddim sampling of a unet exported by export_onnx.export_diffusion, on numpy and onnxruntime only
+# the schedule math mirrors model.GaussianDiffusion and cdiff.GaussianDiffusion
+
+class OnnxDiffusionSampler:
+    def __init__(
+        self,
+        path,
+        providers = ('CPUExecutionProvider',),
+        sess_options = None
+    ):
+        with open(os.path.splitext(path)[0] + '.json') as f:
+            config = json.load(f)
+
+        if sess_options is None:
+            sess_options = ort.SessionOptions()
+            sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        self.session = ort.InferenceSession(path, sess_options = sess_options, providers = list(providers))
+
+        # the exporter drops inputs the graph does not use, e.g. x_self_cond without self conditioning
+
+        self.input_names = {node.name for node in self.session.get_inputs()}
+
+        self.image_size = config['image_size']
+        self.channels = config['channels']
+        self.objective = config['objective']
+        self.num_timesteps = config['num_timesteps']
+        self.sampling_timesteps = config['sampling_timesteps']
+        self.ddim_sampling_eta = config['ddim_sampling_eta']
+        self.self_condition = config['self_condition']
+        self.num_classes = config['num_classes']
+
+        # the schedule is kept in float64 and cast per step, as the torch buffers are computed
+
+        self.alphas_cumprod = np.asarray(config['alphas_cumprod'], dtype = np.float64)
+        self.sqrt_alphas_cumprod = np.sqrt(self.alphas_cumprod)
+        self.sqrt_one_minus_alphas_cumprod = np.sqrt(1. - self.alphas_cumprod)
+        self.sqrt_recip_alphas_cumprod = np.asarray(config['sqrt_recip_alphas_cumprod'], dtype = np.float64)
+        self.sqrt_recipm1_alphas_cumprod = np.asarray(config['sqrt_recipm1_alphas_cumprod'], dtype = np.float64)
+        self.posterior_mean_coef1 = np.asarray(config['posterior_mean_coef1'], dtype = np.float64)
+        self.posterior_mean_coef2 = np.asarray(config['posterior_mean_coef2'], dtype = np.float64)
+        self.posterior_log_variance_clipped = np.asarray(config['posterior_log_variance_clipped'], dtype = np.float64)
+
+    @property
+    def is_conditional(self):
+        return self.num_classes is not None
+
+    def model_output(self, x, t, classes = None, cond_scale = 3., x_self_cond = None):
+        batch = x.shape[0]
+        inputs = dict(x = x, time = np.full((batch,), t, dtype = np.int64))
+
+        if self.is_conditional:
+            inputs.update(classes = classes, cond_scale = np.asarray(cond_scale, dtype = np.float32))
+        else:
+            inputs.update(x_self_cond = x_self_cond if x_self_cond is not None else np.zeros_like(x))
+
+        out, = self.session.run(['out'], {name: value for name, value in inputs.items() if name in self.input_names})
+        return out
+
+    def model_predictions(self, x, t, classes = None, cond_scale = 3., x_self_cond = None, clip_x_start = False):
+        """ (pred_noise, pred_x_start) at the integer timestep t, as GaussianDiffusion.model_predictions """
+        model_output = self.model_output(x, t, classes, cond_scale, x_self_cond)
+        maybe_clip = (lambda x: np.clip(x, -1., 1.)) if clip_x_start else (lambda x: x)
+
+        def noise_from_start(x_start):
+            return (self.sqrt_recip_alphas_cumprod[t] * x - x_start) / self.sqrt_recipm1_alphas_cumprod[t]
+
+        if self.objective == 'pred_noise':
+            pred_noise = model_output
+            x_start = maybe_clip(self.sqrt_recip_alphas_cumprod[t] * x - self.sqrt_recipm1_alphas_cumprod[t] * pred_noise)
+
+        elif self.objective == 'pred_x0':
+            x_start = maybe_clip(model_output)
+            pred_noise = noise_from_start(x_start)
+
+        elif self.objective == 'pred_v':
+            x_start = maybe_clip(self.sqrt_alphas_cumprod[t] * x - self.sqrt_one_minus_alphas_cumprod[t] * model_output)
+            pred_noise = noise_from_start(x_start)
+
+        else:
+            raise ValueError(f'unknown objective {self.objective}')
+
+        return pred_noise.astype(np.float32), x_start.astype(np.float32)
+
+    def p_sample_loop(self, img, classes = None, cond_scale = 3., rng = None):
+        x_start = None
+
+        for t in tqdm(reversed(range(0, self.num_timesteps)), desc = 'sampling loop time step', total = self.num_timesteps):
+            self_cond = x_start if self.self_condition else None
+            _, x_start = self.model_predictions(img, t, classes, cond_scale, self_cond, clip_x_start = True)
+
+            img = self.posterior_mean_coef1[t] * x_start + self.posterior_mean_coef2[t] * img
+
+            if t > 0:
+                img = img + np.exp(0.5 * self.posterior_log_variance_clipped[t]) * rng.standard_normal(img.shape)
+
+            img = img.astype(np.float32)
+
+        return img
+
+    def ddim_sample(self, img, classes = None, cond_scale = 3., rng = None, sampling_timesteps = None, clip_denoised = True):
+        sampling_timesteps, eta = sampling_timesteps or self.sampling_timesteps, self.ddim_sampling_eta
+
+        # the same grid as GaussianDiffusion.ddim_sample, torch.linspace(...).int() truncates towards zero like astype
+
+        times = np.linspace(-1, self.num_timesteps - 1, num = sampling_timesteps + 1, dtype = np.float32).astype(np.int64)
+        times = list(reversed(times.tolist()))
+        time_pairs = list(zip(times[:-1], times[1:]))
+
+        x_start = None
+
+        for time, time_next in tqdm(time_pairs, desc = 'sampling loop time step'):
+            self_cond = x_start if self.self_condition else None
+            pred_noise, x_start = self.model_predictions(img, time, classes, cond_scale, self_cond, clip_x_start = clip_denoised)
+
+            if time_next < 0:
+                img = x_start
+                continue
+
+            alpha = self.alphas_cumprod[time]
+            alpha_next = self.alphas_cumprod[time_next]
+
+            sigma = eta * np.sqrt((1 - alpha / alpha_next) * (1 - alpha_next) / (1 - alpha))
+            c = np.sqrt(1 - alpha_next - sigma ** 2)
+
+            img = x_start * np.sqrt(alpha_next) + c * pred_noise
+
+            if sigma > 0:
+                img = img + sigma * rng.standard_normal(img.shape)
+
+            img = img.astype(np.float32)
+
+        return img
+
+    def sample(self, batch_size = 16, classes = None, noise = None, cond_scale = 3., sampler = None, sampling_timesteps = None, seed = None):
+        """
+        samples in [0, 1], sampler is 'ddpm' or 'ddim', defaulting like GaussianDiffusion.sample
+        classes (an int array of the batch size) are required for a conditional export, noise overrides batch_size
+        """
+        rng = np.random.default_rng(seed)
+        sampling_timesteps = sampling_timesteps or self.sampling_timesteps
+        sampler = sampler or ('ddim' if sampling_timesteps < self.num_timesteps else 'ddpm')
+
+        if self.is_conditional:
+            assert classes is not None, 'a class conditional export needs classes to sample'
+            classes = np.asarray(classes, dtype = np.int64)
+            batch_size = classes.shape[0]
+
+        shape = (batch_size, self.channels, self.image_size, self.image_size)
+        img = rng.standard_normal(shape, dtype = np.float32) if noise is None else np.asarray(noise, dtype = np.float32)
+
+        if sampler == 'ddpm':
+            img = self.p_sample_loop(img, classes, cond_scale, rng = rng)
+        elif sampler == 'ddim':
+            img = self.ddim_sample(img, classes, cond_scale, rng = rng, sampling_timesteps = sampling_timesteps)
+        else:
+            raise ValueError(f'unknown sampler {sampler}, the onnx sampler supports ddpm and ddim')
+
+        return (img + 1) * 0.5
@@ -0,0 +1,250 @@
+import copy
+import time
+
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+import torch.ao.quantization as tq
+
+from argparse import ArgumentParser
+
+import model
+import cdiff
+from layers import WeightStandardizedConv2d
+
+# post training int8 quantization of the unets for cpu sampling
+# the 1x1 / 3x3 convs are statically quantized, with activation ranges calibrated on q_sample noised images over a spread of timesteps,
+# the linear layers are dynamically quantized, everything else (norms, attention, the 7x7 init and 4x4 downsample convs) stays fp32
+
+QUANTIZED_KERNEL_SIZES = ((1, 1), (3, 3))
+
+class QuantizedConv(nn.Module):
+    """ a conv run in int8 between fp32 activations, the (de)quantization stubs become the observed scale / zero point at convert """
+    def __init__(self, conv):
+        super().__init__()
+        self.quant = tq.QuantStub()
+        self.conv = conv
+        self.dequant = tq.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.conv(self.quant(x)))
+
+def standardized_conv(conv):
+    """ plain conv with the standardized weight of a WeightStandardizedConv2d, which is a constant once the weights are fixed """
+    plain = nn.Conv2d(
+        conv.in_channels,
+        conv.out_channels,
+        conv.kernel_size,
+        stride = conv.stride,
+        padding = conv.padding,
+        dilation = conv.dilation,
+        groups = conv.groups,
+        bias = conv.bias is not None
+    )
+
+    with torch.no_grad():
+        plain.weight.copy_(conv.standardized_weight(torch.float32))
+        if conv.bias is not None:
+            plain.bias.copy_(conv.bias)
+
+    return plain
+
+def wrap_convs(unet, qconfig):
+    """ swaps every 1x1 / 3x3 conv of the unet for a QuantizedConv with the given qconfig, in place """
+    for parent in list(unet.modules()):
+        for name, child in list(parent.named_children()):
+            if type(child) not in (nn.Conv2d, WeightStandardizedConv2d):
+                continue
+
+            if child.kernel_size not in QUANTIZED_KERNEL_SIZES:
+                continue
+
+            if isinstance(child, WeightStandardizedConv2d):
+                child = standardized_conv(child)
+
+            wrapped = QuantizedConv(child)
+            wrapped.qconfig = qconfig
+            setattr(parent, name, wrapped)
+
+    return unet
+
+def dynamic_linears(unet):
+    """
+    names of the linear layers to quantize dynamically, leaving out of cdiff
+    the resnet block mlps, whose time / class halves are sliced out of the fp32 weight (see cdiff.ResnetBlock.time_proj),
+    and the classes mlp, run once per sampling call on the class embeddings and on the 1d null class embedding
+    """
+    excluded = {
+        id(module.mlp[-1]) for module in unet.modules()
+        if isinstance(module, cdiff.ResnetBlock) and module.mlp is not None
+    }
+
+    if isinstance(unet, cdiff.Unet):
+        excluded |= {id(module) for module in unet.classes_mlp.modules()}
+
+    return {name for name, module in unet.named_modules() if isinstance(module, nn.Linear) and id(module) not in excluded}
+
+def calibration_timesteps(num_timesteps, num_steps):
+    """ timesteps evenly spread over [0, T), the activation ranges differ a lot between the noisy and the clean end """
+    return torch.linspace(0, num_timesteps - 1, steps = num_steps).round().long()
+
+@torch.no_grad()
+def calibrate(diffusion, images, classes = None, num_steps = 16, batch_size = 8, cond_scale = 3.):
+    """ runs the denoiser of the diffusion on q_sample noised images (in [0, 1]) at num_steps timesteps, through the sampling path """
+    is_conditional = isinstance(diffusion.model, cdiff.Unet)
+    assert not is_conditional or classes is not None, 'calibrating a class conditional unet needs the classes of the images'
+
+    for t in calibration_timesteps(diffusion.num_timesteps, num_steps).tolist():
+        for start in range(0, images.shape[0], batch_size):
+            x_start = model.normalize_to_neg_one_to_one(images[start:start + batch_size])
+            times = torch.full((x_start.shape[0],), t, dtype = torch.long, device = x_start.device)
+            x = diffusion.q_sample(x_start, times)
+
+            if is_conditional:
+                diffusion.model_predictions(x, times, classes[start:start + batch_size], cond_scale = cond_scale)
+            else:
+                diffusion.model_predictions(x, times)
+
+def quantize_diffusion(diffusion, images, classes = None, num_steps = 16, batch_size = 8, cond_scale = 3., engine = None):
+    """
+    int8 copy of a (cpu) model.GaussianDiffusion or cdiff.GaussianDiffusion, sampled with the usual sample()
+    images (and classes for cdiff) are the calibration set, noised with q_sample at num_steps timesteps
+    """
+    engine = engine or torch.backends.quantized.engine
+    torch.backends.quantized.engine = engine
+
+    quantized = copy.deepcopy(diffusion).cpu().eval()
+    unet = quantized.model
+
+    wrap_convs(unet, tq.get_default_qconfig(engine))
+    tq.prepare(unet, inplace = True)
+
+    calibrate(quantized, images.cpu(), classes.cpu() if classes is not None else None, num_steps = num_steps, batch_size = batch_size, cond_scale = cond_scale)
+
+    tq.convert(unet, inplace = True)
+    tq.quantize_dynamic(unet, dynamic_linears(unet), dtype = torch.qint8, inplace = True)
+
+    # the time cache was built from the fp32 weights during calibration
+
+    if unet.num_cached_timesteps is not None:
+        unet.cache_time_embeddings(unet.num_cached_timesteps)
+
+    return quantized
+
+def psnr(x, y, data_range = 1.):
+    return 10 * torch.log10(data_range ** 2 / F.mse_loss(x, y))
+
+@torch.no_grad()
+def quantization_report(diffusion, quantized, batch_size = 4, classes = None, sampler = 'ddim', sampling_timesteps = None, cond_scale = 3., repeats = 5, seed = 42):
+    """
+    sample quality drift of the int8 diffusion against the fp32 one, both sampled from the same noise (and the same ddim / ddpm noise),
+    and the time of one denoising step of each, at a mid schedule timestep
+    """
+    is_conditional = isinstance(diffusion.model, cdiff.Unet)
+    shape = (batch_size, diffusion.channels, diffusion.image_size, diffusion.image_size)
+
+    if is_conditional:
+        classes = classes if classes is not None else torch.arange(batch_size) % diffusion.model.classes_emb.num_embeddings
+        sample = lambda d, noise: d.sample(classes, noise, cond_scale = cond_scale, sampler = sampler, sampling_timesteps = sampling_timesteps)
+        step = lambda d, x, t: d.model_predictions(x, t, classes, cond_scale = cond_scale)
+    else:
+        sample = lambda d, noise: d.sample(noise, batch_size = batch_size, sampler = sampler, sampling_timesteps = sampling_timesteps)
+        step = lambda d, x, t: d.model_predictions(x, t)
+
+    samples = []
+    for d in (diffusion, quantized):
+        torch.manual_seed(seed)
+        samples.append(sample(d, torch.randn(shape)))
+
+    reference, int8 = samples
+
+    x = torch.randn(shape)
+    t = torch.full((batch_size,), diffusion.num_timesteps // 2, dtype = torch.long)
+
+    def step_time(d):
+        step(d, x, t)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            step(d, x, t)
+        return (time.perf_counter() - start) / repeats
+
+    fp32_step, int8_step = step_time(diffusion), step_time(quantized)
+
+    return dict(
+        mse = F.mse_loss(int8, reference).item(),
+        max_abs_diff = (int8 - reference).abs().max().item(),
+        psnr = psnr(int8, reference).item(),
+        fp32_step = fp32_step,
+        int8_step = int8_step,
+        speedup = fp32_step / int8_step,
+    )
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--ckpt", type=str, default=None, help="path to a lightning checkpoint or a GaussianDiffusion state dict, random weights otherwise")
+    parser.add_argument("--prefix", type=str, default='diffusion.', help="prefix of the diffusion inside a lightning checkpoint")
+    parser.add_argument("--timesteps", type=int, default=1000, help="timesteps the model was trained with")
+    parser.add_argument("--sampling_timesteps", type=int, default=20, help="ddim sampling steps of the drift report")
+    parser.add_argument("--shape", type=int, default=256, help="spatial size of the tensor")
+    parser.add_argument("--num_classes", type=int, default=None, help="number of classes, quantizes a cdiff unet")
+    parser.add_argument("--objective", type=str, default='pred_noise', help="pred_noise, pred_x0 or pred_v")
+    parser.add_argument("--calibration_samples", type=int, default=16, help="calibration images")
+    parser.add_argument("--calibration_steps", type=int, default=16, help="calibration timesteps")
+    parser.add_argument("--batch_size", type=int, default=4, help="batch size of the report")
+    parser.add_argument("--output", type=str, default=None, help="path to save the quantized GaussianDiffusion (torch.save of the module)")
+    hparams = parser.parse_args()
+
+    if hparams.num_classes is not None:
+        diffusion = cdiff.GaussianDiffusion(
+            cdiff.Unet(
+                dim=64,
+                dim_mults=(1, 2, 4, 8),
+                channels=1,
+                num_classes=hparams.num_classes,
+            ),
+            image_size=hparams.shape,
+            timesteps=hparams.timesteps,
+            sampling_timesteps=hparams.sampling_timesteps,
+            objective=hparams.objective,
+        )
+    else:
+        diffusion = model.GaussianDiffusion(
+            model.Unet(
+                dim=64,
+                dim_mults=(1, 2, 4, 8),
+                channels=1,
+            ),
+            image_size=hparams.shape,
+            timesteps=hparams.timesteps,
+            sampling_timesteps=hparams.sampling_timesteps,
+            objective=hparams.objective,
+        )
+
+    if hparams.ckpt is not None:
+        state_dict = torch.load(hparams.ckpt, map_location = 'cpu')
+        if 'state_dict' in state_dict:
+            state_dict = {key[len(hparams.prefix):]: value for key, value in state_dict['state_dict'].items() if key.startswith(hparams.prefix)}
+        diffusion.load_state_dict(state_dict)
+
+    diffusion.eval()
+
+    # without a dataset at hand, calibrate on the fp32 model's own samples
+
+    classes = torch.arange(hparams.calibration_samples) % hparams.num_classes if hparams.num_classes is not None else None
+
+    with torch.no_grad():
+        if classes is not None:
+            images = diffusion.sample(classes, sampler = 'ddim')
+        else:
+            images = diffusion.sample(batch_size = hparams.calibration_samples, sampler = 'ddim')
+
+    quantized = quantize_diffusion(diffusion, images, classes, num_steps = hparams.calibration_steps)
+
+    report = quantization_report(diffusion, quantized, batch_size = hparams.batch_size)
+    for key, value in report.items():
+        print(f'{key}: {value:.6g}')
+
+    if hparams.output is not None:
+        torch.save(quantized, hparams.output)
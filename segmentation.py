@@ -1,5 +1,4 @@
 import os
-import glob
 
 from typing import Optional, Union, List, Dict, Sequence, Callable
 import torch
@@ -44,6 +43,9 @@ from monai.transforms import (
     ToTensord,
 )
 
+from transform_cache import CachedTransform
+from file_index import index_files, pair_files
+
 class PairedAndUnpairedDataset(Dataset, Randomizable):
     def __init__(
         self,
@@ -52,6 +54,7 @@ class PairedAndUnpairedDataset(Dataset, Randomizable):
         transform: Optional[Callable] = None,
         length: Optional[Callable] = None, 
         batch_size: int = 32, 
+        pairs: Optional[Sequence] = None,
 
     ) -> None:
         self.keys = keys
@@ -59,10 +62,14 @@ class PairedAndUnpairedDataset(Dataset, Randomizable):
         self.length = length
         self.batch_size = batch_size
         self.transform = transform
+        self.pairs = pairs  # (image, label) index pairs of file_index.pair_files, None pairs the lists by position
 
     def __len__(self) -> int:
         if self.length is None:
-            return min((len(dataset) for dataset in self.data))
+            sizes = [len(dataset) for dataset in self.data]
+            if self.pairs is not None:
+                sizes[:2] = [len(self.pairs)] * 2
+            return min(sizes)
         else: 
             return self.length
 
@@ -70,9 +77,14 @@ class PairedAndUnpairedDataset(Dataset, Randomizable):
         data = {}
         self.R.seed(index)
         
-        rand_idx = self.R.randint(0, len(self.data[0])) 
-        data[self.keys[0]] = self.data[0][rand_idx] # image
-        data[self.keys[1]] = self.data[1][rand_idx] # label
+        if self.pairs is not None:
+            rand_idx = self.R.randint(0, len(self.pairs))
+            image_idx, label_idx = self.pairs[rand_idx]
+        else:
+            rand_idx = self.R.randint(0, len(self.data[0]))
+            image_idx = label_idx = rand_idx
+        data[self.keys[0]] = self.data[0][image_idx] # image
+        data[self.keys[1]] = self.data[1][label_idx] # label
         
         rand_idy = self.R.randint(0, len(self.data[2])) 
         data[self.keys[2]] = self.data[2][rand_idy] # unsup
@@ -103,6 +115,9 @@ class PairedAndUnpairedDataModule(LightningDataModule):
         train_samples: int = 4000,
         val_samples: int = 800,
         test_samples: int = 800,
+        cache_dir: Optional[str] = None,
+        cache_size_gb: float = 32.,
+        shm_size_gb: float = 0.,
     ):
         super().__init__()
 
@@ -124,12 +139,14 @@ class PairedAndUnpairedDataModule(LightningDataModule):
         self.train_samples = train_samples
         self.val_samples = val_samples
         self.test_samples = test_samples
+        self.cache_dir = cache_dir
+        self.cache_size_gb = cache_size_gb
+        self.shm_size_gb = shm_size_gb
 
         # self.setup()
         def glob_files(folders: List[str]=None, extension: str='*.nii.gz'):
             assert folders is not None
-            paths = [glob.glob(os.path.join(folder, extension), recursive = True) for folder in folders]
-            files = sorted([item for sublist in paths for item in sublist])
+            files = index_files(folders, extension)
             print(len(files))
             print(files[:1])
             return files
@@ -149,6 +166,16 @@ class PairedAndUnpairedDataModule(LightningDataModule):
         self.test_usource_files = glob_files(folders=test_usource_dirs, extension='**/*.png')
         self.test_utarget_files = glob_files(folders=test_utarget_dirs, extension='**/*.png')
 
+        # images and labels matched once by relative path, mismatched folders fail here rather than train on wrong pairs
+        self.train_pairs = pair_files(self.train_ssource_files, self.train_starget_files, train_ssource_dirs, train_starget_dirs)
+        self.val_pairs = pair_files(self.val_ssource_files, self.val_starget_files, val_ssource_dirs, val_starget_dirs)
+
+    def cached_transform(self, transform):
+        # with a cache_dir (and / or shared memory), the deterministic prefix (up to the flip) is decoded and resized once
+        if self.cache_dir is None and self.shm_size_gb <= 0:
+            return transform
+        return CachedTransform(transform, self.cache_dir, max_bytes=int(self.cache_size_gb * 2 ** 30), shm_bytes=int(self.shm_size_gb * 2 ** 30))
+
     def setup(self, seed: int=42, stage: Optional[str]=None):
         # make assignments here (val/train/test split)
         # called on every process in DDP
@@ -162,9 +189,9 @@ class PairedAndUnpairedDataModule(LightningDataModule):
                 ScaleIntensityRanged(keys=["target", "labels"], a_min=0, a_max=128, b_min=0, b_max=1, clip=True),
                 ScaleIntensityd(keys=["source", "target", "images", "labels"], minv=0.0, maxv=1.0,),
                 HistogramNormalized(keys=["source", "images"], min=0.0, max=1.0,), # type: ignore
-                RandFlipd(keys=["source", "target", "images", "labels"], prob=0.5, spatial_axis=0),
                 Resized(keys=["source", "target", "images", "labels"], spatial_size=256, size_mode="longest", mode=["area", "nearest", "area", "nearest"]),
                 DivisiblePadd(keys=["source", "target", "images", "labels"], k=256, mode="constant", constant_values=0.0),
+                RandFlipd(keys=["source", "target", "images", "labels"], prob=0.5, spatial_axis=0),
                 ToTensord(keys=["source", "target", "images", "labels"],),
             ]
         )
@@ -172,9 +199,10 @@ class PairedAndUnpairedDataModule(LightningDataModule):
         self.train_datasets = PairedAndUnpairedDataset(
             keys=["source", "target", "images", "labels"],
             data=[self.train_ssource_files, self.train_starget_files, self.train_usource_files, self.train_utarget_files],
-            transform=self.train_transforms,
+            transform=self.cached_transform(self.train_transforms),
             length=self.train_samples, # type: ignore
             batch_size=self.batch_size,
+            pairs=self.train_pairs,
         )
 
         self.train_loader = DataLoader(
@@ -194,9 +222,9 @@ class PairedAndUnpairedDataModule(LightningDataModule):
                 ScaleIntensityRanged(keys=["target", "labels"], a_min=0, a_max=128, b_min=0, b_max=1, clip=True),
                 ScaleIntensityd(keys=["source", "target", "images", "labels"], minv=0.0, maxv=1.0,),
                 HistogramNormalized(keys=["source", "images"], min=0.0, max=1.0,),  # type: ignore
-                RandFlipd(keys=["source", "target", "images", "labels"], prob=0.5, spatial_axis=0),
                 Resized(keys=["source", "target", "images", "labels"], spatial_size=256, size_mode="longest", mode=["area", "nearest", "area", "nearest"]),
                 DivisiblePadd(keys=["source", "target", "images", "labels"], k=256, mode="constant", constant_values=0.0),
+                RandFlipd(keys=["source", "target", "images", "labels"], prob=0.5, spatial_axis=0),
                 ToTensord(keys=["source", "target", "images", "labels"],),
             ]
         )
@@ -204,9 +232,10 @@ class PairedAndUnpairedDataModule(LightningDataModule):
         self.val_datasets = PairedAndUnpairedDataset(
             keys=["source", "target", "images", "labels"],
             data=[self.val_ssource_files, self.val_starget_files, self.val_usource_files, self.val_utarget_files],
-            transform=self.val_transforms,
+            transform=self.cached_transform(self.val_transforms),
             length=self.val_samples,  # type: ignore
             batch_size=self.batch_size,
+            pairs=self.val_pairs,
         )
         
         self.val_loader = DataLoader(
@@ -389,6 +418,9 @@ if __name__ == "__main__":
     
     parser.add_argument("--logsdir", type=str, default='logs', help="logging directory")
     parser.add_argument("--datadir", type=str, default='data', help="data directory")
+    parser.add_argument("--cache_dir", type=str, default=None, help="disk cache of the preprocessed pngs, off when unset")
+    parser.add_argument("--cache_size_gb", type=float, default=32., help="size bound of the disk cache")
+    parser.add_argument("--shm_size_gb", type=float, default=0., help="host wide shared memory cache in front of the disk cache, off at 0")
     
     parser.add_argument("--epochs", type=int, default=31, help="number of epochs")
     parser.add_argument("--lr", type=float, default=1e-4, help="adam: learning rate")
@@ -479,6 +511,9 @@ if __name__ == "__main__":
         test_samples = hparams.test_samples,
         batch_size = hparams.batch_size, 
         shape = hparams.shape,
+        cache_dir = hparams.cache_dir,
+        cache_size_gb = hparams.cache_size_gb,
+        shm_size_gb = hparams.shm_size_gb,
         # keys = ["source", "target", "images", "labels"]
     )
 
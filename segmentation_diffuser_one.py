@@ -1,5 +1,4 @@
 import os
-import glob
 
 from typing import Optional, Union, List, Dict, Sequence, Callable
 import torch
@@ -48,6 +47,9 @@ from monai.transforms import (
 # from data import CustomDataModule
 # from cdiff import *
 from diffusers import UNet2DModel, DDPMScheduler
+
+from file_index import index_files, pair_files
+
 class ClassConditionedUNet(nn.Module):
     def __init__(self, shape= 256, num_classes=2, class_emb_size=2):
         super().__init__()
@@ -104,6 +106,7 @@ class PairedAndUnsupervisedDataset(monai.data.Dataset, monai.transforms.Randomiz
         transform: Optional[Callable] = None,
         length: Optional[Callable] = None, 
         batch_size: int = 32, 
+        pairs: Optional[Sequence] = None,
 
     ) -> None:
         self.keys = keys
@@ -111,10 +114,14 @@ class PairedAndUnsupervisedDataset(monai.data.Dataset, monai.transforms.Randomiz
         self.length = length
         self.batch_size = batch_size
         self.transform = transform
+        self.pairs = pairs  # (image, label) index pairs of file_index.pair_files, None pairs the lists by position
 
     def __len__(self) -> int:
         if self.length is None:
-            return min((len(dataset) for dataset in self.data))
+            sizes = [len(dataset) for dataset in self.data]
+            if self.pairs is not None:
+                sizes[:2] = [len(self.pairs)] * 2
+            return min(sizes)
         else: 
             return self.length
 
@@ -124,9 +131,14 @@ class PairedAndUnsupervisedDataset(monai.data.Dataset, monai.transforms.Randomiz
         # for key, dataset in zip(self.keys, self.data):
         #     rand_idx = self.R.randint(0, len(dataset)) 
         #     data[key] = dataset[rand_idx]
-        rand_idx = self.R.randint(0, len(self.data[0])) 
-        data[self.keys[0]] = self.data[0][rand_idx] # image
-        data[self.keys[1]] = self.data[1][rand_idx] # label
+        if self.pairs is not None:
+            rand_idx = self.R.randint(0, len(self.pairs))
+            image_idx, label_idx = self.pairs[rand_idx]
+        else:
+            rand_idx = self.R.randint(0, len(self.data[0]))
+            image_idx = label_idx = rand_idx
+        data[self.keys[0]] = self.data[0][image_idx] # image
+        data[self.keys[1]] = self.data[1][label_idx] # label
         rand_idy = self.R.randint(0, len(self.data[2])) 
         data[self.keys[2]] = self.data[2][rand_idy] # unsup
 
@@ -173,8 +185,7 @@ class PairedAndUnsupervisedDataModule(LightningDataModule):
         # self.setup()
         def glob_files(folders: str=None, extension: str='*.nii.gz'):
             assert folders is not None
-            paths = [glob.glob(os.path.join(folder, extension), recursive = True) for folder in folders]
-            files = sorted([item for sublist in paths for item in sublist])
+            files = index_files(folders, extension)
             print(len(files))
             print(files[:1])
             return files
@@ -189,6 +200,9 @@ class PairedAndUnsupervisedDataModule(LightningDataModule):
         self.test_label_files = glob_files(folders=test_label_dirs, extension='**/*.png')
         self.test_unsup_files = glob_files(folders=test_unsup_dirs, extension='**/*.png')
 
+        # images and labels matched once by relative path, mismatched folders fail here rather than train on wrong pairs
+        self.train_pairs = pair_files(self.train_image_files, self.train_label_files, train_image_dirs, train_label_dirs)
+        self.val_pairs = pair_files(self.val_image_files, self.val_label_files, val_image_dirs, val_label_dirs)
 
     def setup(self, seed: int=42, stage: Optional[str]=None):
         # make assignments here (val/train/test split)
@@ -219,6 +233,7 @@ class PairedAndUnsupervisedDataModule(LightningDataModule):
             transform=self.train_transforms,
             length=self.train_samples,
             batch_size=self.batch_size,
+            pairs=self.train_pairs,
         )
 
         self.train_loader = DataLoader(
@@ -251,6 +266,7 @@ class PairedAndUnsupervisedDataModule(LightningDataModule):
             transform=self.val_transforms,
             length=self.val_samples,
             batch_size=self.batch_size,
+            pairs=self.val_pairs,
         )
         
         self.val_loader = DataLoader(
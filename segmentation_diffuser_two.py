@@ -1,5 +1,4 @@
 import os
-import glob
 
 from typing import Optional, Union, List, Dict, Sequence, Callable
 import torch
@@ -48,6 +47,9 @@ from monai.transforms import (
     ToTensord,
 )
 
+from transform_cache import CachedTransform
+from file_index import index_files, pair_files
+
 # from data import CustomDataModule
 # from cdiff import *
 from diffusers import UNet2DModel, DDPMScheduler
@@ -61,16 +63,21 @@ class PairedAndUnsupervisedDataset(monai.data.Dataset, monai.transforms.Randomiz
         transform: Optional[Callable] = None,
         length: Optional[Callable] = None,
         batch_size: int = 32,
+        pairs: Optional[Sequence] = None,
     ) -> None:
         self.keys = keys
         self.data = data
         self.length = length
         self.batch_size = batch_size
         self.transform = transform
+        self.pairs = pairs  # (image, label) index pairs of file_index.pair_files, None pairs the lists by position
 
     def __len__(self) -> int:
         if self.length is None:
-            return min((len(dataset) for dataset in self.data))
+            sizes = [len(dataset) for dataset in self.data]
+            if self.pairs is not None:
+                sizes[:2] = [len(self.pairs)] * 2
+            return min(sizes)
         else:
             return self.length
 
@@ -80,9 +87,14 @@ class PairedAndUnsupervisedDataset(monai.data.Dataset, monai.transforms.Randomiz
         # for key, dataset in zip(self.keys, self.data):
         #     rand_idx = self.R.randint(0, len(dataset))
         #     data[key] = dataset[rand_idx]
-        rand_idx = self.R.randint(0, len(self.data[0]))
-        data[self.keys[0]] = self.data[0][rand_idx]  # image
-        data[self.keys[1]] = self.data[1][rand_idx]  # label
+        if self.pairs is not None:
+            rand_idx = self.R.randint(0, len(self.pairs))
+            image_idx, label_idx = self.pairs[rand_idx]
+        else:
+            rand_idx = self.R.randint(0, len(self.data[0]))
+            image_idx = label_idx = rand_idx
+        data[self.keys[0]] = self.data[0][image_idx]  # image
+        data[self.keys[1]] = self.data[1][label_idx]  # label
         rand_idy = self.R.randint(0, len(self.data[2]))
         data[self.keys[2]] = self.data[2][rand_idy]  # unsup
 
@@ -109,6 +121,9 @@ class PairedAndUnsupervisedDataModule(LightningDataModule):
         train_samples: int = 4000,
         val_samples: int = 800,
         test_samples: int = 800,
+        cache_dir: Optional[str] = None,
+        cache_size_gb: float = 32.0,
+        shm_size_gb: float = 0.0,
     ):
         super().__init__()
 
@@ -127,15 +142,14 @@ class PairedAndUnsupervisedDataModule(LightningDataModule):
         self.train_samples = train_samples
         self.val_samples = val_samples
         self.test_samples = test_samples
+        self.cache_dir = cache_dir
+        self.cache_size_gb = cache_size_gb
+        self.shm_size_gb = shm_size_gb
 
         # self.setup()
         def glob_files(folders: str = None, extension: str = "*.nii.gz"):
             assert folders is not None
-            paths = [
-                glob.glob(os.path.join(folder, extension), recursive=True)
-                for folder in folders
-            ]
-            files = sorted([item for sublist in paths for item in sublist])
+            files = index_files(folders, extension)
             print(len(files))
             print(files[:1])
             return files
@@ -162,6 +176,28 @@ class PairedAndUnsupervisedDataModule(LightningDataModule):
             folders=test_unsup_dirs, extension="**/*.png"
         )
 
+        # images and labels matched once by relative path, mismatched folders fail here rather than train on wrong pairs
+        self.train_pairs = pair_files(
+            self.train_image_files,
+            self.train_label_files,
+            train_image_dirs,
+            train_label_dirs,
+        )
+        self.val_pairs = pair_files(
+            self.val_image_files, self.val_label_files, val_image_dirs, val_label_dirs
+        )
+
+    def cached_transform(self, transform):
+        # with a cache_dir (and / or shared memory), the deterministic prefix (up to the flip) is decoded and resized once
+        if self.cache_dir is None and self.shm_size_gb <= 0:
+            return transform
+        return CachedTransform(
+            transform,
+            self.cache_dir,
+            max_bytes=int(self.cache_size_gb * 2**30),
+            shm_bytes=int(self.shm_size_gb * 2**30),
+        )
+
     def setup(self, seed: int = 42, stage: Optional[str] = None):
         # make assignments here (val/train/test split)
         # called on every process in DDP
@@ -187,7 +223,6 @@ class PairedAndUnsupervisedDataModule(LightningDataModule):
                     max=1.0,
                 ),
                 # RandZoomd(keys=["image", "label", "unsup"], prob=1.0, min_zoom=0.9, max_zoom=1.1, padding_mode='constant', mode=["area", "nearest", "area"]),
-                RandFlipd(keys=["image", "label", "unsup"], prob=0.5, spatial_axis=0),
                 # RandAffined(keys=["image", "label", "unsup"], prob=1.0, rotate_range=0.1, translate_range=10, scale_range=0.01, padding_mode='zeros', mode=["bilinear", "nearest", "bilinear"]),
                 Resized(
                     keys=["image", "label", "unsup"],
@@ -201,6 +236,7 @@ class PairedAndUnsupervisedDataModule(LightningDataModule):
                     mode="constant",
                     constant_values=0,
                 ),
+                RandFlipd(keys=["image", "label", "unsup"], prob=0.5, spatial_axis=0),
                 ToTensord(
                     keys=["image", "label", "unsup"],
                 ),
@@ -214,9 +250,10 @@ class PairedAndUnsupervisedDataModule(LightningDataModule):
                 self.train_label_files,
                 self.train_unsup_files,
             ],
-            transform=self.train_transforms,
+            transform=self.cached_transform(self.train_transforms),
             length=self.train_samples,
             batch_size=self.batch_size,
+            pairs=self.train_pairs,
         )
 
         self.train_loader = DataLoader(
@@ -268,9 +305,10 @@ class PairedAndUnsupervisedDataModule(LightningDataModule):
         self.val_datasets = PairedAndUnsupervisedDataset(
             keys=["image", "label", "unsup"],
             data=[self.val_image_files, self.val_label_files, self.val_unsup_files],
-            transform=self.val_transforms,
+            transform=self.cached_transform(self.val_transforms),
             length=self.val_samples,
             batch_size=self.batch_size,
+            pairs=self.val_pairs,
         )
 
         self.val_loader = DataLoader(
@@ -592,6 +630,21 @@ if __name__ == "__main__":
 
     parser.add_argument("--logsdir", type=str, default="logs", help="logging directory")
     parser.add_argument("--datadir", type=str, default="data", help="data directory")
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="disk cache of the preprocessed pngs, off when unset",
+    )
+    parser.add_argument(
+        "--cache_size_gb", type=float, default=32.0, help="size bound of the disk cache"
+    )
+    parser.add_argument(
+        "--shm_size_gb",
+        type=float,
+        default=0.0,
+        help="host wide shared memory cache in front of the disk cache, off at 0",
+    )
 
     parser.add_argument("--epochs", type=int, default=31, help="number of epochs")
     parser.add_argument("--lr", type=float, default=1e-4, help="adam: learning rate")
@@ -671,6 +724,9 @@ if __name__ == "__main__":
         test_samples=hparams.test_samples,
         batch_size=hparams.batch_size,
         shape=hparams.shape,
+        cache_dir=hparams.cache_dir,
+        cache_size_gb=hparams.cache_size_gb,
+        shm_size_gb=hparams.shm_size_gb,
         # keys = ["image", "label", "unsup"]
     )
 
@@ -1,5 +1,4 @@
 import os
-import glob
 
 from typing import Optional, Union, List, Dict, Sequence, Callable
 import torch
@@ -42,6 +41,7 @@ from monai.transforms import (
 )
 # from data import CustomDataModule
 from model import *
+from file_index import index_files, pair_files
 
 class PairedAndUnsupervisedDataset(monai.data.Dataset, monai.transforms.Randomizable):
     def __init__(
@@ -51,6 +51,7 @@ class PairedAndUnsupervisedDataset(monai.data.Dataset, monai.transforms.Randomiz
         transform: Optional[Callable] = None,
         length: Optional[Callable] = None, 
         batch_size: int = 32, 
+        pairs: Optional[Sequence] = None,
 
     ) -> None:
         self.keys = keys
@@ -58,10 +59,14 @@ class PairedAndUnsupervisedDataset(monai.data.Dataset, monai.transforms.Randomiz
         self.length = length
         self.batch_size = batch_size
         self.transform = transform
+        self.pairs = pairs  # (image, label) index pairs of file_index.pair_files, None pairs the lists by position
 
     def __len__(self) -> int:
         if self.length is None:
-            return min((len(dataset) for dataset in self.data))
+            sizes = [len(dataset) for dataset in self.data]
+            if self.pairs is not None:
+                sizes[:2] = [len(self.pairs)] * 2
+            return min(sizes)
         else: 
             return self.length
 
@@ -71,9 +76,14 @@ class PairedAndUnsupervisedDataset(monai.data.Dataset, monai.transforms.Randomiz
         # for key, dataset in zip(self.keys, self.data):
         #     rand_idx = self.R.randint(0, len(dataset)) 
         #     data[key] = dataset[rand_idx]
-        rand_idx = self.R.randint(0, len(self.data[0])) 
-        data[self.keys[0]] = self.data[0][rand_idx] # image
-        data[self.keys[1]] = self.data[1][rand_idx] # label
+        if self.pairs is not None:
+            rand_idx = self.R.randint(0, len(self.pairs))
+            image_idx, label_idx = self.pairs[rand_idx]
+        else:
+            rand_idx = self.R.randint(0, len(self.data[0]))
+            image_idx = label_idx = rand_idx
+        data[self.keys[0]] = self.data[0][image_idx] # image
+        data[self.keys[1]] = self.data[1][label_idx] # label
         rand_idy = self.R.randint(0, len(self.data[2])) 
         data[self.keys[2]] = self.data[2][rand_idy] # unsup
 
@@ -120,8 +130,7 @@ class PairedAndUnsupervisedDataModule(LightningDataModule):
         # self.setup()
         def glob_files(folders: str=None, extension: str='*.nii.gz'):
             assert folders is not None
-            paths = [glob.glob(os.path.join(folder, extension), recursive = True) for folder in folders]
-            files = sorted([item for sublist in paths for item in sublist])
+            files = index_files(folders, extension)
             print(len(files))
             print(files[:1])
             return files
@@ -136,6 +145,9 @@ class PairedAndUnsupervisedDataModule(LightningDataModule):
         self.test_label_files = glob_files(folders=test_label_dirs, extension='**/*.png')
         self.test_unsup_files = glob_files(folders=test_unsup_dirs, extension='**/*.png')
 
+        # images and labels matched once by relative path, mismatched folders fail here rather than train on wrong pairs
+        self.train_pairs = pair_files(self.train_image_files, self.train_label_files, train_image_dirs, train_label_dirs)
+        self.val_pairs = pair_files(self.val_image_files, self.val_label_files, val_image_dirs, val_label_dirs)
 
     def setup(self, seed: int=42, stage: Optional[str]=None):
         # make assignments here (val/train/test split)
@@ -165,6 +177,7 @@ class PairedAndUnsupervisedDataModule(LightningDataModule):
             transform=self.train_transforms,
             length=self.train_samples,
             batch_size=self.batch_size,
+            pairs=self.train_pairs,
         )
 
         self.train_loader = DataLoader(
@@ -197,6 +210,7 @@ class PairedAndUnsupervisedDataModule(LightningDataModule):
             transform=self.val_transforms,
             length=self.val_samples,
             batch_size=self.batch_size,
+            pairs=self.val_pairs,
         )
         
         self.val_loader = DataLoader(
@@ -216,16 +230,21 @@ class DDMMLightningModule(LightningModule):
         self.weight_decay = hparams.weight_decay
         self.num_timesteps = hparams.timesteps
         self.batch_size = hparams.batch_size
+        self.early_exit = hparams.early_exit
         model_image = Unet(
             dim=64,
             dim_mults=(1, 2, 4, 8),
             channels=1,
+            checkpoint_levels=hparams.checkpoint_levels,
+            fused_blocks=hparams.fused_blocks,
         )
 
         model_label = Unet(
             dim=64,
             dim_mults=(1, 2, 4, 8),
             channels=1,
+            checkpoint_levels=hparams.checkpoint_levels,
+            fused_blocks=hparams.fused_blocks,
         )
 
         self.diffusion_image = GaussianDiffusion(
@@ -278,7 +297,12 @@ class DDMMLightningModule(LightningModule):
         if batch_idx==0:
             noise_samples = torch.randn_like(unsup)
             image_samples = self.diffusion_image.sample(batch_size=self.batch_size, img=noise_samples)
-            label_samples = self.diffusion_label.sample(batch_size=self.batch_size, img=noise_samples)
+            if self.early_exit:
+                # each mask stops denoising once its thresholded prediction settles
+                label_samples, label_steps = self.diffusion_label.sample_until_stable(batch_size=self.batch_size, img=noise_samples)
+                self.log(f'{stage}_label_sampling_steps', label_steps.float().mean(), on_step=False, on_epoch=True, logger=True, sync_dist=True, batch_size=self.batch_size)
+            else:
+                label_samples = self.diffusion_label.sample(batch_size=self.batch_size, img=noise_samples)
             viz2d = torch.cat([image, label, image_samples, label_samples], dim=-1).transpose(2, 3)
             grid = torchvision.utils.make_grid(viz2d, normalize=False, scale_each=False, nrow=8, padding=0)
             tensorboard = self.logger.experiment
@@ -323,6 +347,9 @@ if __name__ == "__main__":
     parser.add_argument("--seed", type=int, default=42)
     parser.add_argument("--timesteps", type=int, default=100, help="timesteps")
     parser.add_argument("--batch_size", type=int, default=16, help="batch size")
+    parser.add_argument("--checkpoint_levels", type=int, nargs="*", default=[], help="unet levels to activation checkpoint, 0 is the highest resolution")
+    parser.add_argument("--fused_blocks", action="store_true", help="fused group norm, scale / shift and silu in the unet blocks when sampling")
+    parser.add_argument("--early_exit", action="store_true", help="stop sampling each label mask once its thresholded prediction settles")
     parser.add_argument("--shape", type=int, default=256, help="spatial size of the tensor")
     parser.add_argument("--train_samples", type=int, default=4000, help="training samples")
     parser.add_argument("--val_samples", type=int, default=800, help="validation samples")
@@ -337,6 +364,8 @@ if __name__ == "__main__":
     parser.add_argument("--weight_decay", type=float, default=1e-4, help="Weight decay")
     
     parser = Trainer.add_argparse_args(parser)
+    # fp16 autocast on gpu by default, --precision bf16 for bfloat16 autocast on cpu (or ampere+ gpus)
+    parser.set_defaults(precision=16)
     
     # Collect the hyper parameters
     hparams = parser.parse_args()
@@ -440,7 +469,7 @@ if __name__ == "__main__":
         ],
         # accumulate_grad_batches=4, 
         strategy="fsdp", #"fsdp", #"ddp_sharded", #"horovod", #"deepspeed", #"ddp_sharded",
-        precision=16,  #if hparams.use_amp else 32,
+        precision=hparams.precision,  #if hparams.use_amp else 32,
         # amp_backend='apex',
         # amp_level='O1', # see https://nvidia.github.io/apex/amp.html#opt-levels
         # stochastic_weight_avg=True,
@@ -0,0 +1,179 @@
+import os
+import json
+import bisect
+
+import numpy as np
+import torch
+
+from typing import Dict, List, Optional, Sequence
+
+from argparse import ArgumentParser
+
+from tqdm.auto import tqdm
+
+from file_index import index_files
+
+import monai
+from monai.transforms import (
+    Compose,
+    DivisiblePadd,
+    HistogramNormalized,
+    LoadImaged,
+    Resized,
+    ScaleIntensityd,
+)
+
+# preprocessed, memory mapped tensor shards of the png datasets
+# pack_shards runs the deterministic prefix of the loaders (decode, rescale, histogram normalization, resize, pad) once, offline,
+# and stores its [1, shape, shape] outputs as uint8 or float16 .npy shards next to an index.json,
+# ShardDataset reads them back through np.load(mmap_mode = 'r'), a page cache hit per sample instead of a png decode
+
+INDEX_FILE = 'index.json'
+SHARD_DTYPES = ('uint8', 'float16')
+
+def preprocess_transforms(keys: Sequence[str], shape: int = 256, histogram_normalize: bool = True, mode: Optional[Sequence[str]] = None) -> List:
+    """ the deterministic load / rescale / (histogram normalize) / resize / pad prefix of the loaders, what the shards store """
+    return [
+        LoadImaged(keys=keys, ensure_channel_first=True),
+        ScaleIntensityd(keys=keys, minv=0.0, maxv=1.0,),
+        *([HistogramNormalized(keys=keys, min=0.0, max=1.0,)] if histogram_normalize else []),
+        Resized(keys=keys, spatial_size=shape, size_mode="longest", mode=mode or ["area"] * len(keys)),
+        DivisiblePadd(keys=keys, k=shape, mode="constant", constant_values=0),
+    ]
+
+def encode(sample, dtype: str):
+    """ a [0, 1] sample as stored, uint8 rounds it to 1 / 255 steps """
+    sample = np.asarray(sample, dtype=np.float32)
+    if dtype == 'uint8':
+        return np.clip(np.rint(sample * 255.), 0, 255).astype(np.uint8)
+    return sample.astype(np.float16)
+
+def pack_shards(
+    items: Sequence[Dict[str, str]],
+    directory: str,
+    transform,
+    shape: int = 256,
+    dtype: str = 'uint8',
+    shard_size: int = 1024,
+    num_workers: int = 8,
+) -> str:
+    """
+    runs the (deterministic) transform over items, dicts of key -> png path, and writes one [n, 1, shape, shape] .npy file
+    per key and shard of at most shard_size samples into directory, keys of the same item sharing their position
+    returns the path of the index, written last so an interrupted packing leaves no index behind
+    """
+    assert dtype in SHARD_DTYPES, f'shards are stored as one of {SHARD_DTYPES}'
+    assert len(items) > 0, 'nothing to pack'
+
+    os.makedirs(directory, exist_ok=True)
+    keys = list(items[0].keys())
+
+    dataset = monai.data.Dataset(data=list(items), transform=transform)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=None, num_workers=num_workers)
+
+    shards, arrays, position = [], None, 0
+
+    for index, sample in enumerate(tqdm(loader, total=len(items), desc='packing shards')):
+        if index % shard_size == 0:
+            count = min(shard_size, len(items) - index)
+            files = {key: f'{key}-{len(shards):05d}.npy' for key in keys}
+            arrays = {
+                key: np.lib.format.open_memmap(os.path.join(directory, file), mode='w+', dtype=dtype, shape=(count, 1, shape, shape))
+                for key, file in files.items()
+            }
+            shards.append(dict(count=count, files=files))
+            position = 0
+
+        for key in keys:
+            assert tuple(sample[key].shape) == (1, shape, shape), f'{items[index][key]} preprocessed to {tuple(sample[key].shape)}, expected {(1, shape, shape)}'
+            arrays[key][position] = encode(sample[key], dtype)
+
+        position += 1
+
+        if position == shards[-1]['count']:
+            for array in arrays.values():
+                array.flush()
+
+    index = dict(keys=keys, dtype=dtype, shape=[1, shape, shape], count=len(items), shards=shards, sources=list(items))
+
+    path = os.path.join(directory, INDEX_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(path + '.tmp', path)
+
+    return path
+
+class ShardDataset(torch.utils.data.Dataset):
+    """
+    the samples of one key of a pack_shards directory, float32 [1, shape, shape] tensors in [0, 1], indexable like the file lists
+    the datasets draw from, so the keys of a paired packing stay paired under a shared index
+    shards are memory mapped lazily, in each dataloader worker, the only copy per sample is its conversion to float32
+    """
+    def __init__(self, directory: str, key: str) -> None:
+        with open(os.path.join(directory, INDEX_FILE)) as f:
+            index = json.load(f)
+
+        assert key in index['keys'], f'{directory} holds {index["keys"]}, not {key}'
+
+        self.directory = directory
+        self.key = key
+        self.dtype = index['dtype']
+        self.files = [shard['files'][key] for shard in index['shards']]
+        self.offsets = np.cumsum([0] + [shard['count'] for shard in index['shards']]).tolist()
+        self.sources = [item[key] for item in index['sources']]
+        self._arrays = [None] * len(self.files)
+
+    def __len__(self) -> int:
+        return self.offsets[-1]
+
+    def __getstate__(self):
+        # workers open their own maps, a pickled memmap would be copied into memory
+        state = self.__dict__.copy()
+        state['_arrays'] = [None] * len(self.files)
+        return state
+
+    def array(self, shard: int):
+        if self._arrays[shard] is None:
+            self._arrays[shard] = np.load(os.path.join(self.directory, self.files[shard]), mmap_mode='r')
+        return self._arrays[shard]
+
+    def __getitem__(self, index: int) -> torch.Tensor:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f'sample {index} out of range for {len(self)} samples')
+
+        shard = bisect.bisect_right(self.offsets, index) - 1
+        sample = self.array(shard)[index - self.offsets[shard]]
+
+        if self.dtype == 'uint8':
+            return torch.from_numpy(np.multiply(sample, np.float32(1. / 255.), dtype=np.float32))
+        return torch.from_numpy(sample.astype(np.float32))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--folders", type=str, nargs="+", required=True, help="folders of png images, searched recursively")
+    parser.add_argument("--output", type=str, required=True, help="shard directory")
+    parser.add_argument("--key", type=str, default='image2d', help="key the samples are stored under")
+    parser.add_argument("--shape", type=int, default=256, help="spatial size of the tensor")
+    parser.add_argument("--dtype", type=str, default='uint8', choices=SHARD_DTYPES, help="storage dtype")
+    parser.add_argument("--shard_size", type=int, default=1024, help="samples per shard")
+    parser.add_argument("--no_histogram", action="store_true", help="skip the histogram normalization, as the CustomDataModule train loader does")
+    parser.add_argument("--num_workers", type=int, default=8, help="preprocessing workers")
+    hparams = parser.parse_args()
+
+    files = index_files(hparams.folders, '**/*.png')
+
+    transform = Compose(preprocess_transforms([hparams.key], shape=hparams.shape, histogram_normalize=not hparams.no_histogram))
+
+    path = pack_shards(
+        [{hparams.key: file} for file in files],
+        hparams.output,
+        transform,
+        shape=hparams.shape,
+        dtype=hparams.dtype,
+        shard_size=hparams.shard_size,
+        num_workers=hparams.num_workers,
+    )
+    print(f'packed {len(files)} samples, index at {path}')
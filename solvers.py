@@ -0,0 +1,178 @@
+import math
+
+import torch
+from tqdm.auto import tqdm
+
+# helpers functions
+
+def exists(x):
+    return x is not None
+
+class NoiseSchedule:
+    """
+    alpha_t = sqrt(alphas_cumprod[t]), sigma_t = sqrt(1 - alphas_cumprod[t]), lambda_t = log(alpha_t / sigma_t)
+    kept as python floats (float64) since the solvers only need scalar coefficients per step
+    """
+    def __init__(self, alphas_cumprod):
+        self.alphas_cumprod = alphas_cumprod.detach().double().cpu().tolist()
+
+    def alpha(self, t):
+        return math.sqrt(self.alphas_cumprod[t])
+
+    def sigma(self, t):
+        return math.sqrt(1. - self.alphas_cumprod[t])
+
+    def lambda_(self, t):
+        return 0.5 * (math.log(self.alphas_cumprod[t]) - math.log1p(-self.alphas_cumprod[t]))
+
+    def times(self, steps, spacing = 'logsnr'):
+        """
+        integer timesteps T-1 -> 0 with `steps` network evaluations in between
+        'logsnr' spaces them evenly in lambda (recommended by DPM-Solver for pixel space models), 'uniform' evenly in t
+        """
+        num_timesteps = len(self.alphas_cumprod)
+        assert 0 < steps < num_timesteps, f'number of solver steps must be between 1 and {num_timesteps - 1}'
+
+        if spacing == 'uniform':
+            return torch.linspace(num_timesteps - 1, 0, steps + 1).round().long().tolist()
+
+        assert spacing == 'logsnr', f'unknown timestep spacing {spacing}'
+
+        lambdas = torch.tensor([self.lambda_(t) for t in range(num_timesteps)], dtype = torch.float64)
+        grid = torch.linspace(lambdas[-1].item(), lambdas[0].item(), steps + 1, dtype = torch.float64)
+        times = (lambdas[None, :] - grid[:, None]).abs().argmin(dim = -1).tolist()
+
+        # neighbouring grid points can land on the same timestep where lambda is steep, keep them strictly decreasing from T-1 down to 0
+
+        for ind in range(1, steps + 1):
+            times[ind] = min(times[ind], times[ind - 1] - 1)
+
+        for ind in range(steps, -1, -1):
+            times[ind] = max(times[ind], steps - ind)
+
+        return times
+
+# dpm-solver++
+
+@torch.no_grad()
+def dpm_solver_pp_2m_sample(denoise_fn, img, alphas_cumprod, steps = 20, spacing = 'logsnr', lower_order_final = True):
+    """
+    DPM-Solver++(2M), https://arxiv.org/abs/2211.01095
+    multistep second order solver in data prediction form, one network evaluation per step
+    `denoise_fn(x, t)` returns the predicted x_0 for the whole batch at integer timestep t
+    """
+    schedule = NoiseSchedule(alphas_cumprod)
+    times = schedule.times(steps, spacing)
+
+    x = img
+    x_start_prev, h_prev = None, None
+
+    for ind, (time, time_next) in enumerate(tqdm(list(zip(times[:-1], times[1:])), desc = 'sampling loop time step')):
+        x_start = denoise_fn(x, time)
+
+        h = schedule.lambda_(time_next) - schedule.lambda_(time)
+
+        # first order on the first step, and on the last step when there are few steps, for stability
+
+        if x_start_prev is None or (lower_order_final and ind == steps - 1 and steps < 15):
+            d = x_start
+        else:
+            r = h_prev / h
+            d = x_start + (x_start - x_start_prev) * (0.5 / r)
+
+        x = x * (schedule.sigma(time_next) / schedule.sigma(time)) - d * (schedule.alpha(time_next) * math.expm1(-h))
+
+        x_start_prev, h_prev = x_start, h
+
+    return x
+
+# unipc
+
+def unipc_update(x, model_outputs, lambdas, schedule, time, time_next, order, model_output_next = None):
+    """
+    one UniP (predictor) step from `time` to `time_next`, or, when the model output at `time_next` is given, the UniC (corrector) step
+    `model_outputs` / `lambdas` hold the x_0 predictions and log snrs of the previous steps, the last one being at `time`
+    B(h) = expm1(-h) (the bh2 variant)
+    """
+    m0 = model_outputs[-1]
+    h = schedule.lambda_(time_next) - lambdas[-1]
+
+    rks, d1s = [], []
+    for i in range(1, order):
+        rk = (lambdas[-(i + 1)] - lambdas[-1]) / h
+        rks.append(rk)
+        d1s.append((model_outputs[-(i + 1)] - m0) / rk)
+
+    rks.append(1.)
+
+    hh = -h
+    h_phi_1 = math.expm1(hh)
+    h_phi_k = h_phi_1 / hh - 1
+    b_h = math.expm1(hh)
+
+    factorial_i = 1
+    R, b = [], []
+    for i in range(1, order + 1):
+        R.append([rk ** (i - 1) for rk in rks])
+        b.append(h_phi_k * factorial_i / b_h)
+        factorial_i *= i + 1
+        h_phi_k = h_phi_k / hh - 1 / factorial_i
+
+    R, b = torch.tensor(R, dtype = torch.float64), torch.tensor(b, dtype = torch.float64)
+
+    alpha_next = schedule.alpha(time_next)
+    x_next = x * (schedule.sigma(time_next) / schedule.sigma(time)) - m0 * (alpha_next * h_phi_1)
+
+    if model_output_next is None:
+        if order == 1:
+            return x_next
+
+        rhos = [0.5] if order == 2 else torch.linalg.solve(R[:-1, :-1], b[:-1]).tolist()
+        res = sum(rho * d1 for rho, d1 in zip(rhos, d1s))
+        return x_next - res * (alpha_next * b_h)
+
+    rhos = [0.5] if order == 1 else torch.linalg.solve(R, b).tolist()
+    res = (model_output_next - m0) * rhos[-1]
+    for rho, d1 in zip(rhos[:-1], d1s):
+        res = res + d1 * rho
+
+    return x_next - res * (alpha_next * b_h)
+
+@torch.no_grad()
+def unipc_sample(denoise_fn, img, alphas_cumprod, steps = 20, order = 2, spacing = 'logsnr', lower_order_final = True):
+    """
+    UniPC, https://arxiv.org/abs/2302.04867
+    UniP predictor with the UniC corrector reusing the next network evaluation, so still one evaluation per step
+    `denoise_fn(x, t)` returns the predicted x_0 for the whole batch at integer timestep t
+    """
+    schedule = NoiseSchedule(alphas_cumprod)
+    times = schedule.times(steps, spacing)
+
+    x = img
+    x_prev = None
+    model_outputs, lambdas = [], []
+    this_order = 1
+
+    for ind, time in enumerate(tqdm(times[:-1], desc = 'sampling loop time step')):
+        x_start = denoise_fn(x, time)
+
+        # correct the previous prediction with the evaluation at the current time
+
+        if exists(x_prev):
+            x = unipc_update(x_prev, model_outputs, lambdas, schedule, times[ind - 1], time, this_order, model_output_next = x_start)
+
+        model_outputs = [*model_outputs, x_start][-order:]
+        lambdas = [*lambdas, schedule.lambda_(time)][-order:]
+
+        this_order = min(order, steps - ind) if lower_order_final else order
+        this_order = min(this_order, len(model_outputs))
+
+        x_prev = x
+        x = unipc_update(x, model_outputs, lambdas, schedule, time, times[ind + 1], this_order)
+
+    return x
+
+SOLVERS = dict(
+    dpmpp_2m = dpm_solver_pp_2m_sample,
+    unipc = unipc_sample
+)
@@ -0,0 +1,27 @@
+import pytest
+import torch
+from torch import nn
+
+import cdiff
+import model
+
+TOLERANCES = {torch.float32: dict(rtol = 1e-5, atol = 1e-5), torch.bfloat16: dict(rtol = 2e-2, atol = 2e-2)}
+
+@pytest.mark.parametrize('module', [model, cdiff])
+@pytest.mark.parametrize('dtype', [torch.float32, torch.bfloat16])
+@pytest.mark.parametrize('with_scale_shift', [False, True])
+def test_fused_block_matches_unfused(module, dtype, with_scale_shift):
+    torch.manual_seed(0)
+    fused = module.Block(32, 64, groups = 8, fused = True)
+    nn.init.normal_(fused.norm.weight)
+    nn.init.normal_(fused.norm.bias)
+
+    unfused = module.Block(32, 64, groups = 8, fused = False)
+    unfused.load_state_dict(fused.state_dict())
+    fused, unfused = fused.to(dtype), unfused.to(dtype)
+
+    x = torch.randn(2, 32, 16, 16, dtype = dtype)
+    scale_shift = tuple(torch.randn(2, 64, 1, 1, dtype = dtype) for _ in range(2)) if with_scale_shift else None
+
+    with torch.no_grad():
+        torch.testing.assert_close(fused(x, scale_shift), unfused(x, scale_shift), **TOLERANCES[dtype])
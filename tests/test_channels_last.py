@@ -0,0 +1,33 @@
+import pytest
+import torch
+
+import cdiff
+import model
+from layers import channels_last_violations
+
+def build(module, full_attn, **kwargs):
+    torch.manual_seed(0)
+    conditional = dict(num_classes = 2) if module is cdiff else {}
+    return module.Unet(dim = 16, dim_mults = (1, 2), channels = 1, full_attn = (full_attn, full_attn), **conditional, **kwargs).eval()
+
+def inputs(module):
+    x = torch.randn(2, 1, 32, 32)
+    time = torch.tensor([3, 500])
+    if module is cdiff:
+        return (x, time, torch.tensor([0, 1])), dict(cond_drop_prob = 0.)
+    return (x, time), {}
+
+@pytest.mark.parametrize('module', [model, cdiff])
+@pytest.mark.parametrize('full_attn', [False, True])
+@pytest.mark.parametrize('preallocate_skips', [False, True])
+def test_channels_last_unet_keeps_its_layout(module, full_attn, preallocate_skips):
+    reference = build(module, full_attn)
+    unet = build(module, full_attn, channels_last = True, preallocate_skips = preallocate_skips)
+    unet.load_state_dict(reference.state_dict())
+
+    args, kwargs = inputs(module)
+    channels_last_args = (args[0].contiguous(memory_format = torch.channels_last), *args[1:])
+
+    with torch.no_grad():
+        assert channels_last_violations(unet, *channels_last_args, **kwargs) == []
+        torch.testing.assert_close(unet(*channels_last_args, **kwargs), reference(*args, **kwargs), rtol = 1e-4, atol = 1e-5)
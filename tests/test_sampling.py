@@ -0,0 +1,47 @@
+import pytest
+import torch
+from torch import nn
+
+from model import GaussianDiffusion
+
+class TwoMaskDenoiser(nn.Module):
+    """ the exact x_start posterior mean of data made of two masks, so the prediction depends on the noisy input """
+    channels = out_dim = 1
+    self_condition = False
+    learned_sinusoidal_cond = False
+
+    def __init__(self, masks):
+        super().__init__()
+        self.register_buffer('masks', masks)
+        self.alphas_cumprod = None
+
+    def cache_time_embeddings(self, num_timesteps):
+        pass
+
+    def forward(self, x, time, x_self_cond = None):
+        alpha = self.alphas_cumprod[time].view(-1, 1)
+        dist = (x.unsqueeze(1) - alpha.sqrt().view(-1, 1, 1, 1, 1) * self.masks).flatten(2).pow(2).sum(-1)
+        weights = torch.softmax(-dist / (2 * (1 - alpha)), dim = 1)
+        return torch.einsum('b k, k c h w -> b c h w', weights, self.masks)
+
+@pytest.mark.parametrize('sampler, sampling_timesteps', [('ddpm', 100), ('ddim', 20)])
+def test_until_stable_keeps_the_final_mask(sampler, sampling_timesteps):
+    size = 16
+    first = -torch.ones(1, size, size)
+    first[..., :size // 2] = 1.
+    second = -torch.ones(1, size, size)
+    second[:, 6:] = 1.
+
+    model = TwoMaskDenoiser(torch.stack([first, second]))
+    diffusion = GaussianDiffusion(model, image_size = size, timesteps = 100, sampling_timesteps = sampling_timesteps, objective = 'pred_x0')
+    model.alphas_cumprod = diffusion.alphas_cumprod
+
+    for seed in range(4):
+        torch.manual_seed(seed)
+        full = diffusion.sample(batch_size = 8, sampler = sampler) > 0.5
+
+        torch.manual_seed(seed)
+        early, steps = diffusion.sample_until_stable(batch_size = 8, sampler = sampler)
+
+        assert torch.equal(early > 0.5, full)
+        assert (steps < sampling_timesteps).all()
@@ -0,0 +1,68 @@
+import os
+
+import numpy as np
+import torch
+from PIL import Image
+
+from monai.transforms import Compose, DivisiblePadd, LoadImaged, RandFlipd, Resized, ScaleIntensityd, ToTensord
+
+from transform_cache import CACHE_SUFFIX, CachedTransform
+
+KEYS = ["image", "label"]
+
+def chain():
+    return Compose(
+        [
+            LoadImaged(keys=KEYS, ensure_channel_first=True),
+            ScaleIntensityd(keys=KEYS, minv=0.0, maxv=1.0),
+            Resized(keys=KEYS, spatial_size=32, size_mode="longest", mode=["area", "nearest"]),
+            DivisiblePadd(keys=KEYS, k=32, mode="constant", constant_values=0.0),
+            RandFlipd(keys=KEYS, prob=0.5, spatial_axis=0),
+            ToTensord(keys=KEYS),
+        ]
+    )
+
+def write_pngs(folder, names):
+    rng = np.random.default_rng(0)
+    paths = []
+    for name in names:
+        path = os.path.join(folder, name + '.png')
+        Image.fromarray(rng.integers(0, 255, (48, 40), dtype=np.uint8)).save(path)
+        paths.append(path)
+    return paths
+
+def test_a_file_shared_by_samples_is_cached_once(tmp_path):
+    image, first_label, second_label = write_pngs(tmp_path, ['image', 'first_label', 'second_label'])
+    cache_dir = os.path.join(tmp_path, 'cache')
+
+    transform = CachedTransform(chain(), cache_dir)
+    samples = [dict(image=image, label=first_label), dict(image=image, label=second_label)]
+
+    for sample in samples:
+        cached = transform.cached(sample)
+        expected = transform.deterministic(dict(sample))
+        for key in KEYS:
+            assert torch.equal(torch.as_tensor(cached[key]), torch.as_tensor(expected[key]))
+
+    entries = [name for name in os.listdir(cache_dir) if name.endswith(CACHE_SUFFIX)]
+    assert len(entries) == 3
+    assert os.path.exists(os.path.join(cache_dir, transform.key("image", image) + CACHE_SUFFIX))
+
+def test_shared_memory_holds_one_segment_per_file(tmp_path):
+    images = write_pngs(tmp_path, ['first_image', 'second_image'])
+    labels = write_pngs(tmp_path, ['first_label', 'second_label'])
+
+    transform = CachedTransform(chain(), shm_bytes=2 ** 26, shm_prefix=f'dft{os.getpid() % 1000}-')
+    transform.shared.clear()
+
+    try:
+        # every image with every label, four samples over four files
+        for image in images:
+            for label in labels:
+                transform(dict(image=image, label=label))
+
+        names = sorted(name for name, _ in transform.shared.segments())
+        expected = sorted(transform.shared.name(transform.key(key, path)) for key, paths in zip(KEYS, (images, labels)) for path in paths)
+        assert names == expected
+    finally:
+        transform.shared.clear()
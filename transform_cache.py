@@ -0,0 +1,334 @@
+import os
+import copy
+import enum
+import json
+import pickle
+import hashlib
+
+import numpy as np
+import torch
+
+from typing import Dict, List, Optional, Tuple
+
+from multiprocessing import resource_tracker, shared_memory
+
+from monai.transforms import Compose, MapTransform, Randomizable, Transform
+
+# persistent disk cache of the deterministic prefix of a transform chain
+# split_transforms cuts a Compose at its first random transform, CachedTransform runs the prefix (decode, rescale,
+# histogram normalization, resize, pad) once per file and stores its output under a key of the sample key, the file path,
+# its mtime and a hash of the prefix, so only the random suffix (the flips) runs per sample, and an edited png or transform
+# misses. a file drawn into many samples (paired with other labels or unpaired images) is still decoded and stored once
+# in front of the disk sits a host wide shared memory tier, one segment per file that every dataloader worker and every
+# local ddp rank attaches to, entries past its cap stay on disk
+
+CACHE_SUFFIX = '.pt'
+SHM_PREFIX = 'dfs-'  # segment names are short on macos, prefix and key stay under 31 characters
+SHM_DIR = '/dev/shm'
+SHM_ALIGNMENT = 64
+SHM_RESCAN = 16
+
+def flatten(transform) -> list:
+    """ the transforms of a (nested) Compose, in order """
+    if isinstance(transform, Compose):
+        return [t for child in transform.transforms for t in flatten(child)]
+    return [transform]
+
+def split_transforms(transform) -> Tuple[Compose, Compose]:
+    """ (deterministic prefix, suffix from the first Randomizable on) of a transform chain """
+    transforms = flatten(transform)
+    split = next((i for i, t in enumerate(transforms) if isinstance(t, Randomizable)), len(transforms))
+    return Compose(transforms[:split]), Compose(transforms[split:])
+
+def describe(obj, depth: int = 6):
+    """ a stable, address free description of a transform and its settings, what the transform hash is taken over """
+    if isinstance(obj, (str, int, float, bool, type(None))):
+        return repr(obj)
+    if isinstance(obj, enum.Enum):
+        return f'{type(obj).__name__}.{obj.name}'
+    if isinstance(obj, (torch.dtype, np.dtype, type)):
+        return str(obj)
+    if isinstance(obj, np.ndarray):
+        return hashlib.sha1(np.ascontiguousarray(obj).tobytes()).hexdigest()
+    if isinstance(obj, torch.Tensor):
+        return describe(obj.detach().cpu().numpy(), depth)
+    if isinstance(obj, (list, tuple)):
+        return '[' + ', '.join(describe(item, depth - 1) for item in obj) + ']'
+    if isinstance(obj, dict):
+        return '{' + ', '.join(f'{key}: {describe(value, depth - 1)}' for key, value in sorted(obj.items(), key=lambda item: str(item[0]))) + '}'
+    if isinstance(obj, np.random.RandomState):
+        return 'RandomState'
+
+    name = f'{type(obj).__module__}.{type(obj).__qualname__}'
+    if callable(obj) and not hasattr(obj, '__dict__'):
+        return getattr(obj, '__qualname__', name)
+    if depth <= 0 or not hasattr(obj, '__dict__'):
+        return name
+    return name + describe(vars(obj), depth - 1)
+
+def transform_hash(transform) -> str:
+    return hashlib.sha1(describe(flatten(transform)).encode()).hexdigest()
+
+def align(offset: int) -> int:
+    return -(-offset // SHM_ALIGNMENT) * SHM_ALIGNMENT
+
+def open_segment(name: str, create: bool = False, size: int = 0):
+    segment = shared_memory.SharedMemory(name=name, create=create, size=size)
+    # the resource tracker would unlink the segment when the worker that created (or attached) it exits,
+    # the cache outlives the workers, segments are removed by SharedMemoryCache.clear
+    resource_tracker.unregister(segment._name, 'shared_memory')
+    return segment
+
+def as_array(value):
+    if hasattr(value, 'as_tensor'):  # MetaTensor
+        value = value.as_tensor()
+    if isinstance(value, torch.Tensor):
+        value = value.detach().cpu().numpy()
+    return np.ascontiguousarray(value)
+
+class SharedMemoryCache:
+    """
+    host wide in memory cache of dicts of arrays (and json values), one shared memory segment per entry, named after its key,
+    CachedTransform stores one entry per file, so a file drawn into many samples is held once per host
+    a segment starts with the length of its json header, written last, so a reader never sees a half written entry,
+    followed by the header (dtype, shape, offset per array) and the aligned arrays
+    the cap is over all segments of the prefix on the host, summed from /dev/shm every SHM_RESCAN inserts of a process
+    """
+    def __init__(self, max_bytes: int, prefix: str = SHM_PREFIX) -> None:
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+        self._bytes = None
+        self._inserts = 0
+
+    def name(self, key: str) -> str:
+        return self.prefix + key[:24]
+
+    def segments(self) -> List[Tuple[str, int]]:
+        """ (name, size) of the segments of the prefix, empty where shared memory is not listed under /dev/shm """
+        if not os.path.isdir(SHM_DIR):
+            return []
+
+        segments = []
+        with os.scandir(SHM_DIR) as it:
+            for entry in it:
+                if not entry.name.startswith(self.prefix):
+                    continue
+                try:
+                    segments.append((entry.name, entry.stat().st_size))
+                except FileNotFoundError:
+                    continue
+        return segments
+
+    def get(self, key: str) -> Optional[Dict]:
+        try:
+            segment = open_segment(self.name(key))
+        except FileNotFoundError:
+            return None
+
+        try:
+            length = int.from_bytes(segment.buf[:8], 'little')
+            if length == 0:  # still being written, or its writer died
+                return None
+
+            header = json.loads(bytes(segment.buf[8:8 + length]))
+            start = align(8 + length)
+
+            data = {}
+            for name, entry in header.items():
+                if 'dtype' not in entry:
+                    data[name] = entry['value']
+                    continue
+                array = np.ndarray(entry['shape'], dtype=entry['dtype'], buffer=segment.buf, offset=start + entry['offset'])
+                data[name] = torch.from_numpy(array.copy())
+                del array  # the segment cannot be closed while a view of it is alive
+            return data
+        finally:
+            segment.close()
+
+    def put(self, key: str, data: Dict) -> bool:
+        """ stores data under key, False when it would take the segments past max_bytes or holds values json cannot store """
+        header, arrays, offset = {}, [], 0
+        for name, value in data.items():
+            if isinstance(value, (torch.Tensor, np.ndarray)):
+                array = as_array(value)
+                header[name] = dict(dtype=array.dtype.str, shape=list(array.shape), offset=offset)
+                arrays.append((offset, array))
+                offset = align(offset + array.nbytes)
+            else:
+                header[name] = dict(value=value)
+
+        try:
+            encoded = json.dumps(header).encode()
+        except TypeError:
+            return False
+
+        start = align(8 + len(encoded))
+        size = start + offset
+
+        if self._bytes is None or self._inserts % SHM_RESCAN == 0:
+            self._bytes = sum(used for _, used in self.segments()) or (self._bytes or 0)
+        if self._bytes + size > self.max_bytes:
+            return False
+
+        try:
+            segment = open_segment(self.name(key), create=True, size=max(size, 1))
+        except FileExistsError:  # another worker or rank stored it
+            return True
+
+        try:
+            for array_offset, array in arrays:
+                view = np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf, offset=start + array_offset)
+                view[...] = array
+                del view
+            segment.buf[8:8 + len(encoded)] = encoded
+            segment.buf[:8] = len(encoded).to_bytes(8, 'little')
+        finally:
+            segment.close()
+
+        self._bytes += size
+        self._inserts += 1
+        return True
+
+    def clear(self) -> None:
+        """ removes every segment of the prefix on the host, the segments outlive training runs until then (or a reboot) """
+        for name, _ in self.segments():
+            try:
+                os.remove(os.path.join(SHM_DIR, name))
+            except FileNotFoundError:
+                pass
+
+class CachedTransform(Transform):
+    """
+    a transform chain whose deterministic prefix is cached, a drop in for the Compose it splits
+    items are dicts of key -> path (or other plain values), each path run through the prefix on its own and cached under
+    the key, the path, its mtime and size and the prefix hash, the other values go through the prefix uncached
+    with shm_bytes, the per file entries go to a SharedMemoryCache of that cap (segments named shm_prefix + key) first,
+    those past it (or all, without) to cache_dir
+    the disk cache is bounded to max_bytes, least recently used entries (by mtime, touched on every hit) are evicted past it
+    every dataloader worker reads and writes the same directory, entries are written to a temporary file and renamed into place
+    """
+    def __init__(self, transform, cache_dir: Optional[str] = None, max_bytes: int = 32 * 2 ** 30, shm_bytes: int = 0, shm_prefix: str = SHM_PREFIX) -> None:
+        self.deterministic, self.random = split_transforms(transform)
+
+        # the prefix runs on one file at a time, its map transforms skip the keys of the other files of the sample
+
+        self.deterministic = Compose([self.per_key(t) for t in self.deterministic.transforms])
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.shared = SharedMemoryCache(shm_bytes, shm_prefix) if shm_bytes > 0 else None
+        self.prefix_hash = transform_hash(self.deterministic)
+        self._bytes = None
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def per_key(transform):
+        if not isinstance(transform, MapTransform) or transform.allow_missing_keys:
+            return transform
+        transform = copy.copy(transform)
+        transform.allow_missing_keys = True
+        return transform
+
+    def key(self, name: str, path: str) -> str:
+        """ the cache key of the file at path under the sample key name, the prefix treats each key its own way """
+        stat = os.stat(path)
+        return hashlib.sha1(f'{self.prefix_hash}:{name}:{os.path.abspath(path)}:{stat.st_mtime_ns}:{stat.st_size}'.encode()).hexdigest()
+
+    def entries(self) -> List[Tuple[int, int, str]]:
+        """ (mtime, size, path) of the cache entries """
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if not entry.name.endswith(CACHE_SUFFIX):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:  # evicted by another worker
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        return entries
+
+    def evict(self) -> None:
+        """ removes the least recently used entries until the cache is back under 90% of max_bytes """
+        entries = self.entries()
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+        self._bytes = total
+
+    def load(self, path: str) -> Optional[Dict]:
+        try:
+            data = torch.load(path, weights_only=True)
+        except (FileNotFoundError, EOFError, RuntimeError, pickle.UnpicklingError):  # missing, evicted or unreadable
+            return None
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return data
+
+    def save(self, path: str, data: Dict) -> None:
+        stored = {key: value.as_tensor() if hasattr(value, 'as_tensor') else value for key, value in data.items()}
+
+        tmp = f'{path}.{os.getpid()}.tmp'
+        torch.save(stored, tmp)
+        os.replace(tmp, path)
+
+        # each worker keeps its own running estimate, the directory scan of evict resynchronizes them
+
+        if self._bytes is None:
+            self._bytes = sum(size for _, size, _ in self.entries())
+        else:
+            self._bytes += os.path.getsize(path)
+
+        if self._bytes > self.max_bytes:
+            self.evict()
+
+    def cached_file(self, name: str, file: str) -> Dict:
+        """ the output of the deterministic prefix for {name: file}, from the caches or computed and stored """
+        key = self.key(name, file)
+
+        if self.shared is not None:
+            cached = self.shared.get(key)
+            if cached is not None:
+                return cached
+
+        path = os.path.join(self.cache_dir, key + CACHE_SUFFIX) if self.cache_dir is not None else None
+
+        cached = self.load(path) if path is not None else None
+        on_disk = cached is not None
+
+        if cached is None:
+            cached = self.deterministic({name: file})
+
+        # disk entries are promoted to memory while it has room, what does not fit stays on (or goes to) disk
+
+        in_memory = self.shared is not None and self.shared.put(key, cached)
+
+        if path is not None and not on_disk and not in_memory:
+            self.save(path, cached)
+
+        return cached
+
+    def cached(self, data: Dict) -> Dict:
+        """ the output of the deterministic prefix for data, assembled from the per file entries """
+        files = {key: value for key, value in data.items() if isinstance(value, str) and os.path.isfile(value)}
+        others = {key: value for key, value in data.items() if key not in files}
+
+        out = dict(self.deterministic(others)) if others else {}
+        for key, path in files.items():
+            out.update(self.cached_file(key, path))
+        return out
+
+    def __call__(self, data: Dict) -> Dict:
+        return self.random(self.cached(data))